@@ -32,6 +32,7 @@ from IPython.display import clear_output
 
 sys.path.append(r'/home/eag190/mcd/Circle Grape/class description')
 from circle_grape_v5 import *
+from mcd.search import minimal_search, resample_pulses
 #--------------------------------------------------------------------------------------------
 
 #---------------------------------------------------------------------------Data Storage
@@ -204,30 +205,30 @@ def remove_inter_vecs(filename):
 
 #------------------------------------------------------------------Looping
 fock_states = [2]
+target_err = 1e-3
+time_step = 100 # ns, bracket step
+time_resolution = 20 # ns, resolution of the minimal time
+max_time = 2000
 
 def main(fname = fname, df = df):
     '''
-    Vary time length, get fidelity
+    Minimal pulse time for each fock state transfer: bracket + bisection over total_time (mcd.search),
+    each time point warm started from the best pulse of the closest time already tried
     '''
     filenum = 1000
-    last_err = 1
-    last_time = 100
-    initial_guess_ = None
+    start_time = 100
 
     for fock in fock_states:
         print(fock)
-        last_err = 1
-        # if fock == 1: 
-        #     last_time = 2250
-        #     last_err = 3e-3
-        
-        
-        while last_err>1e-3 and last_time<2000:
-            time = last_time
-            print(time)
+
+        def evaluate(time, warm_pulses):
+            '''
+            5 GRAPE runs at total_time = time; feasible if the best error < target_err
+            '''
+            nonlocal df, filenum
             clear_output(wait = True)
+            print(time)
             total_time = time
-            
             steps = int(time/2) # 2ns timestep
             
             reg_coeffs = {'dwdt': 0.1, 'd2wdt2': 1.0e-3, 'forbid_dressed': False,
@@ -240,12 +241,13 @@ def main(fname = fname, df = df):
                                                         number_of_modes = mode,hparams = circle_grape_params,
                                                         add_disp_kerr=False)
 
-
-            #choosing initial guess
-            
+            best_err, best_uks = np.inf, None
             for t in range(0, 5, 1): # 5 initial guesses
+                #choosing initial guess: the neighbouring time's best pulse, then lower fock pulses
                 initial_guess_ = None
-                if fock-t >0: 
+                if t == 0 and warm_pulses is not None:
+                    initial_guess_ = resample_pulses(warm_pulses, steps, 2 * np.pi * qubit_drive_amp)
+                elif fock-t >0: 
                     initial_guess_ = initial_guess(fock -t, steps, time, qubit_drive_amp,  df)
 
 
@@ -267,16 +269,23 @@ def main(fname = fname, df = df):
                 err  = min(hf['error'])
                 if np.isnan(err):
                     err = -1
-                #err = 1
-                last_err = err
+                elif err < best_err:
+                    best_err = err
+                    best_uks = np.array(hf['uks'][np.argmin(hf['error'])])
                 new_filename = remove_inter_vecs(op.filename)
                 new_row = [[fock, total_time, steps, alpha, detuning,  qubit_drive_amp, err, new_filename]]
                 df_new = pd.DataFrame(new_row, columns=columns)
                 df = pd.concat([df_new,df], ignore_index = True)
                 df.to_csv(parent_path + fname, index=False)
-                
-            last_time +=100
-        last_time -=100 # so that next fock state transfer starts at last_time, not last_time + 200ns
+                if best_err < target_err:
+                    break
+            return best_err < target_err, best_uks
+
+        min_time, history = minimal_search(evaluate, start_time, time_step, resolution = time_resolution,
+                                           max_value = max_time)
+        print('fock %d: minimal time %s ns (%d time points)' % (fock, str(min_time), len(history)))
+        if min_time is not None:
+            start_time = min_time # next fock state transfer starts at the last minimal time
         
     clear_output(wait = True)
     return df
@@ -6,8 +6,6 @@ import inspect
 import numpy as np
 from scipy.special import factorial
 import h5py
-from quantum_optimal_control.helper_functions.grape_functions import *
-from quantum_optimal_control.main_grape.grape import Grape
 from itertools import product
 import itertools
 
@@ -15,11 +13,18 @@ import itertools
 #data_path
 #initial_pulse = '../pulses/example_pulses/transmon_cat_initial_pulse.h5'
 from h5py import File
-import matplotlib.pyplot as plt
-from pylab import*
-from qutip import*
+# matplotlib, qutip and quantum_optimal_control (tensorflow) are imported on first use
+# (plots, qutip solvers, backend = 'qoc'), so the numpy paths import fast on workers
 
 from scipy import interpolate
+from mcd.pwc_propagator import pwc_propagator
+from mcd.split_operator import split_operator_propagator
+from mcd.operators import get_operators
+from mcd.grape import native_grape
+from mcd.runtime import get_logger, plots_requested
+from mcd import metrics
+
+logger = get_logger('circle_grape')
 
 #V1 : Given By Vatsan
 #V3: Make sure that Grape now returns filename and that the following class has a local variable called filename; this avoids manual input
@@ -27,6 +32,10 @@ from scipy import interpolate
 #V5: Added f state
 # The time dependence of the blockade drive is rotated out.
 
+# eigendecompositions of H_rot (and their quantum number labels) shared by all instances,
+# keyed by (qnum, mnum, mmnum, f_state, hparams)
+eigenbasis_cache = {}
+
 
 class multimode_circle_grape_optimal_control:
     
@@ -53,20 +62,16 @@ class multimode_circle_grape_optimal_control:
     def initialize_operators(self):
         '''
         Create qubit and mode versions of pauli/creation/annhilation operators
+        (ladder/number/x/y operators come from the shared mcd.operators registry)
         '''
-        self.Q_x = np.diag(np.sqrt(np.arange(1, self.transmon_levels)), 1)+np.diag(np.sqrt(np.arange(1, self.transmon_levels)), -1)
-        self.Q_y = (0-1j) * (np.diag(np.sqrt(np.arange(1, self.transmon_levels)), 1)-np.diag(np.sqrt(np.arange(1, self.transmon_levels)), -1))
-        self.Q_z = np.diag(np.arange(0, self.transmon_levels))
-        self.I_q = np.identity(self.transmon_levels)
-
-        #Qubit projection operators 
-        self.Q_projs = []
-        q_zeroes = [0 for i in range(self.transmon_levels)] #|g><g|, |e><e|, ...
-        for k in range(0, self.transmon_levels): 
-            diag = q_zeroes.copy()
-            diag[k] = 1
-            proj = np.diag(diag)
-            self.Q_projs.append(proj)
+        ops = get_operators(self.transmon_levels, self.mode_levels, self.mmnum, backend = 'numpy')
+        self.Q_x = ops.x_q
+        self.Q_y = ops.y_q
+        self.Q_z = ops.num_q
+        self.I_q = ops.identity_q
+
+        #Qubit projection operators  |g><g|, |e><e|, ...
+        self.Q_projs = ops.q_projectors
         
         #Sigma_x matrices 
         self.Q_sigmaXs = [] # sigma_x^ge, sigma_x^fe, ...
@@ -87,38 +92,30 @@ class multimode_circle_grape_optimal_control:
 
         
         # Mode Pauli Operatirs
-        self.M_x = np.diag(np.sqrt(np.arange(1, self.mode_levels)), 1)+np.diag(np.sqrt(np.arange(1, self.mode_levels)), -1)
-        self.M_y = (0-1j) * (np.diag(np.sqrt(np.arange(1, self.mode_levels)), 1)-np.diag(np.sqrt(np.arange(1, self.mode_levels)), -1))
-        self.M_z = np.diag(np.arange(0, self.mode_levels))
-        self.I_m = np.identity(self.mode_levels)
-        self.am =  np.diag(np.sqrt(np.arange(1, self.mode_levels)), 1)
-        self.amdag =  np.diag(np.sqrt(np.arange(1, self.mode_levels)), -1)
-        self.aq =  np.diag(np.sqrt(np.arange(1, self.transmon_levels)), 1)
-
-        self.M_zs,self.M_xs,self.M_ys,self.ams=  [],[],[],[]
-        self.a_s,self.adag_s = [],[]
-        
-        for k in np.arange(self.mmnum):
-            mmz = self.M_z*(k==0) + self.I_m*(1-(k==0))
-            mmx = self.M_x*(k==0) + self.I_m*(1-(k==0))
-            mmy = self.M_y*(k==0) + self.I_m*(1-(k==0))
-            mma = self.am*(k==0) + self.I_m*(1-(k==0))
-            mmadag = self.amdag*(k==0) + self.I_m*(1-(k==0))
-            for m in np.arange(1,self.mmnum):
-                mmz = np.kron(mmz,self.M_z*(k==m) + self.I_m*(1-(k==m)))
-                mmx = np.kron(mmx,self.M_x*(k==m) + self.I_m*(1-(k==m)))
-                mmy = np.kron(mmy,self.M_y*(k==m) + self.I_m*(1-(k==m)))
-                mma = np.kron(mma,self.am*(k==m) + self.I_m*(1-(k==m)))
-                mmadag = np.kron(mmadag,self.amdag*(k==m) + self.I_m*(1-(k==m)))
-            self.M_zs.append(mmz)
-            self.M_xs.append(mmx)
-            self.M_ys.append(mmy)
-            self.a_s.append(mma)
-            self.adag_s.append(mmadag)
-            self.ams.append(Qobj(np.kron(self.I_q, mma)))
-        self.I_mm = self.I_m
-        for m in np.arange(1,self.mmnum):self.I_mm = np.kron(self.I_mm,self.I_m)
-        self.aqmm = Qobj(np.kron(self.aq,self.I_mm))
+        self.M_x = ops.x_c
+        self.M_y = ops.y_c
+        self.M_z = ops.num_c
+        self.I_m = ops.identity_c
+        self.am =  ops.a_c
+        self.amdag =  ops.adag_c
+        self.aq =  ops.a_q
+
+        # each mode with identity on the other modes
+        self.M_zs,self.M_xs,self.M_ys = ops.num_mm, ops.x_mm, ops.y_mm
+        self.a_s,self.adag_s = ops.a_mm, ops.adag_mm
+        self._a_full = ops.a_full
+        self.I_mm = ops.identity_mm
+        self._a_q_full = ops.a_q_full
+
+    @property
+    def ams(self):
+        from qutip import Qobj
+        return [Qobj(a) for a in self._a_full]
+
+    @property
+    def aqmm(self):
+        from qutip import Qobj
+        return Qobj(self._a_q_full)
 
     def openfile(self,filename = None):
         if filename is None: 
@@ -140,7 +137,7 @@ class multimode_circle_grape_optimal_control:
             #now making Delta*a^\dagger a but have to account for all other modes being identity
             #mode_ens = np.array([2*np.pi*mm*(mode_freq - 0.5*(mm-1)*kappas[ii]) for mm in np.arange(self.mnum)]) #each level has a diff frequency (if anharmonic i guess)
             mode_ens = np.array([2*np.pi*mm*(mode_freq - 0.5*(mm-1)*0) for mm in np.arange(self.mnum)])
-            print(mode_ens)
+            logger.debug('mode energies: ' + str(mode_ens))
             H_m = np.diag(mode_ens)
             ret = H_m*(ii==0) + self.I_m*(1-(ii==0))
             for m in np.arange(1,self.mmnum):
@@ -152,7 +149,7 @@ class multimode_circle_grape_optimal_control:
             H0 += 2* np.pi*(np.abs(alpha)**2)*(np.kron(chi_e_mat, (self.I_mm)))    # constant real displacement
 
             if self.f_state: 
-                print('f mat included')
+                logger.debug('f mat included')
                 H0 += 2* np.pi*(np.kron(chi_f_mat, (self.adag_s[ii] * self.a_s[ii])))          # chi a^dag a sigma_z term
                 H0 += 2* np.pi*alpha*(np.kron(chi_f_mat, (self.adag_s[ii] + self.a_s[ii])))    # constant real displacement
                 H0 += 2* np.pi*(np.abs(alpha)**2)*(np.kron(chi_f_mat, (self.I_mm)))    # constant real displacement
@@ -218,6 +215,7 @@ class multimode_circle_grape_optimal_control:
         return fine_pulses
 
     def plot_pulses(self,filename = None,plot_cavity=False):
+        import matplotlib.pyplot as plt
         if filename == None: 
             filename = self.filename
         pulses = self.return_pulses(filename)
@@ -232,7 +230,9 @@ class multimode_circle_grape_optimal_control:
         ax.set_ylabel("Pulse amplitude (GHz)")
         return fig
     
+    @metrics.timed('hamiltonian.assembly', step = 'build')
     def total_H(self,filename):
+        from qutip import Qobj
         if self.ROTATING:
 
             H = [Qobj(self.H_rot())]
@@ -257,7 +257,21 @@ class multimode_circle_grape_optimal_control:
                             plot_only_g = True,
                             use_gpu=False,
                             states_forbidden_list = [],initial_guess = None, 
-                            file_name = "test",data_path="test",specify_state_amplitudes = False, save = True):
+                            file_name = "test",data_path="test",specify_state_amplitudes = False, save = True,
+                            backend = 'qoc', propagator = 'exact', n_sub = 1, show_plots = None):
+        # backend = 'qoc'   : quantum_optimal_control Grape (tensorflow, Adam)
+        # backend = 'native': mcd.grape.native_grape (numpy/scipy L-BFGS-B with exact gradients, state transfer only),
+        #                     propagator = 'exact' or 'split' (split operator steps, n_sub substeps per step)
+        # show_plots: qoc progress plots (default: unless headless, see mcd.runtime)
+        if backend not in ['qoc', 'native']:
+            raise ValueError("backend must be 'qoc' or 'native', not " + str(backend))
+        if backend == 'native' and not state_transfer:
+            raise ValueError("backend = 'native' only supports state transfer")
+        if backend == 'qoc':
+            try:
+                from quantum_optimal_control.main_grape.grape import Grape
+            except ImportError:
+                raise ImportError("quantum_optimal_control is not installed, use backend = 'native'")
    
         Hops = self.controlHs()
         H0 = self.H_rot()
@@ -270,7 +284,7 @@ class multimode_circle_grape_optimal_control:
             Hnames.extend(['qubit'+str('')+'__ef_x', 'qubit'+str('')+'_ef_y'])
             ops_max_amp.extend([max_amp*2*np.pi, max_amp*2*np.pi])
 
-        print([len(Hops), len(ops_max_amp), len(Hnames)])
+        logger.debug('controls: ' + str([len(Hops), len(ops_max_amp), len(Hnames)]))
 
 
         U = []
@@ -340,10 +354,8 @@ class multimode_circle_grape_optimal_control:
                 psi0 = initial_states #problem in qoc code
     
         #Defining Concerned states (starting states)
-        print("starting states:")
-        print(psi0)
-        print("target states:")
-        print(U)
+        logger.debug('starting states: ' + str(psi0))
+        logger.debug('target states: ' + str(U))
 
         # #Defining states to include in the drawing of occupation
         if plot_only_g:
@@ -362,16 +374,25 @@ class multimode_circle_grape_optimal_control:
         states_forbidden_list = states_forbidden_list
         #print(states_forbidden_list)
 
+        if backend == 'native':
+            ss = native_grape(H0, Hops, Hnames, U, total_time, steps, psi0, convergence = convergence,
+                              reg_coeffs = reg_coeffs, maxA = ops_max_amp, initial_guess = initial_guess,
+                              file_name = file_name, data_path = data_path, save = save,
+                              propagator = propagator, qnum = self.qnum, n_sub = n_sub)
+            self.filename = ss[-1]
+            return ss
+
         ss = Grape(H0, Hops, Hnames, U, total_time, steps, psi0, convergence=convergence,
                             # U0 = U0, 
                              draw=[states_draw_list, states_draw_names], state_transfer=state_transfer, use_gpu=use_gpu,
-                             sparse_H=False, show_plots=True, Taylor_terms=taylor_terms, method='Adam', initial_guess=initial_guess,
+                             sparse_H=False, show_plots=plots_requested(show_plots), Taylor_terms=taylor_terms, method='Adam', initial_guess=initial_guess,
                              maxA=ops_max_amp, reg_coeffs=reg_coeffs, dressed_info=dressed_info, 
                              file_name=file_name, data_path=data_path, save = save)
         self.filename = ss[-1]
         return ss
 
     def plot_optimal_control(self,scales = [4367,4367,81.1684054679128, 81.1684054679128],pad_FFT = 3,filename = None,lim_scale=1.0):
+        import matplotlib.pyplot as plt
         
         if filename is None: 
             filename = self.filename
@@ -402,7 +423,7 @@ class multimode_circle_grape_optimal_control:
         for i in range(len(a['Hops'][()])):
             ax.plot(np.arange(0, steps) * dt/1e3, a['uks'][-1][i] * scales[i])
 
-        ax.plot(np.arange(0, steps) * dt/1e3, sqrt(a['uks'][-1][0]**2 + a['uks'][-1][1]**2) * scales[0],'k-')
+        ax.plot(np.arange(0, steps) * dt/1e3, np.sqrt(a['uks'][-1][0]**2 + a['uks'][-1][1]**2) * scales[0],'k-')
         plt.legend(labels=[a['Hnames'][ii] for ii in range(len(a['Hnames']))], prop={'size': 12})
         ax.plot(np.arange(0, steps) * dt/1e3, np.zeros(steps), '--k')  # plot a line y=0 for reference
         
@@ -412,7 +433,7 @@ class multimode_circle_grape_optimal_control:
         # plot Fourier transform of control pulses
         ax2 = fig.add_subplot(613)
         for i in range(len(a['Hops'][()])):
-            ax2.plot(fftfreq((2*pad_FFT+1)*steps, d=dt), np.abs(fft(pad(a['uks'][-1][i],(pad_FFT*steps,pad_FFT*steps),'constant'))),'.-', label=a['Hnames'][i])
+            ax2.plot(np.fft.fftfreq((2*pad_FFT+1)*steps, d=dt), np.abs(np.fft.fft(np.pad(a['uks'][-1][i],(pad_FFT*steps,pad_FFT*steps),'constant'))),'.-', label=a['Hnames'][i])
         
         plt.legend(labels=[a['Hnames'][ii] for ii in range(len(a['Hnames']))], prop={'size': 12})
         ax2.set_xlabel("Freq (GHz)")
@@ -430,7 +451,8 @@ class multimode_circle_grape_optimal_control:
         ax3.set_ylabel("Error")
         
         print("Minimum error", a['error'][-1])
-        print("Number of taylor terms",a['taylor_terms'][()])
+        if 'taylor_terms' in a:
+            print("Number of taylor terms",a['taylor_terms'][()])
         
         ax4 = fig.add_subplot(615,title = "Cavity level populations")
         for i in range(len(a['inter_vecs_mag_squared'][0][0])):
@@ -442,51 +464,123 @@ class multimode_circle_grape_optimal_control:
         plt.tight_layout()
         
         
+    @metrics.timed('mesolve', solver = 'qutip_mesolve_new')
     def qutip_mesolve_new(self,start_state,filename = None):
-        print('new qutip mesolve')
+        '''
+        Closed system evolution of start_state under total_H: integrates the ket psi(t) with sesolve
+        (out.states are kets, expectation values are the same as for rho = psi psi^dag)
+        '''
+        from qutip import Qobj, Options, sesolve
+        logger.debug('new qutip mesolve')
         if filename is None: 
             filename = self.filename
         ss = np.zeros(self.qnum*(self.mnum)**self.mmnum,dtype=complex)
         ss[:len(start_state)] = start_state  # g0
         psi0 = Qobj(ss)
-        rho0 = psi0*psi0.dag()
-        
-        
+
         H = self.total_H(filename)
         tlist = self.tlist
-#         if self.t1params is None:
-#             c_ops = []
-#         else:
-#             gamma = 1/self.t1params['T1_q']*1e-3
-#             gamma_phi = 1/self.t1params['T2_q']*1e-3- 1/2/self.t1params['T1_q']*1e-3
-#             n_thq =  self.t1params['nth_q']
-#             c_ops = gamma*(1+ n_thq)*lindblad_dissipator(self.aqmm) + gamma*(n_thq)*lindblad_dissipator(self.aqmm.dag())
-#             c_ops += gamma_phi*lindblad_dissipator(self.aqmm.dag()*self.aqmm) 
-#             kappa_ms = 1/array(self.t1params['T1_ms'])*1e-3
-#             n_thms =  array(self.t1params['nth_ms'])
-#             for ii,a in enumerate(self.ams):
-#                 c_ops += kappa_ms[ii]*(1+n_thms[ii])*lindblad_dissipator(a) +  kappa_ms[ii]*(n_thms[ii])*lindblad_dissipator(a.dag()) 
-
-           
-#         H0 = Qobj(self.H_rot())
-#         e_vecs = H0.eigenstates()[1]
-#         self.e_ops = [e_vec*e_vec.dag() for e_vec in e_vecs]
-#         self.n_mms = array([[expect(Qobj(np.kron(self.I_q,self.M_zs[ii])),e_vec) for e_vec in e_vecs] for ii in np.arange(self.mmnum)])
-#         self.n_qs = array([expect(Qobj(np.kron(self.Q_z,self.I_mm)), e_vec) for e_vec in e_vecs])
-#         self.nqinit = expect(Qobj(np.kron(self.Q_z,self.I_mm)), psi0)
-#         self.nmminit = array([expect(Qobj(np.kron(self.I_q,self.M_zs[ii])),psi0) for ii in np.arange(self.mmnum)])
-        
         nsteps = 1e+4
         opts = Options(store_states=True, store_final_state=True, nsteps = nsteps)
-        out = mesolve(H, rho0, tlist, options =opts)
+        out = sesolve(H, psi0, tlist, options =opts) # no collapse operators: the ket is enough
         return tlist, out    
         
+    @metrics.timed('mesolve', solver = 'pwc_mesolve')
+    def pwc_mesolve(self,start_state,filename = None, store_states = True, method = 'taylor'):
+        '''
+        Same evolution as qutip_mesolve_new, but with the pulses held piecewise constant over each
+        fine sample (mcd.pwc_propagator, exp(-iH dt) applied to the ket) instead of an ODE solver
+
+        start_state can also be a list of start states, which are propagated together
+        Returns tlist and the states, shape (len(tlist), d) (or (len(tlist), d, n_states) for a list)
+        or just the final states if store_states = False
+        '''
+        if filename is None: 
+            filename = self.filename
+        starts = start_state if np.ndim(start_state) == 2 else [start_state]
+        psi0s = np.zeros((self.qnum*(self.mnum)**self.mmnum, len(starts)), dtype=complex)
+        for ii, start in enumerate(starts):
+            psi0s[:len(start), ii] = start
+
+        H = self.total_H(filename)
+        tlist = self.tlist
+        self.pwc = pwc_propagator.from_qutip(H, tlist, method = method)
+        if not store_states:
+            finals = self.pwc.propagate(psi0s)
+            return tlist, (finals if np.ndim(start_state) == 2 else finals[:, 0])
+        finals, states = self.pwc.propagate(psi0s, store_states = True)
+        return tlist, (states if np.ndim(start_state) == 2 else states[:, :, 0])
+
+    def split_operator(self, dt, tol = 1e-6, n_sub = 1):
+        '''
+        Split operator propagator (mcd.split_operator) for H_rot + the transmon only controlHs with
+        amplitude samples of duration dt; exp(-i H_rot dt/2) is computed once
+        '''
+        return split_operator_propagator.from_full(self.H_rot(), self.controlHs(), dt, self.qnum, tol = tol, n_sub = n_sub)
+
+    @metrics.timed('mesolve', solver = 'split_mesolve')
+    def split_mesolve(self,start_state,filename = None, store_states = True, tol = 1e-6):
+        '''
+        Same as pwc_mesolve with the split operator propagator: the fine pulses are interpolated
+        (cubic spline) to the Trotter substeps, whose number is doubled until the final states change
+        by less than tol
+        '''
+        if filename is None: 
+            filename = self.filename
+        starts = start_state if np.ndim(start_state) == 2 else [start_state]
+        psi0s = np.zeros((self.qnum*(self.mnum)**self.mmnum, len(starts)), dtype=complex)
+        for ii, start in enumerate(starts):
+            psi0s[:len(start), ii] = start
+
+        amplitudes = np.array(self.return_pulses(filename))
+        tlist = self.tlist
+        self.split = self.split_operator(tlist[1] - tlist[0], tol = tol)
+        finals, error = self.split.propagate_adaptive(psi0s, amplitudes, samples = 'spline')
+        logger.info('split operator: %d substeps, error estimate %.2e' % (self.split.n_sub, error))
+        if not store_states:
+            return tlist, (finals if np.ndim(start_state) == 2 else finals[:, 0])
+        finals, states = self.split.propagate(psi0s, amplitudes, store_states = True, samples = 'spline')
+        return tlist, (states if np.ndim(start_state) == 2 else states[:, :, 0])
+
+    def eigenbasis(self):
+        '''
+        Eigenvalues/vectors of H_rot with the qubit (n_qs) and mode (n_mms) quantum numbers of each
+        eigenvector; computed once per (qnum, mnum, mmnum, f_state, hparams) and cached
+        '''
+        key = (self.qnum, self.mnum, self.mmnum, self.f_state,
+               repr(sorted((k, np.asarray(v).tolist()) for k, v in self.hparams.items())))
+        if key not in eigenbasis_cache:
+            evals, V = np.linalg.eigh(self.H_rot())
+            weights = np.abs(V.T)**2 # weights[k, i] = |<i|v_k>|^2
+            n_qs = weights @ np.kron(np.diag(self.Q_z), np.diag(self.I_mm))
+            n_mms = np.array([weights @ np.kron(np.diag(self.I_q), np.diag(self.M_zs[ii])) for ii in np.arange(self.mmnum)])
+            eigenbasis_cache[key] = {'evals': evals, 'V': V, 'n_qs': n_qs, 'n_mms': n_mms}
+        return eigenbasis_cache[key]
+
+    def eigenbasis_populations(self, states):
+        '''
+        Populations of the H_rot eigenstates, shape (n_times, d), from kets (n_times, d) as |V^dag psi|^2
+        or from density matrices (n_times, d, d) as diag(V^dag rho V)
+        '''
+        V = self.eigenbasis()['V']
+        states = np.asarray(states)
+        if states.ndim == 2:
+            return np.abs(states @ np.conjugate(V))**2
+        return np.real(np.einsum('ik,tij,jk->tk', np.conjugate(V), states, V))
+
+    @metrics.timed('mesolve', solver = 'qutip_mesolve')
     def qutip_mesolve(self,start_state,filename = None):
+        '''
+        Evolution of start_state under total_H (mesolve with the t1params dissipators, sesolve without);
+        self.pops / out.expect are the H_rot eigenbasis populations, out.final_state the final state
+        (out.states only in the closed system case)
+        '''
+        from qutip import Qobj, Options, lindblad_dissipator, sesolve, mesolve
         if filename is None: 
             filename = self.filename
         ss = np.zeros(self.qnum*(self.mnum)**self.mmnum,dtype=complex)
         ss[:len(start_state)] = start_state  # g0
-        print(ss[:len(start_state)])
+        logger.debug('start state: ' + str(ss[:len(start_state)]))
         psi0 = Qobj(ss)
         rho0 = psi0*psi0.dag()
         
@@ -499,64 +593,75 @@ class multimode_circle_grape_optimal_control:
             gamma = 1/self.t1params['T1_q']*1e-3
             gamma_phi = 1/self.t1params['T2_q']*1e-3- 1/2/self.t1params['T1_q']*1e-3
             n_thq =  self.t1params['nth_q']
-            c_ops = gamma*(1+ n_thq)*lindblad_dissipator(self.aqmm) + gamma*(n_thq)*lindblad_dissipator(self.aqmm.dag())
-            c_ops += gamma_phi*lindblad_dissipator(self.aqmm.dag()*self.aqmm) 
-            kappa_ms = 1/array(self.t1params['T1_ms'])*1e-3
-            n_thms =  array(self.t1params['nth_ms'])
+            L = gamma*(1+ n_thq)*lindblad_dissipator(self.aqmm) + gamma*(n_thq)*lindblad_dissipator(self.aqmm.dag())
+            L += gamma_phi*lindblad_dissipator(self.aqmm.dag()*self.aqmm) 
+            kappa_ms = 1/np.array(self.t1params['T1_ms'])*1e-3
+            n_thms =  np.array(self.t1params['nth_ms'])
             for ii,a in enumerate(self.ams):
-                c_ops += kappa_ms[ii]*(1+n_thms[ii])*lindblad_dissipator(a) +  kappa_ms[ii]*(n_thms[ii])*lindblad_dissipator(a.dag()) 
+                L += kappa_ms[ii]*(1+n_thms[ii])*lindblad_dissipator(a) +  kappa_ms[ii]*(n_thms[ii])*lindblad_dissipator(a.dag()) 
+            c_ops = [L] # one summed dissipator (superoperator); len() of a bare Qobj is its dimension
 
            
-        H0 = Qobj(self.H_rot())
-        e_vecs = H0.eigenstates()[1]
-        self.e_ops = [e_vec*e_vec.dag() for e_vec in e_vecs]
-        self.n_mms = array([[expect(Qobj(np.kron(self.I_q,self.M_zs[ii])),e_vec) for e_vec in e_vecs] for ii in np.arange(self.mmnum)])
-        self.n_qs = array([expect(Qobj(np.kron(self.Q_z,self.I_mm)), e_vec) for e_vec in e_vecs])
-        self.nqinit = expect(Qobj(np.kron(self.Q_z,self.I_mm)), psi0)
-        self.nmminit = array([expect(Qobj(np.kron(self.I_q,self.M_zs[ii])),psi0) for ii in np.arange(self.mmnum)])
+        # eigenbasis of H_rot (cached per hparams) and its labels
+        eig = self.eigenbasis()
+        self.n_mms = eig['n_mms']
+        self.n_qs = eig['n_qs']
+        self.nqinit = np.real(np.kron(np.diag(self.Q_z), np.diag(self.I_mm)) @ np.abs(ss)**2)
+        self.nmminit = np.array([np.real(np.kron(np.diag(self.I_q), np.diag(self.M_zs[ii])) @ np.abs(ss)**2) for ii in np.arange(self.mmnum)])
         
  
-        out = mesolve(H, rho0, tlist, c_ops=c_ops,e_ops = self.e_ops)
+        # eigenbasis populations (n_eigenstates, n_times), one batched product instead of d expectation values
+        if len(c_ops) == 0:
+            out = sesolve(H, psi0, tlist, options = Options(store_final_state = True)) # closed system
+            self.pops = self.eigenbasis_populations(np.array([state.full().ravel() for state in out.states])).T
+        else:
+            # diag(V^dag rho V) at every time from an e_ops callback: no T x d^2 density matrices stored
+            pops = []
+            def populations(t, rho):
+                pops.append(self.eigenbasis_populations(rho.full()[None])[0])
+            out = mesolve(H, rho0, tlist, c_ops = c_ops, e_ops = populations,
+                          options = Options(store_states = False, store_final_state = True))
+            self.pops = np.array(pops).T
+        out.expect = list(self.pops)
         return tlist, out
     
     def plot_mesolve(self,filename = None,show_low_only=True,MAX = 2,start_state = [1,0,0,0,0], title = ''):
+        import matplotlib.pyplot as plt
         if filename is None: 
             filename = self.filename
         
         print("running mesolve for rotating frame")
         
         tlist_rot, out = self.qutip_mesolve(start_state,filename)
-        pops= [out.expect[ii] for ii in arange(len(self.e_ops))]
+        pops= self.pops
         cutoff = self.qnum*(self.mnum)**self.mmnum
         
         fig, ax = plt.subplots(nrows=1, figsize=(14,6))
-        if int(around(self.nqinit,0)) == 0:
+        if int(np.around(self.nqinit,0)) == 0:
             title = "$\\psi_0$ = |g,"
         else:label = "|e,"
-        for mm in arange(self.mmnum):
+        for mm in np.arange(self.mmnum):
             title+=str(int(self.nmminit[mm]))
             if mm == self.mmnum-1:title+='>'
             else:title+=','
         ax.set_title(label=title)
         for num in range(len(pops)):
-            if around(self.n_qs[num],0) == 0:label = '|g,'
-            elif around(self.n_qs[num],0) == 1:label = '|e,'
+            if np.around(self.n_qs[num],0) == 0:label = '|g,'
+            elif np.around(self.n_qs[num],0) == 1:label = '|e,'
             else:label = '|g/e,'  
 
             
-            for mm in arange(self.mmnum):
-                label+=str(int(around(self.n_mms[mm][num],0)))
+            for mm in np.arange(self.mmnum):
+                label+=str(int(np.around(self.n_mms[mm][num],0)))
                 if mm == self.mmnum-1:label+='>'
                 else:label+=','
                     
             if show_low_only:
-                if self.n_qs[num] + sum(array(self.n_mms),axis=0)[num]>MAX:
+                if self.n_qs[num] + np.sum(np.array(self.n_mms),axis=0)[num]>MAX:
                     label = None
             
 
             ax.plot(tlist_rot,pops[num], label=label)
             ax.set_xlabel("Time (ns)")
             ax.set_ylabel("Populations")
-            ax.legend(prop={'size': 12}, loc=2)    
-    
-print ('done')
\ No newline at end of file
+            ax.legend(prop={'size': 12}, loc=2)
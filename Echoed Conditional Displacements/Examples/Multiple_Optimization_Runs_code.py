@@ -20,6 +20,7 @@ import numpy as np
 from qutip import *
 sys.path.append(r'/home/eag190/mcd/Echoed Conditional Displacements/Two Mode/class_description')
 from MECD_paramV1 import BatchOptimizer as BatchOptimizer
+from mcd.search import minimal_search, warm_start_circuit
 #from Simulation_Classes_Two_ModeV8 import *
 import matplotlib.pyplot as plt
 from IPython.display import clear_output
@@ -73,14 +74,16 @@ opt_params = {
     'name' : '',#'Fock1 %d' % Fock1, #name for printing and saving
     'filename' : None, #if no filename specified, results will be saved in this folder under 'name.h5'
     }
+target_fid = 1 - 1e-3
+min_layer, max_layer = 15, 19
+
 def main( n, start, df, reruns=1):
     '''
-    Vary depth
-    0n->n0 state transfer
+    Minimal depth for each 0n->n0 state transfer: bracket + bisection over N_blocks (mcd.search),
+    half of the multistarts of each depth warm started from the best circuit of the closest depth tried
     start time
     df is data frame to store
     '''
-    first_iter = True #this is for dataframe
     filenum = 800
     
     for n__ in range(5, n+1): #for |0n> -> |n0> transfer   # in general
@@ -91,14 +94,15 @@ def main( n, start, df, reruns=1):
         opt_params['initial_states'] = [initial]
         opt_params['target_states'] = [target]
 
-        best_fid = 0
-        layer =15
-
-        while best_fid<(1-1e-3) and layer <20 : 
+        def evaluate(layer, warm_circuit):
+            '''
+            reruns optimizations at N_blocks = layer; feasible if the best fidelity > target_fid
+            '''
+            nonlocal df, filenum
+            best_fid, best_circuit = 0, None
             for r in range(reruns):
                 clear_output(wait = True)            
-                print('prev layer' + str(layer))
-                #print('prev fid' + str(fid))
+                print('layer' + str(layer))
                 print(time.time()-start)
                 print('--------')
 
@@ -106,34 +110,20 @@ def main( n, start, df, reruns=1):
                 opt_params['N_blocks'] = layer
                 opt_params['name'] = opt_filename_prefix + str(filenum) + '.h5'
                 opt = BatchOptimizer(**opt_params)
+                if warm_circuit is not None:
+                    warm_start_circuit(opt, warm_circuit)
                 #print(opt.filename)
                 opt.optimize()
                 BO_fid = opt.best_fidelity()
                 BO_fid = BO_fid.real
-                #angles_filename = angles_filename_prefix + '_' + str(filenum) + '.txt'
-                #opt.save_angles(filename = angles_filename)
 
                 print('finished optimization')
                 print(time.time()-start)
                 print('-------')
 
-                #pulses
-    #             pulse_sim = ecd_pulse_two_mode(param_file = opt_params['name']) 
-    #             pulse_sim.get_pulses()
                 pulse_time =0#len(pulse_sim.cavity1_dac_pulse_GHz)
-
-    #             #qutip simulation
-    #             qutip_sim  = qutip_sim_two_mode(n_q = 2, n_c1 = N1,
-    #                                             n_c2 = N2, alpha1 = pulse_sim.alpha1,
-    #                                             alpha2 = pulse_sim.alpha2,
-    #                                             qubit_pulse = pulse_sim.qubit_dac_pulse_GHz)
-    #             qutip_sim.me_solve(initial = initial)
                 qutip_fid = 0#qutip_sim.get_fidelity(target)
 
-        #             print('finished qutip_sim')
-        #             print(time.time()-start)
-        #             print('-------')
-
                 new_row = [[n_, 
                             layer, 
                             pulse_time,
@@ -145,10 +135,15 @@ def main( n, start, df, reruns=1):
                 df.to_csv(fname, index=False)
                 filenum+=1
 
-                fid = BO_fid
-                if fid>best_fid:
-                    best_fid = fid
-            layer +=1
+                if BO_fid>best_fid:
+                    best_fid = BO_fid
+                    best_circuit = opt.best_circuit()
+                if best_fid >= target_fid:
+                    break
+            return best_fid >= target_fid, best_circuit
+
+        min_layer_n, history = minimal_search(evaluate, min_layer, 1, max_value = max_layer, min_value = min_layer)
+        print('n = %d: minimal depth %s (%d depths)' % (n_, str(min_layer_n), len(history)))
             
     return df
 
@@ -19,6 +19,7 @@
 # not needed - module load anaconda
 module load cuda/11.7.1 cudnn/7.0.3
 export XLA_FLAGS=--xla_gpu_cuda_data_dir=/opt/sw/packages/cuda/11.7.1
+export MCD_HEADLESS=1 # no figures, logging instead of prints (mcd.runtime)
 
 # Load Environment
 source activate /home/eag190/miniconda3/envs/sims_gpu1
@@ -1,9 +1,12 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
 from scipy.integrate import solve_ivp
 from scipy.signal import find_peaks
 from scipy.optimize import fmin
+from mcd.runtime import get_logger
+from mcd import metrics
+
+logger = get_logger('pulse')
 
 # note that some pulse functions also in fpga_lib are repeated here so this file can be somewhat standalone.
 
@@ -375,6 +378,7 @@ def get_ef_trajectories(
 # Buffer time can be a negative number if you wish to perform the pi pulse while the cavity is being displaced
 # conditional displacement is defined as:
 # D(beta/2)|eXg| + D(-beta/2) |gXe|
+@metrics.timed('pulse.conditional_displacement')
 def conditional_displacement(
     beta,
     alpha,
@@ -723,8 +727,7 @@ def conditional_displacement(
             qubit_dac_pulse = np.pad(qubit_dac_pulse, (0, 1), mode="constant")
             # accumulated_phase = np.pad(accumulated_phase, (0,1), mode='edge')
 
-    print('---------------------------')
-    print('Final Displacement: ' + str(current_beta))
+    logger.debug('Final Displacement: ' + str(current_beta))
     #cavity_dac_pulse, qubit_dac_pulse = construct_CD(alpha, tw, r, r2, buf=buffer_time)
     cavity_dac_pulse = np.append(cavity_dac_pulse, np.zeros(wait_time)) 
     qubit_dac_pulse = np.append(qubit_dac_pulse, np.zeros(wait_time)) 
@@ -876,6 +879,7 @@ def ECD_ef_post_process(
     return pulse_dict
 
 # The following function is used for 3 level ancilla 
+@metrics.timed('pulse.conditional_displacement_circuit')
 def conditional_displacement_circuit(
     betas,
     phis,
@@ -1017,7 +1021,7 @@ def conditional_displacement_circuit(
             pulse_dict['cumulative_qubit_phase'][1] += sum(pulse_dict['cd_qubit_phases'][1][-3:])
 
     pulse_dict['cavity_dac_pulse'] = np.array([np.concatenate(pulse_dict['cavity_dac_pulse'][m_]) for m_ in range(N_modes)])
-    print('len of qubit dac pulse is ' + str(len(pulse_dict['qubit_dac_pulse'])))
+    logger.debug('len of qubit dac pulse is ' + str(len(pulse_dict['qubit_dac_pulse'])))
     pulse_dict['qubit_dac_pulse'][0] = np.concatenate(pulse_dict['qubit_dac_pulse'][0])
     pulse_dict['qubit_dac_pulse'][1] = np.concatenate(pulse_dict['qubit_dac_pulse'][1])
     pulse_dict['qubit_dac_pulse'] = np.array(pulse_dict['qubit_dac_pulse'])
@@ -1028,7 +1032,7 @@ def conditional_displacement_circuit(
     
 
     if kerr_correction:
-        print("Kerr correction not implemented yet!")
+        logger.warning("Kerr correction not implemented yet!")
     pulse_dict['accumulated_phase'] = np.zeros_like(pulse_dict['cavity_dac_pulse'])
 
 
@@ -1036,6 +1040,7 @@ def conditional_displacement_circuit(
 
 
 
+@metrics.timed('pulse.analytic_CD_ef')
 def analytic_CD_ef(epsilon, Omega, chi):
     '''
     Solves EOM as in Alec's S4A
@@ -1099,17 +1104,14 @@ def analytic_CD_ef(epsilon, Omega, chi):
     theta_prime_g = theta_g[-1] + correction_g
 
     beta = 2 * (delta_ef[-1])# - delta_f[-1])
-    print('-----------')
-    print('Analytic Values')
-    print('delta_g : ' + str(delta_g[-1]))
-    print('delta_e : ' + str(delta_ef[-1]))
-    print('theta_prime_g : ' + str(theta_prime_g))
-    print('theta_prime_ef : ' + str(theta_prime_ef))
-    print('gamma : ' + str(gamma[-1]))
-    print('phi_g : ' + str(phi_g[-1] * 180 /np.pi) + str(' deg'))
-    print('phi_ef : ' + str(phi_ef[-1] * 180 /np.pi) + str(' deg'))
+    logger.debug('Analytic Values: delta_g : ' + str(delta_g[-1])
+                 + ', delta_e : ' + str(delta_ef[-1])
+                 + ', theta_prime_g : ' + str(theta_prime_g)
+                 + ', theta_prime_ef : ' + str(theta_prime_ef)
+                 + ', gamma : ' + str(gamma[-1])
+                 + ', phi_g : ' + str(phi_g[-1] * 180 /np.pi) + str(' deg')
+                 + ', phi_ef : ' + str(phi_ef[-1] * 180 /np.pi) + str(' deg'))
     #print('predicted_beta : ' + str(np.abs(-delta_g[-1] + 2*delta_ef[-1])))
-    print('-----------')
 
     # print('--------------------------------------')
     # print({
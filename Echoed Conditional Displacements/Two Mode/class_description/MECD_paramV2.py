@@ -18,16 +18,557 @@ import tensorflow as tf
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)  # supress warnings
 import h5py
 
-print(
-    "\nNeed tf version 2.3.0 or later. Using tensorflow version: "
-    + tf.__version__
-    + "\n"
-)
 import ECD_control.ECD_optimization.tf_quantum as tfq
 from ECD_control.ECD_optimization.visualization import VisualizationMixin
-import qutip as qt
 import datetime
 import time
+from mcd.operators import get_operators
+from mcd.runtime import get_logger
+from mcd import metrics
+
+logger = get_logger('ecd_optimizer')
+logger.debug("Need tf version 2.3.0 or later. Using tensorflow version: " + tf.__version__)
+
+
+#%%
+# compiled kernels, shared by every BatchOptimizer with the same shapes
+kernel_cache = {}
+
+def get_kernels(N_modes, N_ancilla_levels, N_cav, N_blocks, N_single_layer, N_multistart,
+                BCH_approx = True, dtype = 'complex64'):
+    '''
+    Cached ecd_kernels for the given shapes; a depth/task sweep creating many optimizers of the same
+    shape traces each kernel once instead of once per optimizer
+    '''
+    key = (N_modes, N_ancilla_levels, N_cav, N_blocks, N_single_layer, N_multistart, bool(BCH_approx),
+           tf.as_dtype(dtype).name)
+    if key not in kernel_cache:
+        kernel_cache[key] = ecd_kernels(*key)
+    return kernel_cache[key]
+
+
+def sync(tensors):
+    '''
+    Waits for the (GPU) tensors when metrics are on, so the step timers measure the computation
+    '''
+    if metrics.enabled():
+        tf.nest.map_structure(lambda t: t if t is None else t.numpy(), tensors)
+
+
+@tf.function
+def entry_stop_gradients(target, mask):
+    mask_h = tf.abs(mask - 1)
+    return tf.stop_gradient(mask_h * target) + mask * target
+
+@tf.function
+def loss_fun(fids):
+    # I think it's important that the log is taken before the avg
+    losses = tf.math.log(1 - fids)
+    return tf.reduce_mean(losses) # = sum / N_multistart
+
+
+class ecd_kernels:
+    '''
+    Instance independent ECD circuit construction for BatchOptimizer
+
+    Operators come from the shared operator registry and the initial/target states are arguments, so
+    nothing here depends on a particular optimizer. The tf_* attributes are tf.functions with fixed
+    input signatures (traced once per kernel set); n_traces counts the python traces of each of them.
+    '''
+
+    def __init__(self, N_modes, N_ancilla_levels, N_cav, N_blocks, N_single_layer, N_multistart,
+                 BCH_approx = True, dtype = 'complex64'):
+        self.N_modes = N_modes
+        self.N_ancilla_levels = N_ancilla_levels
+        self.N_cav = N_cav
+        self.N_layers = N_blocks
+        self.N_single_layer = N_single_layer
+        self.N_multistart = N_multistart
+        self.BCH_approx = BCH_approx
+        self.dtype = tf.as_dtype(dtype)
+        self.real_dtype = self.dtype.real_dtype
+        self.dim = N_ancilla_levels * N_cav ** N_modes
+        self.n_traces = {}
+
+        ops = get_operators(N_ancilla_levels, N_cav, N_modes, backend = 'tf', dtype = self.dtype.name)
+        self.identity_mm = ops.identity_mm
+        self.a_mm = ops.a_mm
+        self.adag_mm = ops.adag_mm
+        self._eig_q_mm = [tf.cast(e, self.dtype) for e in ops.eig_q_mm]
+        self._eig_p_mm = [tf.cast(e, self.dtype) for e in ops.eig_p_mm]
+        self._U_q_mm = ops.U_q_mm
+        self._U_p_mm = ops.U_p_mm
+        self._qp_comm_mm = ops.qp_comm_mm
+        # position, momentum and number of every mode (for the adjoint gradients)
+        self._q_mm = [U @ tf.linalg.diag(e) @ tf.linalg.adjoint(U) for U, e in zip(self._U_q_mm, self._eig_q_mm)]
+        self._p_mm = [U @ tf.linalg.diag(e) @ tf.linalg.adjoint(U) for U, e in zip(self._U_p_mm, self._eig_p_mm)]
+        self._n_mm = ops.num_mm
+
+        betas = tf.TensorSpec([N_modes, N_blocks, N_multistart], self.real_dtype)
+        final_disp = tf.TensorSpec([1, N_multistart], self.real_dtype)
+        angles = tf.TensorSpec([N_modes, N_blocks, N_single_layer, N_multistart], self.real_dtype)
+        circuit = [betas, betas, final_disp, final_disp, angles, angles]
+        states = [tf.TensorSpec([None, self.dim, None], self.dtype), tf.TensorSpec([None, None, self.dim], self.dtype)]
+
+        self.tf_displacement_operators = [
+            self.compile('displacement_operators_' + str(mode),
+                         lambda alphas, mode = mode: self.displacement_operators(alphas, mode),
+                         [tf.TensorSpec([None, None], self.dtype)])
+            for mode in range(N_modes)]
+        self.tf_multimode_block_operators = self.compile('multimode_block_operators', self.multimode_block_operators, circuit)
+        self.tf_state_transfer_fidelities = self.compile('state_transfer_fidelities', self.state_transfer_fidelities, circuit + states)
+        self.tf_state_transfer_fidelities_real_part = self.compile('state_transfer_fidelities_real_part',
+                                                                   self.state_transfer_fidelities_real_part, circuit + states)
+        self.tf_unitary = self.compile('unitary', self.unitary, circuit)
+        self.tf_adjoint_gradients = self.compile('adjoint_gradients', self.adjoint_gradients, circuit + states)
+        self.tf_adjoint_gradients_real_part = self.compile(
+            'adjoint_gradients_real_part', lambda *args: self.adjoint_gradients(*args, real_part=True), circuit + states)
+
+    def compile(self, name, function, input_signature):
+        '''
+        tf.function of function with the given input signature, counting its traces in n_traces[name]
+        '''
+        def traced(*args):
+            self.n_traces[name] = self.n_traces.get(name, 0) + 1
+            metrics.count('optimizer.traces', kernel = name)
+            return function(*args)
+        return tf.function(traced, input_signature = input_signature)
+
+    def displacement_operators(self, alphas, mode_idx):
+
+        # Reshape amplitudes for broadcast against diagonals
+        shape = tf.shape(alphas)
+        sqrt2 = tf.math.sqrt(tf.constant(2, dtype=self.dtype))
+        re_a = tf.reshape(
+            sqrt2 * tf.cast(tf.math.real(alphas), dtype=self.dtype),
+            [shape[0], shape[1], 1],
+        )
+        im_a = tf.reshape(
+            sqrt2 * tf.cast(tf.math.imag(alphas), dtype=self.dtype),
+            [shape[0], shape[1], 1],
+        )
+
+        # Exponentiate diagonal matrices
+        expm_q = tf.linalg.diag(tf.math.exp(1j * im_a * self._eig_q_mm[mode_idx]))
+        expm_p = tf.linalg.diag(tf.math.exp(-1j * re_a * self._eig_p_mm[mode_idx]))
+        expm_c = tf.linalg.diag(tf.math.exp(-0.5 * re_a * im_a * self._qp_comm_mm[mode_idx]))
+
+        # Apply Baker-Campbell-Hausdorff
+        if self.BCH_approx:
+            D_mode = (
+                self._U_q_mm[mode_idx]
+                @ expm_q
+                @ tf.linalg.adjoint(self._U_q_mm[mode_idx])
+                @ self._U_p_mm[mode_idx]
+                @ expm_p
+                @ tf.linalg.adjoint(self._U_p_mm[mode_idx])
+                @ expm_c
+            )
+        else: #exact form (at least exact up to under-the-hood-tensorflow standard)
+            alphas_star = tf.math.conj(alphas)
+            exponent = tf.einsum('ij,kl->ijkl', alphas, self.adag_mm[mode_idx]) - tf.einsum('ij,kl->ijkl', alphas_star, self.a_mm[mode_idx])
+            D_mode = tf.linalg.expm(exponent)
+
+        return D_mode
+
+    def layer_identity(self):
+        '''
+        identity of the modes with shape N_layers x N_multistart x shape(identity of multimode)
+        '''
+        ones = tf.stack([self.identity_mm] * self.N_multistart)
+        return tf.stack([ones] * self.N_layers)
+
+    def ancilla_rotation(self, phis, thetas, version = 'ge'):
+        '''
+        contructs rotation op for ancilla
+        note type can be 'ge' or 'ef'
+
+        Author: EG
+        '''
+
+        # First reshape for later multiplication with displacement ops
+        # new shape: ( N_layers, N_multistart, 1, 1)
+        Phis = phis - tf.constant(np.pi, dtype=self.real_dtype) / tf.constant(
+            2, dtype=self.real_dtype
+        )
+        Thetas = thetas / tf.constant(2, dtype=self.real_dtype)
+
+        Phis = tf.cast(
+            tf.reshape(Phis, [Phis.shape[0], Phis.shape[1], 1, 1]), dtype=self.dtype
+        )
+
+        Thetas = tf.cast(
+            tf.reshape(Thetas, [Thetas.shape[0], Thetas.shape[1], 1, 1]),
+            dtype=self.dtype,
+        )
+
+        exp = tf.math.exp(tf.constant(1j, dtype=self.dtype) * Phis)
+        exp_dag = tf.linalg.adjoint(exp)
+        cos = tf.math.cos(Thetas)
+        sin = tf.math.sin(Thetas)
+
+        # constructing the blocks of the matrix
+        ul = cos * self.identity_mm
+        ll = tf.constant(-1j, dtype=self.dtype)* exp * sin * self.identity_mm
+        ur = tf.constant(-1j, dtype=self.dtype) * exp_dag * sin * self.identity_mm
+        lr = cos * self.identity_mm
+
+        zeroes = tf.zeros_like(ul)
+        ones = self.layer_identity()
+
+        if self.N_ancilla_levels ==2:
+            return tf.concat([tf.concat([ul, ur], 3), tf.concat([ll, lr], 3)], 2) # normal rotation matrix for qubit
+
+        elif self.N_ancilla_levels == 3: # qutrit mode
+
+            if version == 'ge':
+                return tf.concat([tf.concat([ul, ur, zeroes], 3),
+                                  tf.concat([ll, lr, zeroes], 3),
+                                  tf.concat([zeroes, zeroes, ones], 3)], 2) # normal rotation matrix for qubit but with 3 levels
+
+            elif version == 'ef':
+                return tf.concat([tf.concat([ones, zeroes, zeroes], 3),
+                                  tf.concat([zeroes, ul, ur ], 3),
+                                  tf.concat([zeroes, ll, lr], 3),
+                                  ], 2)
+
+    def ECD_operators(self, betas_rho, betas_angle, version, mode):
+        '''
+        COnstructs ECD(beta) = D(beta/2)|e><g| + h.c. and equivalent form if
+        type == ef
+
+        Author: EG
+        '''
+        Bs = (
+            tf.cast(betas_rho, dtype=self.dtype)
+            / tf.constant(2, dtype=self.dtype)
+            * tf.math.exp(
+                tf.constant(1j, dtype=self.dtype)
+                * tf.cast(betas_angle, dtype=self.dtype)
+            )
+        )
+
+        ds_g = self.displacement_operators(Bs, mode)
+        ds_e = tf.linalg.adjoint(ds_g)
+
+        zeroes = tf.zeros_like(ds_g)
+        ones = self.layer_identity()
+
+        #contructing ECD block
+        if self.N_ancilla_levels == 2: #qubit
+            return tf.concat([tf.concat([zeroes, ds_e], 3),
+                               tf.concat([ds_g, zeroes], 3)], 2) # normal rotation matrix for qubit
+
+        elif self.N_ancilla_levels == 3: # qutrit mode
+
+            if version == 'ge':
+                return tf.concat([tf.concat([zeroes, ds_e, zeroes], 3),
+                                  tf.concat([ds_g, zeroes, zeroes], 3),
+                                  tf.concat([zeroes, zeroes, ones], 3)], 2) # normal rotation matrix for qubit
+
+            elif version == 'ef':
+                return tf.concat([tf.concat([ones, zeroes, zeroes], 3),
+                                  tf.concat([zeroes, zeroes, ds_e,], 3),
+                                  tf.concat([zeroes, ds_g, zeroes], 3),
+                                  ], 2) # normal rotation matrix for qubit
+
+    def singlemode_block_operators(self, betas_rho, betas_angle, phis, thetas, mode):
+        '''
+        Construct a layer for a single mode
+        '''
+        # original indixes :  N_layers xN_single_layerx N_multistart
+        # new indixes :  N_single_layer  x N_layers x N_multistart
+        phis = tf.einsum('ijk -> jik', phis)
+        thetas = tf.einsum('ijk -> jik', thetas)
+
+        return (
+            self.ECD_operators(betas_rho, betas_angle, version = 'ge', mode = mode)
+            @ self.ancilla_rotation(phis[0], thetas[0], version = 'ge')
+            @ self.ancilla_rotation(phis[1], thetas[1], version = 'ef')
+        )
+
+    def multimode_block_operators(self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas):
+        '''
+        Combines single mode block/layers
+
+        Author: EG
+        '''
+        #compute single mode blocks (all the layers for each mode)
+        modes_blocks = [self.singlemode_block_operators(betas_rho[mode], betas_angle[mode], phis[mode], thetas[mode], mode)
+                        for mode in range(self.N_modes)]
+
+        #combines single mode blocks
+        mm_blocks = modes_blocks[0]
+        for mode in range(1, self.N_modes):
+            mm_blocks = tf.einsum(
+                "lmij, lmjk -> lmik",
+                mm_blocks,
+                modes_blocks[mode]
+            )
+        return mm_blocks
+
+    def final_overlaps(self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas,
+                       initial_states, target_states_dag):
+        '''
+        <target|U|initial> for every multistart (m) and state (s)
+        '''
+        # EG: I'm just gonna ignore this final disp angle
+        bs = self.multimode_block_operators(
+            betas_rho, betas_angle,
+            final_disp_rho, final_disp_angle,
+            phis, thetas
+        )
+        psis = tf.stack([initial_states] * self.N_multistart)
+        for U in bs:
+            psis = tf.einsum(
+                "mij,msjk->msik", U, psis
+            )  # m: multistart, s:multiple states
+        return target_states_dag @ psis  # broadcasting
+
+    def state_transfer_fidelities(self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas,
+                                  initial_states, target_states_dag):
+        overlaps = self.final_overlaps(betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas,
+                                       initial_states, target_states_dag)
+        overlaps = tf.reduce_mean(overlaps, axis=1)
+        overlaps = tf.squeeze(overlaps)
+        # squeeze after reduce_mean which uses axis=1,
+        # which will not exist if squeezed before for single state transfer
+        fids = tf.cast(overlaps * tf.math.conj(overlaps), dtype=self.real_dtype)
+        return fids
+
+    # here, including the relative phase in the cost function by taking the real part of the overlap then squaring it.
+    # need to think about how this is related to the fidelity.
+    def state_transfer_fidelities_real_part(self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas,
+                                            initial_states, target_states_dag):
+        overlaps = self.final_overlaps(betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas,
+                                       initial_states, target_states_dag)
+        overlaps = tf.reduce_mean(tf.math.real(overlaps), axis=1)
+        overlaps = tf.squeeze(overlaps)
+        # don't need to take the conjugate anymore
+        fids = tf.cast(overlaps * overlaps, dtype=self.real_dtype)
+        return fids
+
+    def mult_bin(self, a):
+        while a.shape[0] > 1:
+            if a.shape[0] % 2 == 1:
+                a = tf.concat(
+                    [a[:-2], [tf.matmul(a[-2], a[-1])]], 0
+                )  # maybe there's a faster way to deal with immutable constants
+            a = tf.matmul(a[::2, ...], a[1::2, ...])
+        return a[0]
+
+    def unitary(self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas):
+        bs = self.multimode_block_operators(
+            betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas
+        )
+        # U_c = tf.scan(lambda a, b: tf.matmul(b, a), bs)[-1]
+        return self.mult_bin(
+            tf.reverse(bs, axis=[0])
+        )  # [U_1,U_2,..] -> [U_N,U_{N-1},..]-> U_N @ U_{N-1} @ .. @ U_1
+
+    # adjoint (closed form) gradients, see BatchOptimizer gradient_backend = 'adjoint'
+    # The circuit is applied gate by gate to the states (m: multistart, s: state, ancilla level, mode
+    # index), so only the states between gates are stored, and the displacements are applied through
+    # their diagonalized factors (matrix-vector products, no d x d layer operators).
+    def inner(self, u, v):
+        '''
+        sum over states of <u|v> for every multistart
+        '''
+        return tf.reduce_sum(tf.math.conj(u) * v, axis=[1, 2])
+
+    def displacement(self, betas_rho, betas_angle, mode):
+        '''
+        D(beta/2) of one layer of one mode (betas of shape (N_multistart,)) as functions of states
+        (M, S, d): apply(x), apply_dag(x) and grads(u, v) = (sum <u|dD/drho v>, sum <u|dD/dangle v>)
+        '''
+        alphas = (
+            tf.cast(betas_rho, dtype=self.dtype) / 2
+            * tf.math.exp(tf.constant(1j, dtype=self.dtype) * tf.cast(betas_angle, dtype=self.dtype))
+        )
+        sqrt2 = tf.math.sqrt(tf.constant(2, dtype=self.dtype))
+        re_a = sqrt2 * tf.cast(tf.math.real(alphas), dtype=self.dtype)[:, None, None]
+        im_a = sqrt2 * tf.cast(tf.math.imag(alphas), dtype=self.dtype)[:, None, None]
+        matvec = tf.linalg.matvec
+
+        if not self.BCH_approx:
+            a, adag, n = self.a_mm[mode], self.adag_mm[mode], self._n_mm[mode]
+            alphas = alphas[:, None, None]
+            D = tf.linalg.expm(alphas * adag - tf.math.conj(alphas) * a)[:, None]
+            phase = tf.math.exp(tf.constant(1j, dtype=self.dtype) * tf.cast(betas_angle, dtype=self.dtype))[:, None, None]
+
+            def apply(x):
+                return matvec(D, x)
+
+            def apply_dag(x):
+                return matvec(D, x, adjoint_a=True)
+
+            def grads(u, v):
+                # D = exp(rho G), G = (e^{i angle} a^dag - e^{-i angle} a)/2 anti-hermitian; dD/dangle = i[n, D]
+                Gu = 0.5 * (phase * matvec(adag, u) - tf.math.conj(phase) * matvec(a, u))
+                Dv = apply(v)
+                d_rho = -self.inner(Gu, Dv)
+                d_angle = 1j * (self.inner(matvec(n, u), Dv) - self.inner(apply_dag(u), matvec(n, v)))
+                return d_rho, d_angle
+            return apply, apply_dag, grads
+
+        # same factors as displacement_operators: D = Q P C
+        U_q, U_p = self._U_q_mm[mode], self._U_p_mm[mode]
+        qp = self._qp_comm_mm[mode]
+        E_q = tf.math.exp(1j * im_a * self._eig_q_mm[mode])
+        E_p = tf.math.exp(-1j * re_a * self._eig_p_mm[mode])
+        E_c = tf.math.exp(-0.5 * re_a * im_a * qp)
+
+        def Q(x, dag=False):
+            E = tf.math.conj(E_q) if dag else E_q
+            return matvec(U_q, E * matvec(U_q, x, adjoint_a=True))
+
+        def PC(x):
+            return matvec(U_p, E_p * matvec(U_p, E_c * x, adjoint_a=True))
+
+        def PC_dag(x):
+            return tf.math.conj(E_c) * matvec(U_p, tf.math.conj(E_p) * matvec(U_p, x, adjoint_a=True))
+
+        def apply(x):
+            return Q(PC(x))
+
+        def apply_dag(x):
+            return PC_dag(Q(x, dag=True))
+
+        def grads(u, v):
+            # dQ/dim_a = i q Q, dP/dre_a = -i p P, dC/d(re_a, im_a) = -0.5 (im_a, re_a) qp C
+            w = PC(v)
+            Dv = Q(w)
+            Q_dag_u = Q(u, dag=True)
+            D_dag_u = PC_dag(Q_dag_u)
+            d_re = (
+                -1j * self.inner(Q_dag_u, matvec(self._p_mm[mode], w))
+                + self.inner(D_dag_u, -0.5 * im_a * qp * v)
+            )
+            d_im = (
+                1j * self.inner(matvec(self._q_mm[mode], u), Dv)
+                + self.inner(D_dag_u, -0.5 * re_a * qp * v)
+            )
+            # re_a = rho cos(angle)/sqrt2, im_a = rho sin(angle)/sqrt2
+            angle = tf.cast(betas_angle, dtype=self.dtype)
+            d_rho = (tf.math.cos(angle) * d_re + tf.math.sin(angle) * d_im) / sqrt2
+            d_angle = -im_a[:, 0, 0] * d_re + re_a[:, 0, 0] * d_im
+            return d_rho, d_angle
+        return apply, apply_dag, grads
+
+    def rotation(self, phis, thetas):
+        '''
+        ancilla rotation restricted to its two levels (N_multistart, 2, 2) and its derivatives with
+        respect to phi and theta (same convention as ancilla_rotation)
+        '''
+        Phis = tf.cast(phis - np.pi / 2, dtype=self.dtype)[:, None, None]
+        Thetas = tf.cast(thetas / 2, dtype=self.dtype)[:, None, None]
+        exp = tf.math.exp(1j * Phis)
+        exp_dag = tf.math.conj(exp)
+        cos = tf.math.cos(Thetas)
+        sin = tf.math.sin(Thetas)
+        R = tf.concat([tf.concat([cos, -1j * exp_dag * sin], 2), tf.concat([-1j * exp * sin, cos], 2)], 1)
+        dR_dphi = tf.concat([tf.concat([tf.zeros_like(cos), -exp_dag * sin], 2), tf.concat([exp * sin, tf.zeros_like(cos)], 2)], 1)
+        dR_dtheta = 0.5 * tf.concat([tf.concat([-sin, -1j * exp_dag * cos], 2), tf.concat([-1j * exp * cos, -sin], 2)], 1)
+        return R, dR_dphi, dR_dtheta
+
+    def apply_rotation(self, R, levels, psi):
+        i, j = levels
+        new_i = R[:, 0, 0, None, None] * psi[:, :, i] + R[:, 0, 1, None, None] * psi[:, :, j]
+        new_j = R[:, 1, 0, None, None] * psi[:, :, i] + R[:, 1, 1, None, None] * psi[:, :, j]
+        blocks = [psi[:, :, k] for k in range(self.N_ancilla_levels)]
+        blocks[i], blocks[j] = new_i, new_j
+        return tf.stack(blocks, axis=2)
+
+    def apply_ECD(self, D, D_dag, psi):
+        # ECD = D^dag |g><e| + D |e><g| (+ |f><f|), hermitian
+        blocks = [D_dag(psi[:, :, 1]), D(psi[:, :, 0])] + [psi[:, :, k] for k in range(2, self.N_ancilla_levels)]
+        return tf.stack(blocks, axis=2)
+
+    def adjoint_gradients(self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas,
+                          initial_states, target_states_dag, real_part=False):
+        '''
+        Fidelities and exact gradients of loss_fun(fidelities) with respect to (betas_rho, betas_angle,
+        final_disp_rho, final_disp_angle, phis, thetas) from one forward and one backward sweep of the
+        states (the final displacement is not part of the circuit, its gradients are zero)
+        '''
+        M, n_q = self.N_multistart, self.N_ancilla_levels
+        d = self.dim // n_q
+        levels = {'ge': (0, 1), 'ef': (1, 2) if n_q == 3 else (0, 1)}
+
+        # gates in the order they act: per layer, modes N-1 .. 0, each R_ef, R_ge, ECD
+        gates = []
+        for layer in range(self.N_layers):
+            for mode in reversed(range(self.N_modes)):
+                for version, k in [('ef', 1), ('ge', 0)]:
+                    R, dR_dphi, dR_dtheta = self.rotation(phis[mode, layer, k], thetas[mode, layer, k])
+                    gates.append(('rotation', (mode, layer, k), levels[version], (R, dR_dphi, dR_dtheta)))
+                gates.append(('ECD', (mode, layer), None,
+                              self.displacement(betas_rho[mode, layer], betas_angle[mode, layer], mode)))
+
+        # forward sweep, keeping the states between gates
+        psi = tf.reshape(tf.stack([initial_states] * M), [M, -1, n_q, d])
+        states = [psi]
+        for kind, index, gate_levels, gate in gates:
+            if kind == 'rotation':
+                psi = self.apply_rotation(gate[0], gate_levels, psi)
+            else:
+                psi = self.apply_ECD(gate[0], gate[1], psi)
+            states.append(psi)
+
+        chi = tf.reshape(tf.stack([tf.linalg.adjoint(target_states_dag)] * M), [M, -1, n_q, d])
+        n_states = tf.cast(tf.shape(chi)[1], dtype=self.dtype)
+        overlaps = tf.reduce_sum(tf.math.conj(chi) * psi, axis=[1, 2, 3]) / n_states
+        if real_part:
+            fids = tf.math.real(overlaps) ** 2
+        else:
+            fids = tf.math.real(overlaps * tf.math.conj(overlaps))
+        # d loss / d <chi|dG|psi> (summed over states), loss = mean log(1 - F)
+        dloss_dfid = -1 / (M * (1 - fids))
+
+        def to_loss(g):
+            g = g / n_states
+            if real_part:
+                dfid = 2 * tf.math.real(overlaps) * tf.math.real(g)
+            else:
+                dfid = 2 * tf.math.real(tf.math.conj(overlaps) * g)
+            return dloss_dfid * dfid
+
+        # backward sweep
+        grads = {}
+        for k in reversed(range(len(gates))):
+            kind, index, gate_levels, gate = gates[k]
+            psi = states[k]
+            if kind == 'rotation':
+                i, j = gate_levels
+                R, dR_dphi, dR_dtheta = gate
+                pair_chi, pair_psi = tf.stack([chi[:, :, i], chi[:, :, j]], 2), tf.stack([psi[:, :, i], psi[:, :, j]], 2)
+                O = tf.einsum('msax,msbx->mab', tf.math.conj(pair_chi), pair_psi)
+                grads[('phis',) + index] = to_loss(tf.reduce_sum(dR_dphi * O, axis=[1, 2]))
+                grads[('thetas',) + index] = to_loss(tf.reduce_sum(dR_dtheta * O, axis=[1, 2]))
+                chi = self.apply_rotation(tf.linalg.adjoint(R), gate_levels, chi)
+            else:
+                D, D_dag, D_grads = gate
+                # <chi|dECD|psi> = <chi_e|dD psi_g> + conj(<psi_e|dD chi_g>)
+                rho_1, angle_1 = D_grads(chi[:, :, 1], psi[:, :, 0])
+                rho_2, angle_2 = D_grads(psi[:, :, 1], chi[:, :, 0])
+                grads[('betas_rho',) + index] = to_loss(rho_1 + tf.math.conj(rho_2))
+                grads[('betas_angle',) + index] = to_loss(angle_1 + tf.math.conj(angle_2))
+                chi = self.apply_ECD(D, D_dag, chi)
+
+        zeros = tf.zeros([M], dtype=self.real_dtype)
+        betas_grads = [
+            tf.stack([tf.stack([grads[(name, mode, layer)] for layer in range(self.N_layers)])
+                      for mode in range(self.N_modes)])
+            for name in ['betas_rho', 'betas_angle']
+        ]
+        angle_grads = [
+            tf.stack([tf.stack([tf.stack([grads.get((name, mode, layer, k), zeros) for k in range(self.N_single_layer)])
+                                for layer in range(self.N_layers)])
+                      for mode in range(self.N_modes)])
+            for name in ['phis', 'thetas']
+        ]
+        final_disp_grads = [tf.zeros_like(final_disp_rho), tf.zeros_like(final_disp_angle)]
+        return tf.squeeze(fids), betas_grads + final_disp_grads + angle_grads
 
 
 class BatchOptimizer(VisualizationMixin):
@@ -66,12 +607,26 @@ class BatchOptimizer(VisualizationMixin):
         filename=None,
         comment="",
         real_part_only=False,  # include the phase in the optimization cost function. Important for unitaries.
+        precision="single",
+        polish_epochs=10,
+        polish_learning_rate=None,
+        gradient_backend="autodiff",
         timestamps=[],
         **kwargs
     ):
         '''
         N_single layer : if =1 , only adds ge rotation in a single layer; if 2 , adds in both ge and ef ancilla rotations
+        precision : 'single' (complex64), 'double' (complex128) or 'mixed' (train in complex64, then
+                    verify and polish for polish_epochs epochs in complex128, with polish_learning_rate
+                    = learning_rate/10 by default)
+        gradient_backend : 'autodiff' (GradientTape through the layer matrices) or 'adjoint' (closed form
+                    gradients from one forward and one backward sweep of the states, memory
+                    O(layers x states) instead of O(layers x operators))
         '''
+        if precision not in ["single", "double", "mixed"]:
+            raise ValueError("precision must be one of {'single', 'double', 'mixed'}")
+        if gradient_backend not in ["autodiff", "adjoint"]:
+            raise ValueError("gradient_backend must be one of {'autodiff', 'adjoint'}")
         self.parameters = {
             "optimization_type": optimization_type,
             "N_modes": N_modes,
@@ -92,10 +647,19 @@ class BatchOptimizer(VisualizationMixin):
             "theta_scale": theta_scale,
             "include_final_displacement": include_final_displacement,
             "real_part_only": real_part_only,
+            "precision": precision,
+            "gradient_backend": gradient_backend,
+            "polish_epochs": polish_epochs,
+            "polish_learning_rate": (
+                polish_learning_rate if polish_learning_rate is not None else learning_rate / 10
+            ),
             "name": name,
             "comment": comment,
         }
         self.parameters.update(kwargs)
+        # training dtype (mixed switches to complex128 for the polish, see optimize)
+        self.dtype = tf.complex128 if precision == "double" else tf.complex64
+        self.real_dtype = self.dtype.real_dtype
         if (
             self.parameters["optimization_type"] == "state transfer"
             or self.parameters["optimization_type"] == "analysis"
@@ -108,16 +672,18 @@ class BatchOptimizer(VisualizationMixin):
             # set fidelity function
 
             self.initial_states = tf.stack(
-                [tfq.qt2tf(state) for state in initial_states]
+                [tf.cast(tfq.qt2tf(state), self.dtype) for state in initial_states]
             )
 
             self.target_unitary = tfq.qt2tf(target_unitary)
+            if self.target_unitary is not None:
+                self.target_unitary = tf.cast(self.target_unitary, self.dtype)
 
             # if self.target_unitary is not None: TODO
             #     raise Exception("Need to fix target_unitary multi-state transfer generation!")
 
             self.target_states = (  # store dag
-                tf.stack([tfq.qt2tf(state) for state in target_states])
+                tf.stack([tf.cast(tfq.qt2tf(state), self.dtype) for state in target_states])
                 if self.target_unitary is None
                 else self.target_unitary @ self.initial_states
             )
@@ -216,61 +782,21 @@ class BatchOptimizer(VisualizationMixin):
        
     
 
+    @metrics.timed('optimizer.construct_operators')
     def _construct_needed_matrices(self):
         '''
         EG: assuming all modes have same dimensions
         '''
         N_cav = self.parameters["N_cav"]
-        q = tfq.position(N_cav)
-        p = tfq.momentum(N_cav)
-        a = tfq.destroy(N_cav)
-        adag = tfq.create(N_cav)
-        self.identity = tfq.identity(N_cav)
-        self.identity_mm = self.multimode_baby_matrices(self.identity, 0)
-
-        self.identity_ancilla_mm_system =tfq.identity(self.parameters['N_ancilla_levels']*
-                                                     (N_cav ** self.parameters['N_modes'] ))
-        # Pre-diagonalize and listify
-        self.a_mm = []
-        self.adag_mm = []
-        self._eig_q_mm = []
-        self._eig_p_mm = []
-        self._U_q_mm = []
-        self._U_p_mm = []
-        self._qp_comm_mm = []
-
-        for mode_idx in range(self.parameters['N_modes']):
-            q_m = self.multimode_baby_matrices( q, mode_idx)
-            p_m = self.multimode_baby_matrices( p, mode_idx)
-            a_m = self.multimode_baby_matrices( a, mode_idx)
-            adag_m = self.multimode_baby_matrices( adag, mode_idx)
-            
-            (eig_q, U_q) = tf.linalg.eigh(q_m)
-            (eig_p, U_p) = tf.linalg.eigh(p_m)
-            qp_comm = tf.linalg.diag_part(q_m @ p_m - p_m @ q_m)
-
-            self._eig_q_mm.append(eig_q)
-            self._eig_p_mm.append(eig_p)
-            self._U_q_mm.append(U_q)
-            self._U_p_mm.append(U_p)
-            self._qp_comm_mm.append(qp_comm)
-            self.a_mm.append(a_m)
-            self.adag_mm.append(adag_m)
-
-        #listify (for all modes)
-        # self.a_mm = [self.multimode_baby_matrices( a, mode_idx) 
-        #                 for mode_idx in range(self.parameters['N_modes'])]
-        # self.adag_mm = [self.multimode_baby_matrices( adag, mode_idx) 
-        #                 for mode_idx in range(self.parameters['N_modes'])]
-        # self._U_q_mm = [self.multimode_baby_matrices( self._U_q, mode_idx) 
-        #                 for mode_idx in range(self.parameters['N_modes'])]
-        # self._U_p_mm = [self.multimode_baby_matrices( self._U_p, mode_idx) 
-        #                 for mode_idx in range(self.parameters['N_modes'])]
-
-        # self._qp_comm_mm = [self.multimode_baby_matrices(self._qp_comm, mode_idx) 
-        #                 for mode_idx in range(self.parameters['N_modes'])]
+        # the circuit operators live in self.kernels (ecd_kernels, in the optimizer precision); the single
+        # mode identity is kept for multimode_baby_matrices
+        ops = get_operators(self.parameters['N_ancilla_levels'], N_cav, self.parameters['N_modes'], backend = 'tf',
+                            dtype = self.dtype.name)
+        self.identity = ops.identity_c
+        self._set_kernels()
 
         if self.parameters["optimization_type"] == "unitary":
+            import qutip as qt
             P_cav = self.parameters["P_cav"]
             partial_I = np.array(qt.identity(N_cav))
             for j in range(P_cav, N_cav):
@@ -284,7 +810,7 @@ class BatchOptimizer(VisualizationMixin):
         if beta_mask is None:
             beta_mask = np.ones(
                 shape=(self.parameters['N_modes'], self.parameters["N_blocks"], self.parameters["N_multistart"]),
-                dtype=np.float32,
+                dtype=self.real_dtype.as_numpy_dtype,
             )
             if self.parameters["no_CD_end"]:
                 beta_mask[-1, :] = 0  # don't optimize final CD
@@ -295,7 +821,7 @@ class BatchOptimizer(VisualizationMixin):
             )
         if final_disp_mask is None:
             final_disp_mask = np.ones(
-                shape=(1, self.parameters["N_multistart"]), dtype=np.float32,
+                shape=(1, self.parameters["N_multistart"]), dtype=self.real_dtype.as_numpy_dtype,
             )
         else:
             raise Exception(
@@ -307,7 +833,7 @@ class BatchOptimizer(VisualizationMixin):
                        self.parameters["N_blocks"], 
                        self.parameters["N_single_layer"],
                        self.parameters["N_multistart"]),
-                dtype=np.float32,
+                dtype=self.real_dtype.as_numpy_dtype,
             )
         else:
             raise Exception(
@@ -319,7 +845,7 @@ class BatchOptimizer(VisualizationMixin):
                        self.parameters["N_blocks"], 
                        self.parameters["N_single_layer"],
                        self.parameters["N_multistart"]),
-                dtype=np.float32,
+                dtype=self.real_dtype.as_numpy_dtype,
             )
         else:
             raise Exception(
@@ -330,229 +856,83 @@ class BatchOptimizer(VisualizationMixin):
         self.phi_mask = phi_mask
         self.theta_mask = theta_mask
 
-    @tf.function
-    def batch_construct_displacement_operators(self, alphas, mode_idx):
-
-        # Reshape amplitudes for broadcast against diagonals
-        sqrt2 = tf.math.sqrt(tf.constant(2, dtype=tf.complex64))
-        re_a = tf.reshape(
-            sqrt2 * tf.cast(tf.math.real(alphas), dtype=tf.complex64),
-            [alphas.shape[0], alphas.shape[1], 1],
-        )
-        im_a = tf.reshape(
-            sqrt2 * tf.cast(tf.math.imag(alphas), dtype=tf.complex64),
-            [alphas.shape[0], alphas.shape[1], 1],
+    def _set_kernels(self):
+        '''
+        compiled circuit kernels for the current shapes, shared with every other optimizer of the same
+        shapes (see get_kernels)
+        '''
+        self.kernels = get_kernels(
+            self.parameters["N_modes"],
+            self.parameters["N_ancilla_levels"],
+            self.parameters["N_cav"],
+            self.parameters["N_blocks"],
+            self.parameters["N_single_layer"],
+            self.parameters["N_multistart"],
+            BCH_approx = self.parameters["BCH_approx"],
+            dtype = self.dtype,
         )
 
-        # Exponentiate diagonal matrices
-        expm_q = tf.linalg.diag(tf.math.exp(1j * im_a * self._eig_q_mm[mode_idx]))
-        expm_p = tf.linalg.diag(tf.math.exp(-1j * re_a * self._eig_p_mm[mode_idx]))
-        expm_c = tf.linalg.diag(tf.math.exp(-0.5 * re_a * im_a * self._qp_comm_mm[mode_idx]))
-
-        # Apply Baker-Campbell-Hausdorff
-        if self.parameters['BCH_approx']:
-            D_mode =  tf.cast(
-                self._U_q_mm[mode_idx]
-                @ expm_q
-                @ tf.linalg.adjoint(self._U_q_mm[mode_idx])
-                @ self._U_p_mm[mode_idx]
-                @ expm_p
-                @ tf.linalg.adjoint(self._U_p_mm[mode_idx])
-                @ expm_c,
-                dtype=tf.complex64,
-            )
-        else: #exact form (at least exact up to under-the-hood-tensorflow standard)
-            alphas_star = tf.math.conj(alphas)
-            exponent = tf.einsum('ij,kl->ijkl', alphas, self.adag_mm[mode_idx]) - tf.einsum('ij,kl->ijkl', alphas_star, self.a_mm[mode_idx])
-            D_mode = tf.linalg.expm(exponent)
-        # print('ho')
-        # print(self.ad.shape)
-
-        return D_mode
-
+    def set_dtype(self, dtype):
+        '''
+        Switches all circuit math to the complex dtype (parameters to the matching real dtype), keeping
+        the current parameter values; used by the mixed precision polish
+        '''
+        self.dtype = tf.as_dtype(dtype)
+        self.real_dtype = self.dtype.real_dtype
+        self.initial_states = tf.cast(self.initial_states, self.dtype)
+        self.target_states = tf.cast(self.target_states, self.dtype)
+        self.target_states_dag = tf.linalg.adjoint(self.target_states)
+        if self.target_unitary is not None:
+            self.target_unitary = tf.cast(self.target_unitary, self.dtype)
+        for name in ["beta_mask", "final_disp_mask", "phi_mask", "theta_mask"]:
+            setattr(self, name, getattr(self, name).astype(self.real_dtype.as_numpy_dtype))
+        for name in ["betas_rho", "betas_angle", "final_disp_rho", "final_disp_angle", "phis", "thetas"]:
+            value = getattr(self, name)
+            if isinstance(value, tf.Variable):
+                setattr(self, name, tf.Variable(value.numpy(), dtype=self.real_dtype, trainable=True, name=name))
+            else: # final displacement not optimized
+                setattr(self, name, tf.constant(value.numpy(), dtype=self.real_dtype))
+        self._set_kernels()
+
+    def batch_construct_displacement_operators(self, alphas, mode_idx = 0):
+        return self.kernels.tf_displacement_operators[mode_idx](tf.cast(alphas, self.kernels.dtype))
 
-    @tf.function
     def batch_construct_singlemode_ancilla_rotation(
         self, phis, thetas, version = 'ge'
     ):
         '''
         contructs rotation op for ancilla 
         note type can be 'ge' or 'ef'
-        
-        Author: EG
         '''
+        return self.kernels.ancilla_rotation(phis, thetas, version)
 
-        # First reshape for later multiplication with displacement ops
-        # new shape: ( N_layers, N_multistart, 1, 1)
-        
-
-        Phis = phis - tf.constant(np.pi, dtype=tf.float32) / tf.constant(
-            2, dtype=tf.float32
-        )
-        Thetas = thetas / tf.constant(2, dtype=tf.float32)
-        
-        Phis = tf.cast(
-            tf.reshape(Phis, [Phis.shape[0], Phis.shape[1], 1, 1]), dtype=tf.complex64
-        )
-        
-        Thetas = tf.cast(
-            tf.reshape(Thetas, [Thetas.shape[0], Thetas.shape[1], 1, 1]),
-            dtype=tf.complex64,
-        )
-
-        exp = tf.math.exp(tf.constant(1j, dtype=tf.complex64) * Phis)
-        exp_dag = tf.linalg.adjoint(exp)
-        cos = tf.math.cos(Thetas)
-        sin = tf.math.sin(Thetas)
-
-        # constructing the blocks of the matrix
-        ul = cos * self.identity_mm
-        ll = tf.constant(-1j, dtype=tf.complex64)* exp * sin * self.identity_mm
-        ur = tf.constant(-1j, dtype=tf.complex64) * exp_dag * sin * self.identity_mm
-        lr = cos * self.identity_mm
-
-        zeroes = tf.cast(tf.zeros(ul.shape), dtype = tf.complex64)
-
-        #creating identity 
-        # orig shape : shape(identity of mulltimode)
-        # new shape: N_layers x N_multistarts x shape(identity of multimode)
-        ones =  tf.stack([self.identity_mm] * self.parameters["N_multistart"])
-        ones =  tf.stack([ones] * self.parameters["N_layers"])
-        # print('shape of zeroes is ')
-        # print(tf.shape(zeroes))
-
-        if self.parameters["N_ancilla_levels"] ==2: 
-            return tf.concat([tf.concat([ul, ur], 3), tf.concat([ll, lr], 3)], 2) # normal rotation matrix for qubit 
-        
-        elif self.parameters["N_ancilla_levels"] == 3: # qutrit mode
-            
-            if version == 'ge':
-                return tf.concat([tf.concat([ul, ur, zeroes], 3), 
-                                  tf.concat([ll, lr, zeroes], 3),
-                                  tf.concat([zeroes, zeroes, ones], 3)], 2) # normal rotation matrix for qubit but with 3 levels
-            
-            elif version == 'ef':
-                return tf.concat([tf.concat([ones, zeroes, zeroes], 3),
-                                  tf.concat([zeroes, ul, ur ], 3), 
-                                  tf.concat([zeroes, ll, lr], 3),
-                                  ], 2) 
-
-    @tf.function    
     def batch_contruct_singlemode_ECD_operators(
             self, betas_rho, betas_angle, version, mode):
         '''
         COnstructs ECD(beta) = D(beta/2)|e><g| + h.c. and equivalent form if 
         type == ef
-
-        Author: EG
         '''
-        Bs = (
-            tf.cast(betas_rho, dtype=tf.complex64)
-            / tf.constant(2, dtype=tf.complex64)
-            * tf.math.exp(
-                tf.constant(1j, dtype=tf.complex64)
-                * tf.cast(betas_angle, dtype=tf.complex64)
-            )
-        )
-
-        ds_g = self.batch_construct_displacement_operators(Bs, mode)
-        ds_e = tf.linalg.adjoint(ds_g)
-        
-        zeroes = tf.cast(tf.zeros( ds_g.shape), dtype = tf.complex64)
-        #creating identity 
-        # orig shape : shape(identity of mulltimode)
-        # new shape: N_layers x N_multistarts x shape(identity of multimode)
-        ones =  tf.stack([self.identity_mm] * self.parameters["N_multistart"])
-        ones =  tf.stack([ones] * self.parameters["N_layers"])
-        # print('shape of zeroes is ')
-        # print(tf.shape(zeroes))
-
-        #contructing ECD block
-
-        if self.parameters["N_ancilla_levels"] == 2: #qubit
-            return tf.concat([tf.concat([zeroes, ds_e], 3),
-                               tf.concat([ds_g, zeroes], 3)], 2) # normal rotation matrix for qubit 
-        
-        elif self.parameters["N_ancilla_levels"] == 3: # qutrit mode
-            
-            if version == 'ge':
-                return tf.concat([tf.concat([zeroes, ds_e, zeroes], 3), 
-                                  tf.concat([ds_g, zeroes, zeroes], 3),
-                                  tf.concat([zeroes, zeroes, ones], 3)], 2) # normal rotation matrix for qubit 
-            
-            elif version == 'ef':
-                return tf.concat([tf.concat([ones, zeroes, zeroes], 3),
-                                  tf.concat([zeroes, zeroes, ds_e,], 3), 
-                                  tf.concat([zeroes, ds_g, zeroes], 3),
-                                  ], 2) # normal rotation matrix for qubit 
-        
-
+        return self.kernels.ECD_operators(betas_rho, betas_angle, version, mode)
 
-
-    @tf.function
     def batch_construct_singlemode_block_operators(
         self, betas_rho, betas_angle,  phis, thetas, mode
     ):
         '''
         Construct a layer for a single mode
         '''
+        return self.kernels.singlemode_block_operators(betas_rho, betas_angle, phis, thetas, mode)
 
-        # original indixes :  N_layers xN_single_layerx N_multistart 
-        # new indixes :  N_single_layer  x N_layers x N_multistart
-        # swap indices 
-        # betas_rho = tf.einsum('ijk -> jik', betas_rho)  # uncomment when adding in ef ECD
-        # betas_angle = tf.einsum('ijk -> jik', betas_angle)
-        phis = tf.einsum('ijk -> jik', phis)
-        thetas = tf.einsum('ijk -> jik', thetas)
-
-        # print('shape of ecd ops')
-        # print(tf.shape(self.batch_contruct_singlemode_ECD_operators(betas_rho, betas_angle, version = 'ge', mode = mode)))
-
-        # print('shape of rotation ops')
-        # print(tf.shape(self.batch_construct_singlemode_ancilla_rotation(phis[0], thetas[0], version = 'ge')))
-        
-        mat = tf.cast(
-            # self.batch_contruct_singlemode_ECD_operators(betas_rho[1], betas_angle[1], version = 'ef', mode = mode)
-            # @ self.batch_construct_singlemode_ancilla_rotation(phis[3], thetas[3], version = 'ef')
-            # @ self.batch_construct_singlemode_ancilla_rotation(phis[2], thetas[2], version = 'ge')
-            self.batch_contruct_singlemode_ECD_operators(betas_rho, betas_angle, version = 'ge', mode = mode)
-            @ self.batch_construct_singlemode_ancilla_rotation(phis[0], thetas[0], version = 'ge')
-            @ self.batch_construct_singlemode_ancilla_rotation(phis[1], thetas[1], version = 'ef')
-            , dtype = tf.complex64)
-            
-        return mat
-    
-    @tf.function
     def batch_construct_multimode_block_operators(
         self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas
     ):
         '''
         Combines single mode block/layers
-
-        Author: EG
         '''
-        #compute single mode blocks
-        modes_blocks = []
-        for mode in range(0,self.parameters["N_modes"]):
-            mode_blocks = self.batch_construct_singlemode_block_operators(betas_rho[mode], betas_angle[mode], phis[mode], thetas[mode], mode) 
-            #above var contains all the layers for a specific mode
-            modes_blocks.append(mode_blocks) 
-
-        #combines single mode blocks
-        mm_blocks = modes_blocks[0] 
-        # print('ho')
-        # print(mode_blocks.shape)
-        for mode in range(1, self.parameters["N_modes"]): 
-            mm_blocks = tf.einsum(
-                "lmij, lmjk -> lmik", 
-                mm_blocks, 
-                modes_blocks[mode]
-            )
-        return mm_blocks
-
+        return self.kernels.tf_multimode_block_operators(
+            betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas
+        )
 
     
-
     # batch computation of <D>
     # todo: handle non-pure states (rho)
     def characteristic_function(self, psi, betas):
@@ -579,65 +959,29 @@ class BatchOptimizer(VisualizationMixin):
         C = tf.linalg.trace(Ds @ rhos)
         return np.squeeze(C.numpy()).reshape(betas.shape)
 
-    @tf.function
     def batch_state_transfer_fidelities(
         self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas
     ):
-        # EG: I'm just gonna ignore this final disp angle
-        bs = self.batch_construct_multimode_block_operators(
-            betas_rho, betas_angle,
-            final_disp_rho, final_disp_angle, 
-            phis, thetas
+        return self.kernels.tf_state_transfer_fidelities(
+            betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas,
+            self.initial_states, self.target_states_dag,
         )
-        psis = tf.stack([self.initial_states] * self.parameters["N_multistart"])
-        for U in bs:
-            psis = tf.einsum(
-                "mij,msjk->msik", U, psis
-            )  # m: multistart, s:multiple states
-        overlaps = self.target_states_dag @ psis  # broadcasting
-        overlaps = tf.reduce_mean(overlaps, axis=1)
-        overlaps = tf.squeeze(overlaps)
-        # squeeze after reduce_mean which uses axis=1,
-        # which will not exist if squeezed before for single state transfer
-        fids = tf.cast(overlaps * tf.math.conj(overlaps), dtype=tf.float32)
-        return fids
 
     # here, including the relative phase in the cost function by taking the real part of the overlap then squaring it.
     # need to think about how this is related to the fidelity.
-    # @tf.function
-    # def batch_state_transfer_fidelities_real_part(
-    #     self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas
-    # ):
-    #     bs = self.batch_construct_block_operators(
-    #         betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas
-    #     )
-    #     psis = tf.stack([self.initial_states] * self.parameters["N_multistart"])
-    #     for U in bs:
-    #         psis = tf.einsum(
-    #             "mij,msjk->msik", U, psis
-    #         )  # m: multistart, s:multiple states
-    #     overlaps = self.target_states_dag @ psis  # broadcasting
-    #     overlaps = tf.reduce_mean(tf.math.real(overlaps), axis=1)
-    #     overlaps = tf.squeeze(overlaps)
-    #     # squeeze after reduce_mean which uses axis=1,
-    #     # which will not exist if squeezed before for single state transfer
-    #     # don't need to take the conjugate anymore
-    #     fids = tf.cast(overlaps * overlaps, dtype=tf.float32)
-    #     return fids
-
-    @tf.function
+    def batch_state_transfer_fidelities_real_part(
+        self, betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas
+    ):
+        return self.kernels.tf_state_transfer_fidelities_real_part(
+            betas_rho, betas_angle, final_disp_rho, final_disp_angle, phis, thetas,
+            self.initial_states, self.target_states_dag,
+        )
+
     def mult_bin_tf(self, a):
-        while a.shape[0] > 1:
-            if a.shape[0] % 2 == 1:
-                a = tf.concat(
-                    [a[:-2], [tf.matmul(a[-2], a[-1])]], 0
-                )  # maybe there's a faster way to deal with immutable constants
-            a = tf.matmul(a[::2, ...], a[1::2, ...])
-        return a[0]
+        return self.kernels.mult_bin(a)
 
-    @tf.function
     def U_tot(self,):
-        bs = self.batch_construct_block_operators(
+        return self.kernels.tf_unitary(
             self.betas_rho,
             self.betas_angle,
             self.final_disp_rho,
@@ -645,14 +989,6 @@ class BatchOptimizer(VisualizationMixin):
             self.phis,
             self.thetas,
         )
-        # U_c = tf.scan(lambda a, b: tf.matmul(b, a), bs)[-1]
-        U_c = self.mult_bin_tf(
-            tf.reverse(bs, axis=[0])
-        )  # [U_1,U_2,..] -> [U_N,U_{N-1},..]-> U_N @ U_{N-1} @ .. @ U_1
-        # U_c = self.I
-        # for U in bs:
-        #     U_c = U @ U_c
-        return U_c
 
     def optimize(self, do_prints=True):
 
@@ -661,35 +997,10 @@ class BatchOptimizer(VisualizationMixin):
         print("Start time: " + timestamp)
         # start time
         start_time = time.time()
+        if self.parameters["precision"] == "mixed" and self.dtype != tf.complex64:
+            self.set_dtype(tf.complex64)  # bulk training in single precision
         optimizer = tf.optimizers.Adam(self.parameters["learning_rate"])
-        if self.parameters["include_final_displacement"]:
-            variables = [
-                self.betas_rho,
-                self.betas_angle,
-                self.final_disp_rho,
-                self.final_disp_angle,
-                self.phis,
-                self.thetas,
-            ]
-        else:
-            variables = [
-                self.betas_rho,
-                self.betas_angle,
-                self.phis,
-                self.thetas,
-            ]
-
-        @tf.function
-        def entry_stop_gradients(target, mask):
-            mask_h = tf.abs(mask - 1)
-            return tf.stop_gradient(mask_h * target) + mask * target
-
-        @tf.function
-        def loss_fun(fids):
-            # I think it's important that the log is taken before the avg
-            losses = tf.math.log(1 - fids)
-            avg_loss = tf.reduce_sum(losses) / self.parameters["N_multistart"]
-            return avg_loss
+        variables = self._optimization_variables()
 
         def callback_fun(obj, fids, dfids, epoch):
             elapsed_time_s = time.time() - start_time
@@ -757,37 +1068,11 @@ class BatchOptimizer(VisualizationMixin):
         try:  # will catch keyboard inturrupt
             for epoch in range(self.parameters["epochs"] + 1)[1:]:
                 for _ in range(self.parameters["epoch_size"]):
-                    with tf.GradientTape() as tape:
-                        betas_rho = entry_stop_gradients(self.betas_rho, self.beta_mask)
-                        betas_angle = entry_stop_gradients(
-                            self.betas_angle, self.beta_mask
-                        )
-                        if self.parameters["include_final_displacement"]:
-                            final_disp_rho = entry_stop_gradients(
-                                self.final_disp_rho, self.final_disp_mask
-                            )
-                            final_disp_angle = entry_stop_gradients(
-                                self.final_disp_angle, self.final_disp_mask
-                            )
-                        else:
-                            final_disp_rho = self.final_disp_rho
-                            final_disp_angle = self.final_disp_angle
-                        phis = entry_stop_gradients(self.phis, self.phi_mask)
-                        thetas = entry_stop_gradients(self.thetas, self.theta_mask)
-                        new_fids = self.batch_fidelities(
-                            betas_rho,
-                            betas_angle,
-                            final_disp_rho,
-                            final_disp_angle,
-                            phis,
-                            thetas,
-                        )
-                        new_loss = loss_fun(new_fids)
-                        dloss_dvar = tape.gradient(new_loss, variables)
-                    optimizer.apply_gradients(zip(dloss_dvar, variables))
+                    new_fids = self._train_step(optimizer, variables)
                 dfids = new_fids - fids
                 fids = new_fids
                 callback_fun(self, fids, dfids, epoch)
+                metrics.flush()
                 condition_fid = tf.greater(fids, self.parameters["term_fid"])
                 condition_dfid = tf.greater(dfids, self.parameters["dfid_stop"])
                 if tf.reduce_any(condition_fid):
@@ -813,6 +1098,8 @@ class BatchOptimizer(VisualizationMixin):
             print(
                 "\n\nOptimization stopped.  Reached maximum number of epochs. Terminal fidelity not reached.\n"
             )
+        if self.parameters["precision"] == "mixed":
+            self._polish(timestamp, start_time, do_prints)
         self._save_termination_reason(timestamp, termination_reason)
         timestamp_end = datetime.datetime.now().strftime(TIMESTAMP_FORMAT)
         elapsed_time_s = time.time() - start_time
@@ -834,11 +1121,168 @@ class BatchOptimizer(VisualizationMixin):
             + str(datetime.timedelta(seconds=step_time_s))
         )
         print(END_OPT_STRING)
+        metrics.flush()
         return timestamp
 
+    def _optimization_variables(self):
+        if self.parameters["include_final_displacement"]:
+            return [
+                self.betas_rho,
+                self.betas_angle,
+                self.final_disp_rho,
+                self.final_disp_angle,
+                self.phis,
+                self.thetas,
+            ]
+        return [
+            self.betas_rho,
+            self.betas_angle,
+            self.phis,
+            self.thetas,
+        ]
+
+    def _train_step(self, optimizer, variables):
+        '''
+        One Adam step on the masked circuit parameters, returns the fidelities before the step
+        '''
+        if self.parameters["gradient_backend"] == "adjoint":
+            adjoint_gradients = (
+                self.kernels.tf_adjoint_gradients_real_part
+                if self.parameters["real_part_only"]
+                else self.kernels.tf_adjoint_gradients
+            )
+            with metrics.timer('optimizer.forward_backward', detail = False):
+                new_fids, grads = adjoint_gradients(
+                    self.betas_rho,
+                    self.betas_angle,
+                    self.final_disp_rho,
+                    self.final_disp_angle,
+                    self.phis,
+                    self.thetas,
+                    self.initial_states,
+                    self.target_states_dag,
+                )
+                sync(grads)
+            masks = [self.beta_mask, self.beta_mask, self.final_disp_mask, self.final_disp_mask, self.phi_mask, self.theta_mask]
+            dloss_dvar = [grad * mask for grad, mask in zip(grads, masks)]
+            if not self.parameters["include_final_displacement"]:
+                dloss_dvar = dloss_dvar[:2] + dloss_dvar[4:]
+            with metrics.timer('optimizer.apply_gradients', detail = False):
+                optimizer.apply_gradients(zip(dloss_dvar, variables))
+                sync(variables)
+            metrics.count('optimizer.adam_steps')
+            return new_fids
+        start = time.perf_counter()
+        with tf.GradientTape() as tape:
+            betas_rho = entry_stop_gradients(self.betas_rho, self.beta_mask)
+            betas_angle = entry_stop_gradients(
+                self.betas_angle, self.beta_mask
+            )
+            if self.parameters["include_final_displacement"]:
+                final_disp_rho = entry_stop_gradients(
+                    self.final_disp_rho, self.final_disp_mask
+                )
+                final_disp_angle = entry_stop_gradients(
+                    self.final_disp_angle, self.final_disp_mask
+                )
+            else:
+                final_disp_rho = self.final_disp_rho
+                final_disp_angle = self.final_disp_angle
+            phis = entry_stop_gradients(self.phis, self.phi_mask)
+            thetas = entry_stop_gradients(self.thetas, self.theta_mask)
+            new_fids = self.batch_fidelities(
+                betas_rho,
+                betas_angle,
+                final_disp_rho,
+                final_disp_angle,
+                phis,
+                thetas,
+            )
+            new_loss = loss_fun(new_fids)
+            sync(new_loss)
+            metrics.record('optimizer.forward', time.perf_counter() - start, detail = False)
+            with metrics.timer('optimizer.backward', detail = False):
+                dloss_dvar = tape.gradient(new_loss, variables)
+                sync(dloss_dvar)
+        with metrics.timer('optimizer.apply_gradients', detail = False):
+            optimizer.apply_gradients(zip(dloss_dvar, variables))
+            sync(variables)
+        metrics.count('optimizer.adam_steps')
+        return new_fids
+
+    def _polish(self, timestamp, start_time, do_prints=True):
+        '''
+        Mixed precision: re-evaluates the complex64 result in complex128 and polishes it there with Adam
+        for polish_epochs epochs. Multistarts whose fidelity the polish did not improve are reset to
+        their verified values, so the stored fidelities are always complex128 ones.
+        '''
+        single_fids = np.atleast_1d(self.all_fidelities())
+        self.set_dtype(tf.complex128)
+        fids = self.batch_fidelities(
+            self.betas_rho,
+            self.betas_angle,
+            self.final_disp_rho,
+            self.final_disp_angle,
+            self.phis,
+            self.thetas,
+        )
+        verified_fids = np.atleast_1d(fids.numpy())
+        verified_vars = [v.numpy() for v in self._optimization_variables()]
+        print(
+            "\n Mixed precision check. Max Fid: %.8f (complex64) %.8f (complex128)"
+            % (np.max(single_fids), np.max(verified_fids))
+        )
+        optimizer = tf.optimizers.Adam(self.parameters["polish_learning_rate"])
+        variables = self._optimization_variables()
+        for epoch in range(1, self.parameters["polish_epochs"] + 1):
+            for _ in range(self.parameters["epoch_size"]):
+                new_fids = self._train_step(optimizer, variables)
+            fids = new_fids
+            betas_np, final_disp_np, phis_np, thetas_np = self.get_numpy_vars()
+            self._save_optimization_data(
+                timestamp,
+                np.squeeze(np.array(fids)),
+                betas_np,
+                final_disp_np,
+                phis_np,
+                thetas_np,
+                time.time() - start_time,
+                append=True,
+            )
+            if do_prints:
+                print(
+                    "\r Polish epoch: %d / %d Max Fid: %.8f Avg Fid: %.8f"
+                    % (epoch, self.parameters["polish_epochs"], tf.reduce_max(fids), tf.reduce_mean(fids)),
+                    end="",
+                )
+            if tf.reduce_any(tf.greater(fids, self.parameters["term_fid"])):
+                break
+
+        # keep the polished parameters only where they are better (last axis is the multistart)
+        polished_fids = np.atleast_1d(self.all_fidelities())
+        better = polished_fids > verified_fids
+        for variable, verified in zip(variables, verified_vars):
+            variable.assign(np.where(better, variable.numpy(), verified))
+        betas_np, final_disp_np, phis_np, thetas_np = self.get_numpy_vars()
+        self._save_optimization_data(
+            timestamp,
+            np.squeeze(self.all_fidelities()),
+            betas_np,
+            final_disp_np,
+            phis_np,
+            thetas_np,
+            time.time() - start_time,
+            append=True,
+        )
+        print(
+            "\n Polish done (complex128). Max Fid: %.8f, improved %d / %d multistarts\n"
+            % (np.max(np.where(better, polished_fids, verified_fids)), np.sum(better), len(better))
+        )
+
     # if append is True, it will assume the dataset is already created and append only the
     # last aquired values to it.
     # TODO: if needed, could use compression when saving data.
+    @metrics.timed('hdf5.write', writer = 'optimizer')
     def _save_optimization_data(
         self,
         timestamp,
@@ -936,6 +1380,7 @@ class BatchOptimizer(VisualizationMixin):
                 f[timestamp]["thetas"][-1] = thetas_np
                 f[timestamp].attrs["elapsed_time_s"] = elapsed_time_s
 
+    @metrics.timed('hdf5.write', writer = 'optimizer')
     def _save_termination_reason(self, timestamp, termination_reason):
         with h5py.File(self.filename, "a") as f:
             f[timestamp].attrs["termination_reason"] = termination_reason
@@ -987,30 +1432,30 @@ class BatchOptimizer(VisualizationMixin):
         #     betas_rho[-1] = 0
         #     betas_angle[-1] = 0
         self.betas_rho = tf.Variable(
-            betas_rho, dtype=tf.float32, trainable=True, name="betas_rho",
+            betas_rho, dtype=self.real_dtype, trainable=True, name="betas_rho",
         )
         self.betas_angle = tf.Variable(
-            betas_angle, dtype=tf.float32, trainable=True, name="betas_angle",
+            betas_angle, dtype=self.real_dtype, trainable=True, name="betas_angle",
         )
         if self.parameters["include_final_displacement"]:
             self.final_disp_rho = tf.Variable(
-                final_disp_rho, dtype=tf.float32, trainable=True, name="final_disp_rho",
+                final_disp_rho, dtype=self.real_dtype, trainable=True, name="final_disp_rho",
             )
             self.final_disp_angle = tf.Variable(
-                final_disp_angle, dtype=tf.float32, trainable=True, name="final_disp_angle",
+                final_disp_angle, dtype=self.real_dtype, trainable=True, name="final_disp_angle",
             )
         else:
             self.final_disp_rho = tf.constant(
                 np.zeros(shape=((1, self.parameters["N_multistart"]))),
-                dtype=tf.float32,
+                dtype=self.real_dtype,
             )
             self.final_disp_angle = tf.constant(
                 np.zeros(shape=((1, self.parameters["N_multistart"]))),
-                dtype=tf.float32,
+                dtype=self.real_dtype,
             )
-        self.phis = tf.Variable(phis, dtype=tf.float32, trainable=True, name="phis",)
+        self.phis = tf.Variable(phis, dtype=self.real_dtype, trainable=True, name="phis",)
         self.thetas = tf.Variable(
-            thetas, dtype=tf.float32, trainable=True, name="thetas",
+            thetas, dtype=self.real_dtype, trainable=True, name="thetas",
         )
 
     def get_numpy_vars(
@@ -1062,10 +1507,10 @@ class BatchOptimizer(VisualizationMixin):
             betas_rho = np.abs(betas)
             betas_angle = np.angle(betas)
             self.betas_rho = tf.Variable(
-                betas_rho, dtype=tf.float32, trainable=True, name="betas_rho"
+                betas_rho, dtype=self.real_dtype, trainable=True, name="betas_rho"
             )
             self.betas_angle = tf.Variable(
-                betas_angle, dtype=tf.float32, trainable=True, name="betas_angle",
+                betas_angle, dtype=self.real_dtype, trainable=True, name="betas_angle",
             )
         if final_disp is not None:
             if len(final_disp.shape) < 2:
@@ -1075,19 +1520,19 @@ class BatchOptimizer(VisualizationMixin):
             final_disp_angle = np.angle(final_disp)
             if self.parameters["include_final_displacement"]:
                 self.final_disp_rho = tf.Variable(
-                    final_disp_rho, dtype=tf.float32, trainable=True, name="final_disp_rho",
+                    final_disp_rho, dtype=self.real_dtype, trainable=True, name="final_disp_rho",
                 )
                 self.final_disp_angle = tf.Variable(
-                    final_disp_angle, dtype=tf.float32, trainable=True, name="final_disp_angle",
+                    final_disp_angle, dtype=self.real_dtype, trainable=True, name="final_disp_angle",
                 )
             else:
                 self.final_disp_rho = tf.constant(
                     np.zeros(shape=((1, self.parameters["N_multistart"],))),
-                    dtype=tf.float32,
+                    dtype=self.real_dtype,
                 )
                 self.final_disp_angle = tf.constant(
                     np.zeros(shape=((1, self.parameters["N_multistart"],))),
-                    dtype=tf.float32,
+                    dtype=self.real_dtype,
                 )
 
         if phis is not None:
@@ -1095,15 +1540,16 @@ class BatchOptimizer(VisualizationMixin):
                 phis = phis.reshape(phis.shape + (1,))
                 self.parameters["N_multistart"] = 1
             self.phis = tf.Variable(
-                phis, dtype=tf.float32, trainable=True, name="phis",
+                phis, dtype=self.real_dtype, trainable=True, name="phis",
             )
         if thetas is not None:
             if len(thetas.shape) < 2:
                 thetas = thetas.reshape(thetas.shape + (1,))
                 self.parameters["N_multistart"] = 1
             self.thetas = tf.Variable(
-                thetas, dtype=tf.float32, trainable=True, name="thetas",
+                thetas, dtype=self.real_dtype, trainable=True, name="thetas",
             )
+        self._set_kernels() # N_multistart may have changed
 
     def best_circuit(self):
         fids = self.batch_fidelities(
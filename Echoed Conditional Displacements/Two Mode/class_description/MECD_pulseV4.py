@@ -1,9 +1,12 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
 from scipy.integrate import solve_ivp
 from scipy.signal import find_peaks
 from scipy.optimize import fmin
+from mcd.runtime import get_logger
+from mcd import metrics
+
+logger = get_logger('pulse')
 
 # note that some pulse functions also in fpga_lib are repeated here so this file can be somewhat standalone.
 
@@ -370,6 +373,7 @@ def get_gf_trajectories(
 # Buffer time can be a negative number if you wish to perform the pi pulse while the cavity is being displaced
 # conditional displacement is defined as:
 # D(beta/2)|eXg| + D(-beta/2) |gXe|
+@metrics.timed('pulse.conditional_displacement')
 def conditional_displacement(
     beta,
     alpha,
@@ -703,8 +707,7 @@ def conditional_displacement(
             qubit_dac_pulse = np.pad(qubit_dac_pulse, (0, 1), mode="constant")
             # accumulated_phase = np.pad(accumulated_phase, (0,1), mode='edge')
 
-    print('---------------------------')
-    print('Final Displacement: ' + str(current_beta))
+    logger.debug('Final Displacement: ' + str(current_beta))
     #cavity_dac_pulse, qubit_dac_pulse = construct_CD(alpha, tw, r, r2, buf=buffer_time)
     cavity_dac_pulse = np.append(cavity_dac_pulse, np.zeros(wait_time)) 
     qubit_dac_pulse = np.append(qubit_dac_pulse, np.zeros(wait_time)) 
@@ -733,6 +736,7 @@ def double_circuit(betas, phis, thetas, final_disp=True):
 
 # the following code is old in the sense that it performs a normal ECD sequence
 # normal ECD - two displacements interleaved with either a ge or ef pi pulse
+@metrics.timed('pulse.conditional_displacement_circuit_old')
 def conditional_displacement_circuit_old(
     betas,
     phis,
@@ -921,7 +925,7 @@ def conditional_displacement_circuit_old(
     
 
     if kerr_correction:
-        print("Kerr correction not implemented yet!")
+        logger.warning("Kerr correction not implemented yet!")
     accumulated_phase = np.zeros_like(cavity_dac_pulse)
 
     # if pad:
@@ -951,6 +955,7 @@ def conditional_displacement_circuit_old(
 
 
 # uses baptiste's formulas to find the CD and phase
+@metrics.timed('pulse.analytic_CD_old')
 def analytic_CD_old(epsilon, Omega, chi, is_gf):
     flip_idxs = get_flip_idxs(Omega)
     pm = +1
@@ -1010,6 +1015,7 @@ def analytic_CD_old(epsilon, Omega, chi, is_gf):
     }
 
 # The following function is used for 3 level ancilla 
+@metrics.timed('pulse.conditional_displacement_circuit_ge')
 def conditional_displacement_circuit_ge(
     betas,
     phis,
@@ -1230,7 +1236,7 @@ def conditional_displacement_circuit_ge(
             #cavity_dac_pulse.append(np.zeros(wait_time))
 
     cavity_dac_pulse = np.array([np.concatenate(cavity_dac_pulse[m_]) for m_ in range(N_modes)])
-    print('len of qubit dac pulse is ' + str(len(qubit_dac_pulse)))
+    logger.debug('len of qubit dac pulse is ' + str(len(qubit_dac_pulse)))
     qubit_dac_pulse[0] = np.concatenate(qubit_dac_pulse[0])
     qubit_dac_pulse[1] = np.concatenate(qubit_dac_pulse[1])
     qubit_dac_pulse = np.array(qubit_dac_pulse)
@@ -1240,7 +1246,7 @@ def conditional_displacement_circuit_ge(
     
 
     if kerr_correction:
-        print("Kerr correction not implemented yet!")
+        logger.warning("Kerr correction not implemented yet!")
     accumulated_phase = np.zeros_like(cavity_dac_pulse)
 
     # if pad:
@@ -1314,6 +1320,7 @@ def conditional_displacement_circuit_ge(
 #     }
 
 
+@metrics.timed('pulse.analytic_CD_ge')
 def analytic_CD_ge(epsilon, Omega, chi):
     '''
     Computes phase accrued by e and f state (relative to e and g state) during a ECD_ge gate
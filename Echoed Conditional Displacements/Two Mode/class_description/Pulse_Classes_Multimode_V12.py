@@ -0,0 +1,260 @@
+# ECD pulse construction for the multimode qutip simulations (Simulation_Classes_Multimode_V12),
+# numpy only: importable without qutip, tensorflow or matplotlib (imported when plotting)
+from MECD_pulseV4 import *
+import numpy as np
+import h5py as hf
+
+
+class ecd_pulse_multimode: 
+    
+    def __init__(self, 
+                 param_file = None, 
+                 storages_params = None,
+                 N_modes = 2,
+                 version = 'gef',
+                # storage2_params = None,
+                 chis = None, 
+                 betas = None, 
+                 #gammas = None,
+                 phis = None, 
+                 thetas = None,
+                 qubit_params = None, 
+                 alpha_CD =30, 
+                 kappa = [0.5e-6,0.5e-6], # T1 for both modes is 2ms
+                # kappa2 = 0.5e-6,
+                 buffer_time = 0): 
+        '''
+        betas, thetas, phis : ecd parameters
+        n_q : # of levels in the qubit
+        n_c1 : # of levels in mode 1 of the cavity
+        n_c2 : # of levels in mode 2 of the cavity 
+        
+        storage_params : {
+                            "chi_kHz": -33, #dispersive shift
+                            "chi_prime_Hz": 0, #second order dispersive shift
+                            "Ks_Hz": 0, #Kerr correction not yet implemented.
+                            "epsilon_m_MHz": 400, #largest oscillator drive amplitude in MHz (max|epsilon|)
+                            "unit_amp": 0.01, #DAC unit amp of gaussian displacement to alpha=1.
+                            "sigma": 11, #oscillator displacement sigma
+                            "chop": 4, #oscillator displacement chop (number of stds. to include in gaussian pulse)
+                        }
+                        
+        qubit_params : {'unit_amp': 0.5, 'sigma': 6, 'chop': 4} #parameters for qubit pi pulse.
+        '''
+        self.param_file = param_file # for loading parameters
+        self.betas = betas
+        #self.gammas = gammas
+        self.phis = phis
+        self.thetas = thetas
+        self.load_params()
+        self.N_modes = N_modes
+        self.version = version
+        
+        self.kappa = kappa
+        
+        #Pulse parameters
+
+        ## modes
+        self.storages_params = storages_params
+        
+        if storages_params == None: 
+            self.storages_params = [{
+                            "chi_kHz": 1e+6 * np.array(chis[0]),  # from ECD paper  #chis (Assume same chis for all modes for now 
+                            "chi_prime_Hz":np.array([0,0,0]),# np.array([0, 1.5, 3]), 
+                            "Ks_Hz": 0,
+                            "epsilon_m_MHz": 400, 
+                            "unit_amp": 0.01, 
+                            "sigma": 11, 
+                            "chop": 4, 
+                        } for _ in range(self.N_modes)]
+        #self.storage2_params = storage2_params
+        
+            
+        self.qubit_params = qubit_params
+        if self.qubit_params == None: 
+            self.qubit_params = {'unit_amp': 0.5,
+                                 'sigma': 6, 
+                                 'chop': 4} 
+        self.storages = None
+        #self.storage2 = None
+        self.qubit = None
+        
+        
+        #parameters obtained after get_pulse() is called
+        self.modes_dac_pulse_GHz = None
+        #self.cavity2_dac_pulse_Ghz = None
+        self.qubit_dac_pulse_GHz = None
+        self.alpha = None 
+        
+        #other keyword params
+        self.alpha_CD = alpha_CD
+        self.buffer_time = buffer_time
+        
+        
+    
+    ####
+    import cmath
+    ####
+    def load_params(self): 
+        '''
+        Loads betas, thetas, phis
+        '''
+        #params = np.loadtxt(self.param_file)
+        filename = self.param_file
+        if filename is None:
+            return None
+        file = hf.File(filename, "r")
+        timestamp = list(file.keys())[-1]
+        fids = file[timestamp]['fidelities'][-1]
+        best_fid_idx = np.argmax(fids)
+        logger.info('fidelity for h5 param is ' + str(max(fids)) + ' (index ' + str(best_fid_idx) + ')')
+        self.betas = file[timestamp]['betas'][-1][best_fid_idx]
+        #self.gammas = file[timestamp]['gammas'][-1][best_fid_idx]
+        self.phis = file[timestamp]['phis'][-1][best_fid_idx]
+        #bug in MECD param V2
+        (m,n,s) = self.phis.shape
+        for m_ in range(m):
+            for n_ in range(n): 
+                for s_ in range(s):
+                    self.phis[m_,n_, s_] = self.phis[m_,n_,s_] - (np.pi/2)
+        self.thetas = file[timestamp]['thetas'][-1][best_fid_idx]
+
+        # self.betas = np.array([self.betas[0][:1]])
+        # self.phis = np.array([self.phis[0][:1]])
+        # self.thetas = np.array([self.thetas[0][:1]])
+        return None
+
+    def get_pulses(self): 
+        '''
+        Evaluates cavity and qubit pulses for the desired ECD simulation
+        '''
+
+        #Creates objects
+        self.storages = [FakeStorage(**self.storages_params[m]) for m in range(self.N_modes)] 
+        # = FakeStorage(**self.storage2_params)
+        self.qubit = FakeQubit(**self.qubit_params)
+        
+        #Qubit pi pulse stuff ... calculating conversion between qubit DAC units and MHz (Omega)
+        pi = rotate(np.pi, phi=0, sigma=self.qubit_params['sigma'], chop=self.qubit_params['chop'], dt=1)
+        Omega_m = np.real(np.max(pi))/self.qubit_params['unit_amp']
+        
+        #get pulses
+        pulse_dict = None
+        if self.version == 'ge': 
+            pulse_dict = conditional_displacement_circuit_old(self.betas,
+                                                        #self.gammas,
+                                                        self.phis,
+                                                        self.thetas,
+                                                        self.storages, 
+                                                        #  self.storage2, 
+                                                        self.qubit,
+                                                        alpha_CD = self.alpha_CD,
+                                                        # self.alpha_CD ,
+                                                        buffer_time=self.buffer_time, 
+                                                        kerr_correction = False, 
+                                                        kappa = self.kappa,
+                                                    #  kappa2 = self.kappa2,
+                                                        chi_prime_correction=True, 
+                                                    #  final_disp=True, 
+                                                        pad=True, 
+                                                        is_gf = False
+                                                        )
+        elif self.version == 'gef':
+            pulse_dict = conditional_displacement_circuit_ge(self.betas,
+                                                        #self.gammas,
+                                                        self.phis,
+                                                        self.thetas,
+                                                        self.storages, 
+                                                        #  self.storage2, 
+                                                        self.qubit,
+                                                        alpha_CD = self.alpha_CD,
+                                                        # self.alpha_CD ,
+                                                        buffer_time=self.buffer_time, 
+                                                        kerr_correction = False, 
+                                                        kappa = self.kappa,
+                                                    #  kappa2 = self.kappa2,
+                                                        chi_prime_correction=True, 
+                                                    #  final_disp=True, 
+                                                        pad=True, 
+                                                        #is_gf = False
+                                                        ) 
+
+        #return pulse_dict
+        modes_dac_pulse,  qubit_dac_pulse, = pulse_dict['cavity_dac_pulse'],  pulse_dict['qubit_dac_pulse']
+    
+        #Dac units to Ghz conversion
+
+        self.modes_dac_pulse_GHz = [(2*np.pi)*(10**(-3))*self.storages[m].epsilon_m_MHz*modes_dac_pulse[m] for m in range(self.N_modes)] #convert from DAC to Mhz to Ghz
+        #self.cavity2_dac_pulse_GHz = (2*np.pi)*(10**(-3))*self.storage2.epsilon_m_MHz*cavity2_dac_pulse #convert from DAC to Mhz to Ghz
+        if self.version == 'ge':
+            self.qubit_dac_pulse_GHz = (2*np.pi)*10**(-3)*self.qubit.Omega_m_MHz*qubit_dac_pulse #convert from DAC to Mhz to Ghz
+        elif self.version == 'gef': 
+            self.qubit_dac_pulse_GHz = [(2*np.pi)*10**(-3)*self.qubit.Omega_m_MHz*qubit_dac_pulse[i] for i in range(len(qubit_dac_pulse))] 
+
+        #alpha:  Solve equation of motion and get corresponding displacements for displaced frame simulations
+        self.alpha = [self.alpha_from_epsilon_nonlinear_finite_difference(
+            epsilon_array =self.modes_dac_pulse_GHz[m] , delta=0, kappa = self.kappa[m], alpha_init=0 + 0j) for m in range(self.N_modes)] 
+        
+        # self.alpha2 = self.alpha_from_epsilon_nonlinear_finite_difference(
+        #     epsilon_array =self.cavity2_dac_pulse_GHz , delta=0, kappa = self.kappa2, alpha_init=0 + 0j)
+        
+        return None
+    
+    def alpha_from_epsilon_nonlinear_finite_difference(
+        self, epsilon_array, delta=0, kappa = 0, alpha_init=0 + 0j):
+        dt = 1
+        alpha = np.zeros_like(epsilon_array)
+        alpha[0] = alpha_init
+        alpha[1] = alpha_init
+        for j in range(1, len(epsilon_array) - 1):
+            alpha[j + 1] = (
+                    2*
+                     dt
+                    * (
+                        -1j * delta# * alpha[j]
+                        #- 2j * Ks * np.abs(alpha[j]) ** 2 * alpha[j]
+                        - (kappa / 2.0) * alpha[j]
+                        - 1j * epsilon_array[j]
+                        # probabily assuming that chi_g = 0 , same assumption in MECD V2 pulse file
+                    )
+                    + alpha[j - 1])
+        return alpha
+    
+
+    #####
+    def plot_pulses(self): 
+        '''
+        Plots cavity dac pulse, the resultant displacement of cavity and the qubit pulse
+        '''
+        import matplotlib.pyplot as plt
+        #fig, axs = plt.subplots(5,1)
+        #fig, axs = plt.subplots(3,1)
+        if self.version == 'ge':
+            fig, axs = plt.subplots(self.N_modes+1,1)
+            for m_ in range(self.N_modes):
+                axs[m_].plot(np.real(self.modes_dac_pulse_GHz[m_]))
+                axs[m_].plot(np.imag(self.modes_dac_pulse_GHz[m_]))
+                axs[m_].set_ylabel('Mode '+str(m_)+' Drive (Ghz)', fontsize = 10)
+
+            axs[-1].plot(np.real(self.qubit_dac_pulse_GHz))
+            axs[-1].plot(np.imag(self.qubit_dac_pulse_GHz))
+            axs[-1].set_ylabel('qubit dac pulse (GHz)', fontsize = 10)
+            plt.xlabel('ns')
+            
+        elif self.version == 'gef':
+            fig, axs = plt.subplots(self.N_modes+2,1)
+            for m_ in range(self.N_modes):
+                axs[m_].plot(np.real(self.modes_dac_pulse_GHz[m_]))
+                axs[m_].plot(np.imag(self.modes_dac_pulse_GHz[m_]))
+                axs[m_].set_ylabel('Mode '+str(m_)+' Drive (Ghz)', fontsize = 10)
+
+            axs[-2].plot(np.real(self.qubit_dac_pulse_GHz[0]))
+            axs[-2].plot(np.imag(self.qubit_dac_pulse_GHz[0]))
+            axs[-2].set_ylabel('qubit ge (GHz)', fontsize = 10)
+            
+            axs[-1].plot(np.real(self.qubit_dac_pulse_GHz[1]))
+            axs[-1].plot(np.imag(self.qubit_dac_pulse_GHz[1]))
+            axs[-1].set_ylabel('qubit ef (GHz)', fontsize = 10)
+            plt.xlabel('ns')
+        
+        return fig#None#fig
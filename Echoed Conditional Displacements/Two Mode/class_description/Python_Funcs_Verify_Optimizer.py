@@ -2,6 +2,7 @@ from qutip import *
 import h5py as hf
 import numpy as np
 import scipy
+from mcd.operators import get_operators
 # def mod_disp_op(disp, n_q, n_c):
 #     '''
 #     Returns displacement operator using baken campbell formula
@@ -162,11 +163,10 @@ class Calculator_gef_ECD():
         self.N_modes = len(self.betas)
         self.N_layers = len(self.betas[0])
         
-        #important matrices
-        self.identity = qeye(self.n_c)
-        self.identity_mm = self.identity
-        for i in range(1, self.N_modes):
-            self.identity_mm = np.kron(self.identity_mm, self.identity)
+        #important matrices (shared mcd.operators registry)
+        self.ops = get_operators(self.n_q, self.n_c, self.N_modes, backend = 'numpy')
+        self.identity = self.ops.identity_c
+        self.identity_mm = self.ops.identity_mm
         
     def load_params(self): 
         '''
@@ -193,7 +193,7 @@ class Calculator_gef_ECD():
         Returns displacement operator for specified displacement (in numpy form)
         '''
         #disp = normalize_complex(disp)
-        exponent = (disp*create(self.n_c))- (np.conjugate(disp)*destroy(self.n_c))
+        exponent = Qobj((disp*self.ops.adag_c)- (np.conjugate(disp)*self.ops.a_c))
         d_op = (exponent.expm()).full()
 
         ii= mode_idx
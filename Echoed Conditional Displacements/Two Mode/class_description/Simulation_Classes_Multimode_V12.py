@@ -1,9 +1,17 @@
-from MECD_pulseV4 import *
+from Pulse_Classes_Multimode_V12 import * # ecd_pulse_multimode (and MECD_pulseV4)
 from qutip import *
 import numpy as np
 import h5py as hf
+import os
+import threading
+import multiprocessing
 from scipy import interpolate
-import matplotlib.pyplot as plt
+from mcd.pwc_propagator import pwc_propagator
+from mcd.operators import get_operators
+from mcd.runtime import get_logger, plots_requested
+from mcd import metrics
+
+logger = get_logger('simulation')
 
 
 #V3: changed how angles are loaded 
@@ -21,265 +29,220 @@ import matplotlib.pyplot as plt
 #August 11, 2023
 #V12: each layer consists of ef rotation, ge rotation and then ge ECD
 
-class ecd_pulse_multimode: 
-    
-    def __init__(self, 
-                 param_file = None, 
-                 storages_params = None,
-                 N_modes = 2,
-                 version = 'gef',
-                # storage2_params = None,
-                 chis = None, 
-                 betas = None, 
-                 #gammas = None,
-                 phis = None, 
-                 thetas = None,
-                 qubit_params = None, 
-                 alpha_CD =30, 
-                 kappa = [0.5e-6,0.5e-6], # T1 for both modes is 2ms
-                # kappa2 = 0.5e-6,
-                 buffer_time = 0): 
-        '''
-        betas, thetas, phis : ecd parameters
-        n_q : # of levels in the qubit
-        n_c1 : # of levels in mode 1 of the cavity
-        n_c2 : # of levels in mode 2 of the cavity 
-        
-        storage_params : {
-                            "chi_kHz": -33, #dispersive shift
-                            "chi_prime_Hz": 0, #second order dispersive shift
-                            "Ks_Hz": 0, #Kerr correction not yet implemented.
-                            "epsilon_m_MHz": 400, #largest oscillator drive amplitude in MHz (max|epsilon|)
-                            "unit_amp": 0.01, #DAC unit amp of gaussian displacement to alpha=1.
-                            "sigma": 11, #oscillator displacement sigma
-                            "chop": 4, #oscillator displacement chop (number of stds. to include in gaussian pulse)
-                        }
-                        
-        qubit_params : {'unit_amp': 0.5, 'sigma': 6, 'chop': 4} #parameters for qubit pi pulse.
-        '''
-        self.param_file = param_file # for loading parameters
-        self.betas = betas
-        #self.gammas = gammas
-        self.phis = phis
-        self.thetas = thetas
-        self.load_params()
-        self.N_modes = N_modes
-        self.version = version
-        
-        self.kappa = kappa
-        
-        #Pulse parameters
+####################################################################################
+#############     Qutip Now   ######################################################
+def slice_td_term(term, i0, i1):
+    '''
+    Restricts a [op, coeff_array] term (or a constant op) to the time samples i0..i1
+    '''
+    if isinstance(term, Qobj):
+        return term
+    op, coeff = term
+    return [op, np.asarray(coeff)[i0:i1 + 1]]
+
+def chunk_propagator(bounds, H, t_list, c_ops, nsteps = 10000):
+    '''
+    Propagator from t_list[i0] to t_list[i1] for bounds = (i0, i1). Unitary if there are no
+    collapse operators, superoperator otherwise.
+
+    Kept at module level so that qutip's parallel_map can send it to worker processes
+    '''
+    i0, i1 = bounds
+    H_chunk = [slice_td_term(term, i0, i1) for term in H]
+    c_ops_chunk = [slice_td_term(term, i0, i1) for term in c_ops]
+    t_chunk = t_list[i0:i1 + 1]
+
+    dims = H_chunk[0].dims[0]
+    opts = Options(store_states = False, store_final_state = True, nsteps = nsteps)
+    if len(c_ops_chunk) == 0:
+        return sesolve(H_chunk, qeye(dims), t_chunk, [], options = opts).final_state
+    return mesolve(H_chunk, spre(qeye(dims)), t_chunk, c_ops_chunk, [], options = opts).final_state
+
+def state_fidelity(state, target):
+    '''
+    |<target|state>|^2 for kets, sqrt(Tr(rho target)) when state is a density matrix
+    '''
+    result = 0
+    if (state.type == 'ket') and (target.type == 'ket'):
+        fid = state.overlap(target)
+        result = fid*np.conjugate(fid)
+
+    elif (state.type == 'oper') and (target.type == 'ket'): #density matrix alert
+        target_rho= target*target.dag()
+        result = np.sqrt(state.overlap(target_rho)) # Hilbert schmidt prod is enough, no need for squaring
+
+    elif (state.type == 'oper') and (target.type == 'oper'): #density matrix alert
+        result = np.sqrt(state.overlap(target))
+
+    return np.real(result)
+
+def solve_initial_state(task, H, t_list, c_ops, nsteps = 10000):
+    '''
+    Worker for qutip_sim_multimode.me_solve_many: task = (index, initial, target)
+    Returns (index, fidelity, final state)
+    '''
+    index, initial, target = task
+    opts = Options(store_states = False, store_final_state = True, nsteps = nsteps)
+    # mesolve integrates a ket with sesolve when there are no collapse operators (c_ops may be a list
+    # or a single superoperator)
+    final_state = mesolve(H, initial, t_list, c_ops, [], options = opts).final_state
+    return index, state_fidelity(final_state, target), final_state
+
+def mc_batch(seed, H, initial, t_list, c_ops, e_ops, ntraj, nsteps = 10000):
+    '''
+    Worker for qutip_sim_multimode.mc_solve: ntraj quantum trajectories run serially in this process
+    Returns the per trajectory expectation values, shape (ntraj, len(e_ops), len(t_list))
+    '''
+    opts = Options(nsteps = nsteps, seeds = int(seed), average_expect = False,
+                   store_states = False, store_final_state = False)
+    output = mcsolve(H, initial, t_list, c_ops, e_ops, ntraj = ntraj, options = opts,
+                     progress_bar = None, map_func = serial_map)
+    return np.real(np.array([[np.array(e) for e in traj] for traj in output.expect]))
+
+def mc_batch_task(task, H, initial, t_list, c_ops, e_ops, nsteps = 10000):
+    '''
+    parallel_map wrapper of mc_batch: task = (seed, ntraj)
+    '''
+    seed, ntraj = task
+    return mc_batch(seed, H, initial, t_list, c_ops, e_ops, ntraj, nsteps)
+
+
+def projector_indices(e_ops):
+    '''
+    Flat basis indices k when every operator of e_ops is a projector |k><k| (as from
+    population_e_ops), else None
+    '''
+    if not isinstance(e_ops, (list, tuple)) or len(e_ops) == 0:
+        return None
+    indices = []
+    for op in e_ops:
+        if not isinstance(op, Qobj) or not op.isoper:
+            return None
+        data = op.data.tocoo()
+        data.eliminate_zeros()
+        if data.nnz != 1 or data.row[0] != data.col[0] or data.data[0] != 1:
+            return None
+        indices.append(int(data.row[0]))
+    return np.array(indices)
 
-        ## modes
-        self.storages_params = storages_params
-        
-        if storages_params == None: 
-            self.storages_params = [{
-                            "chi_kHz": 1e+6 * np.array(chis[0]),  # from ECD paper  #chis (Assume same chis for all modes for now 
-                            "chi_prime_Hz":np.array([0,0,0]),# np.array([0, 1.5, 3]), 
-                            "Ks_Hz": 0,
-                            "epsilon_m_MHz": 400, 
-                            "unit_amp": 0.01, 
-                            "sigma": 11, 
-                            "chop": 4, 
-                        } for _ in range(self.N_modes)]
-        #self.storage2_params = storage2_params
-        
-            
-        self.qubit_params = qubit_params
-        if self.qubit_params == None: 
-            self.qubit_params = {'unit_amp': 0.5,
-                                 'sigma': 6, 
-                                 'chop': 4} 
-        self.storages = None
-        #self.storage2 = None
-        self.qubit = None
-        
-        
-        #parameters obtained after get_pulse() is called
-        self.modes_dac_pulse_GHz = None
-        #self.cavity2_dac_pulse_Ghz = None
-        self.qubit_dac_pulse_GHz = None
-        self.alpha = None 
-        
-        #other keyword params
-        self.alpha_CD = alpha_CD
-        self.buffer_time = buffer_time
-        
-        
-    
-    ####
-    import cmath
-    ####
-    def load_params(self): 
+
+class running_stats:
+    '''
+    Mean and standard error over trajectories, updated one batch of trajectories at a time
+    (pairwise update of the mean and the sum of squared deviations, so batches can be dropped)
+    '''
+    def __init__(self):
+        self.n, self.mean, self.M2 = 0, 0., 0.
+
+    def add(self, x):
+        '''
+        x : values of one batch, shape (n_batch, ...)
+        '''
+        n_b = len(x)
+        mean_b = np.mean(x, axis = 0)
+        M2_b = np.sum((x - mean_b)**2, axis = 0)
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * n_b / n
+        self.M2 = self.M2 + M2_b + delta**2 * self.n * n_b / n
+        self.n = n
+
+    def err(self):
+        return np.sqrt(self.M2 / (self.n - 1) / self.n) if self.n > 1 else 0 * self.mean
+
+
+class trajectory_recorder:
+    '''
+    Callback handed to mesolve as e_ops so that nothing but the final state is kept by the solver
+
+    At every time step the record_ops (operators such as projectors, or callables f(t, state)) are
+    evaluated and every stride'th state is kept. If filename is given, the buffered values are
+    appended to that h5 file every flush_every steps, so memory stays constant in pulse length.
+    '''
+    def __init__(self, record_ops = None, stride = None, filename = None, flush_every = 100):
+        self.record_ops = [] if record_ops is None else list(record_ops)
+        self.stride = stride
+        self.filename = filename
+        self.flush_every = flush_every
+        self.step = 0
+
+        self.times, self.values = [], []
+        self.state_times, self.states = [], []
+
+        self.file = None
+        if self.filename is not None:
+            self.file = hf.File(self.filename, 'w')
+
+    def __call__(self, t, state):
+        self.times.append(t)
+        self.values.append([self.evaluate(op, t, state) for op in self.record_ops])
+        if self.stride is not None and self.step % self.stride == 0:
+            self.state_times.append(t)
+            self.states.append(state.full())
+        self.step += 1
+
+        if self.file is not None and len(self.times) >= self.flush_every:
+            self.flush()
+        return None
+
+    def evaluate(self, op, t, state):
+        if isinstance(op, Qobj):
+            return expect(op, state)
+        return op(t, state)
+
+    def append_to_dataset(self, key, data):
         '''
-        Loads betas, thetas, phis
+        Appends data along the first axis of a resizable dataset (created on first call)
         '''
-        #params = np.loadtxt(self.param_file)
-        filename = self.param_file
-        if filename is None:
+        data = np.asarray(data)
+        if key not in self.file:
+            self.file.create_dataset(key, data = data, chunks = True, maxshape = (None,) + data.shape[1:])
             return None
-        file = hf.File(filename, "r")
-        timestamp = list(file.keys())[-1]
-        fids = file[timestamp]['fidelities'][-1]
-        print('fidelity for h5 param is ' + str(max(fids)))
-        best_fid_idx = np.argmax(fids)
-        print('index of fidelity for h5 param is ' + str(best_fid_idx))
-        self.betas = file[timestamp]['betas'][-1][best_fid_idx]
-        #self.gammas = file[timestamp]['gammas'][-1][best_fid_idx]
-        self.phis = file[timestamp]['phis'][-1][best_fid_idx]
-        #bug in MECD param V2
-        (m,n,s) = self.phis.shape
-        for m_ in range(m):
-            for n_ in range(n): 
-                for s_ in range(s):
-                    self.phis[m_,n_, s_] = self.phis[m_,n_,s_] - (np.pi/2)
-        self.thetas = file[timestamp]['thetas'][-1][best_fid_idx]
-
-        # self.betas = np.array([self.betas[0][:1]])
-        # self.phis = np.array([self.phis[0][:1]])
-        # self.thetas = np.array([self.thetas[0][:1]])
+        dset = self.file[key]
+        dset.resize(dset.shape[0] + data.shape[0], axis = 0)
+        dset[-data.shape[0]:] = data
         return None
 
-    def get_pulses(self): 
+    @metrics.timed('hdf5.write', writer = 'trajectory')
+    def flush(self):
         '''
-        Evaluates cavity and qubit pulses for the desired ECD simulation
+        Moves buffered records to the h5 file
         '''
+        if len(self.times) > 0:
+            self.append_to_dataset('times', self.times)
+            self.append_to_dataset('expect', np.array(self.values, dtype = complex).reshape(len(self.times), len(self.record_ops)))
+        if len(self.states) > 0:
+            self.append_to_dataset('state_times', self.state_times)
+            self.append_to_dataset('states', np.array(self.states))
+        self.file.flush()
+        self.times, self.values = [], []
+        self.state_times, self.states = [], []
+        return None
 
-        #Creates objects
-        self.storages = [FakeStorage(**self.storages_params[m]) for m in range(self.N_modes)] 
-        # = FakeStorage(**self.storage2_params)
-        self.qubit = FakeQubit(**self.qubit_params)
-        
-        #Qubit pi pulse stuff ... calculating conversion between qubit DAC units and MHz (Omega)
-        pi = rotate(np.pi, phi=0, sigma=self.qubit_params['sigma'], chop=self.qubit_params['chop'], dt=1)
-        Omega_m = np.real(np.max(pi))/self.qubit_params['unit_amp']
-        
-        #get pulses
-        pulse_dict = None
-        if self.version == 'ge': 
-            pulse_dict = conditional_displacement_circuit_old(self.betas,
-                                                        #self.gammas,
-                                                        self.phis,
-                                                        self.thetas,
-                                                        self.storages, 
-                                                        #  self.storage2, 
-                                                        self.qubit,
-                                                        alpha_CD = self.alpha_CD,
-                                                        # self.alpha_CD ,
-                                                        buffer_time=self.buffer_time, 
-                                                        kerr_correction = False, 
-                                                        kappa = self.kappa,
-                                                    #  kappa2 = self.kappa2,
-                                                        chi_prime_correction=True, 
-                                                    #  final_disp=True, 
-                                                        pad=True, 
-                                                        is_gf = False
-                                                        )
-        elif self.version == 'gef':
-            pulse_dict = conditional_displacement_circuit_ge(self.betas,
-                                                        #self.gammas,
-                                                        self.phis,
-                                                        self.thetas,
-                                                        self.storages, 
-                                                        #  self.storage2, 
-                                                        self.qubit,
-                                                        alpha_CD = self.alpha_CD,
-                                                        # self.alpha_CD ,
-                                                        buffer_time=self.buffer_time, 
-                                                        kerr_correction = False, 
-                                                        kappa = self.kappa,
-                                                    #  kappa2 = self.kappa2,
-                                                        chi_prime_correction=True, 
-                                                    #  final_disp=True, 
-                                                        pad=True, 
-                                                        #is_gf = False
-                                                        ) 
-
-        #return pulse_dict
-        modes_dac_pulse,  qubit_dac_pulse, = pulse_dict['cavity_dac_pulse'],  pulse_dict['qubit_dac_pulse']
-    
-        #Dac units to Ghz conversion
-
-        self.modes_dac_pulse_GHz = [(2*np.pi)*(10**(-3))*self.storages[m].epsilon_m_MHz*modes_dac_pulse[m] for m in range(self.N_modes)] #convert from DAC to Mhz to Ghz
-        #self.cavity2_dac_pulse_GHz = (2*np.pi)*(10**(-3))*self.storage2.epsilon_m_MHz*cavity2_dac_pulse #convert from DAC to Mhz to Ghz
-        if self.version == 'ge':
-            self.qubit_dac_pulse_GHz = (2*np.pi)*10**(-3)*self.qubit.Omega_m_MHz*qubit_dac_pulse #convert from DAC to Mhz to Ghz
-        elif self.version == 'gef': 
-            self.qubit_dac_pulse_GHz = [(2*np.pi)*10**(-3)*self.qubit.Omega_m_MHz*qubit_dac_pulse[i] for i in range(len(qubit_dac_pulse))] 
-
-        #alpha:  Solve equation of motion and get corresponding displacements for displaced frame simulations
-        self.alpha = [self.alpha_from_epsilon_nonlinear_finite_difference(
-            epsilon_array =self.modes_dac_pulse_GHz[m] , delta=0, kappa = self.kappa[m], alpha_init=0 + 0j) for m in range(self.N_modes)] 
-        
-        # self.alpha2 = self.alpha_from_epsilon_nonlinear_finite_difference(
-        #     epsilon_array =self.cavity2_dac_pulse_GHz , delta=0, kappa = self.kappa2, alpha_init=0 + 0j)
-        
+    def close(self, final_state = None):
+        '''
+        Flushes what is left (and the final state) and closes the file
+        '''
+        if self.file is None:
+            return None
+        self.flush()
+        if final_state is not None:
+            self.file.create_dataset('final_state', data = final_state.full())
+        self.file.close()
+        self.file = None
         return None
-    
-    def alpha_from_epsilon_nonlinear_finite_difference(
-        self, epsilon_array, delta=0, kappa = 0, alpha_init=0 + 0j):
-        dt = 1
-        alpha = np.zeros_like(epsilon_array)
-        alpha[0] = alpha_init
-        alpha[1] = alpha_init
-        for j in range(1, len(epsilon_array) - 1):
-            alpha[j + 1] = (
-                    2*
-                     dt
-                    * (
-                        -1j * delta# * alpha[j]
-                        #- 2j * Ks * np.abs(alpha[j]) ** 2 * alpha[j]
-                        - (kappa / 2.0) * alpha[j]
-                        - 1j * epsilon_array[j]
-                        # probabily assuming that chi_g = 0 , same assumption in MECD V2 pulse file
-                    )
-                    + alpha[j - 1])
-        return alpha
-    
 
-    #####
-    import matplotlib.pyplot as plt
-    #####
-    def plot_pulses(self): 
-        '''
-        Plots cavity dac pulse, the resultant displacement of cavity and the qubit pulse
-        '''
-        #fig, axs = plt.subplots(5,1)
-        #fig, axs = plt.subplots(3,1)
-        if self.version == 'ge':
-            fig, axs = plt.subplots(self.N_modes+1,1)
-            for m_ in range(self.N_modes):
-                axs[m_].plot(np.real(self.modes_dac_pulse_GHz[m_]))
-                axs[m_].plot(np.imag(self.modes_dac_pulse_GHz[m_]))
-                axs[m_].set_ylabel('Mode '+str(m_)+' Drive (Ghz)', fontsize = 10)
-
-            axs[-1].plot(np.real(self.qubit_dac_pulse_GHz))
-            axs[-1].plot(np.imag(self.qubit_dac_pulse_GHz))
-            axs[-1].set_ylabel('qubit dac pulse (GHz)', fontsize = 10)
-            plt.xlabel('ns')
-            
-        elif self.version == 'gef':
-            fig, axs = plt.subplots(self.N_modes+2,1)
-            for m_ in range(self.N_modes):
-                axs[m_].plot(np.real(self.modes_dac_pulse_GHz[m_]))
-                axs[m_].plot(np.imag(self.modes_dac_pulse_GHz[m_]))
-                axs[m_].set_ylabel('Mode '+str(m_)+' Drive (Ghz)', fontsize = 10)
-
-            axs[-2].plot(np.real(self.qubit_dac_pulse_GHz[0]))
-            axs[-2].plot(np.imag(self.qubit_dac_pulse_GHz[0]))
-            axs[-2].set_ylabel('qubit ge (GHz)', fontsize = 10)
-            
-            axs[-1].plot(np.real(self.qubit_dac_pulse_GHz[1]))
-            axs[-1].plot(np.imag(self.qubit_dac_pulse_GHz[1]))
-            axs[-1].set_ylabel('qubit ef (GHz)', fontsize = 10)
-            plt.xlabel('ns')
-        
-        return fig#None#fig
-    
-    
-####################################################################################
-#############     Qutip Now   ######################################################
+    def results(self):
+        '''
+        Recorded data as arrays (only what is still in memory, i.e. everything if no file was given)
+        '''
+        return {'times' : np.array(self.times),
+                'expect' : np.array(self.values, dtype = complex).reshape(len(self.times), len(self.record_ops)),
+                'state_times' : np.array(self.state_times),
+                'states' : np.array(self.states),
+                'filename' : self.filename}
+
+
 class qutip_sim_multimode:
     
     def __init__(self, n_q, n_c, N_modes, method = 'ecd', # or 'cgrape'
@@ -288,7 +251,8 @@ class qutip_sim_multimode:
                  alphas = [], qubit_pulse = [],
                  sim_params = None, save_states = False, 
                  filename = '',
-                 states_filename = 'states store'):
+                 states_filename = 'states store',
+                 plot_pulses = None):
         '''
         n_q, n_c = # of levels in qubit, cavity
         
@@ -299,6 +263,8 @@ class qutip_sim_multimode:
         sim_params = sim_params = {'bare_qubit_mode_coupling':0,
         'Stark Shift': 0,  'transmon_relax': 0,'transmon_dephasing': 0,
         'cavity_relax': 0,'cavity_dephasing': 0}  # 0 means false, 1 means true or activates    
+
+        plot_pulses = plot the loaded ECD pulses (default: unless headless, see mcd.runtime)
         '''
         #print('hi')
         self.n_q = n_q
@@ -320,7 +286,7 @@ class qutip_sim_multimode:
         self.compute_chis()
         
         #load pulses from simulation files
-        self.load_pulse()       
+        self.load_pulse(plot = plot_pulses)       
             
         #get operators
         self.get_basic_ops()
@@ -376,9 +342,10 @@ class qutip_sim_multimode:
         
         return None
         
-    def load_pulse(self ):
+    def load_pulse(self, plot = None):
         '''
         Returns qubit and alpha(t)
+        plot: plot the ECD pulses (default: unless headless)
         '''
         # Two arrays for qubit pulse: 
         '''
@@ -446,7 +413,8 @@ class qutip_sim_multimode:
                 self.qubit_pulse2[1].append(pulse_sim.qubit_dac_pulse_GHz[1])
             
             #Plot ECD pulses
-            pulse_sim.plot_pulses()
+            if plots_requested(plot):
+                pulse_sim.plot_pulses()
             self.pulse_sim = pulse_sim
             
 
@@ -476,21 +444,23 @@ class qutip_sim_multimode:
     def get_basic_ops(self): 
         '''
         Creates identity, creation/annihilation for qubit/cavity
+        (shared with the other classes through the mcd.operators registry)
         '''
-        self.identity_q = qeye(self.n_q)
-        self.identity_c = qeye(self.n_c)
+        ops = get_operators(self.n_q, self.n_c, self.N_modes, backend = 'qutip')
+        self.identity_q = ops.identity_q
+        self.identity_c = ops.identity_c
 
-        self.a_q = destroy(self.n_q)
-        self.a_c = destroy(self.n_c)
+        self.a_q = ops.a_q
+        self.a_c = ops.a_c
 
-        self.adag_q = create(self.n_q)
-        self.adag_c = create(self.n_c)
+        self.adag_q = ops.adag_q
+        self.adag_c = ops.adag_c
 
-        self.num_q = num(self.n_q)
-        self.num_c =  num(self.n_c)
+        self.num_q = ops.num_q
+        self.num_c =  ops.num_c
         
         # Transmon state projection operators
-        self.t_states = [ basis( self.n_q, j ) * (basis( self.n_q, j).dag()) for j in range(self.n_q)]
+        self.t_states = ops.q_projectors
         
         #Transmon Sigma Matrices  (For Grape Code)
 
@@ -518,35 +488,15 @@ class qutip_sim_multimode:
             self.Q_sigmaYs.append(arr)
 
         # Multimode Identity Operator
-        self.identity_mms = self.identity_c
-        
-        for _ in range(1, self.N_modes):
-            
-            self.identity_mms = tensor( self.identity_mms ,
-                                       self.identity_c)
-        
-        # Multimode Operators Creation and Annhilation operators
-        self.a_mms= []
-        self.adag_mms = []
+        self.identity_mms = ops.identity_mm
         
-        for m in range(self.N_modes):
-            
-            ## Creating annihilation and creation operators for m'th mode (ignoring qubit)
-            a_mm = self.a_c * (m == 0) + self.identity_c * (1 - (m == 0))
-            adag_mm = self.adag_c * (m == 0) + self.identity_c * (1 - (m == 0))
-            
-            for n in range(1,self.N_modes):
-                a_mm = tensor( a_mm , 
-                                    self.a_c * (m == n) + self.identity_c * (1 - (m == n)) )
-                adag_mm = tensor( adag_mm , 
-                                    self.adag_c * (m == n) + self.identity_c * (1 - (m == n)) )
-                
-            ## Adding them to the list 
-            self.a_mms.append( a_mm )
-            self.adag_mms.append( adag_mm )
+        # Multimode Operators Creation and Annhilation operators (m'th mode, ignoring qubit)
+        self.a_mms = ops.a_mm
+        self.adag_mms = ops.adag_mm
         
         return None
     
+    @metrics.timed('hamiltonian.assembly', step = 'drive')
     def initialize_ECD_and_qubit_drive(self): 
         '''
         Adds the initial ECD time dependent displacement terms and qubit_drive to ham
@@ -650,112 +600,49 @@ class qutip_sim_multimode:
 
     def add_mode_mode_coupling(self, eta = None):
         '''
-        Add mode mode coupling term or cross kerr interaction
+        Add mode mode coupling term or cross kerr interaction for any number of modes
+
+        eta = N_modes x N_modes cross kerr matrix (only i<j entries are used)
+        default: cross kerr = sqrt(kerr_mode_i  * kerr_mode_j) = chi_i * chi_j /anharmonicity of qubit
 
-        cross kerr = sqrt(kerr_mode1  * kerr_mode2) = chi1 * chi2 /anharmonicity of qubit
+        In the displaced frame each mode's number operator is (a^dag + alpha*)(a + alpha) 
+            = n + alpha a^dag + alpha* a + |alpha|^2
+        so eta_ij n_i n_j is expanded mode by mode; terms acting with the same operators on all modes
+        (e.g. n_1 |alpha_2|^2 and n_1 |alpha_3|^2) are merged and their coefficients summed as arrays
         '''
-        eta = self.chi1*self.chi2/self.qubit_anh   
-        print('V8 mode-mode coupling')
-        
-        #a^dag a 
-        
-        ## bdag b
-        self.H0+= eta*tensor(self.identity_q, self.num_c, self.num_c)
-        ## beta * bdag
-        term = tensor(self.identity_q, self.num_c, self.adag_c)
-        self.Hd.append(
-            [eta * term, self.alpha2 ]
-        )
-        ## beta* * b
-        term = tensor(self.identity_q, self.num_c, self.a_c)
-        self.Hd.append(
-            [eta * term, np.conjugate(self.alpha2 )]
-        )
-        ## |beta|^2
-        term = tensor(self.identity_q, self.num_c, self.identity_c)
-        self.Hd.append(
-            [eta * term, np.array([(np.abs(amp))**2 for amp in self.alpha2])]
-        )
-        
-        #a^dag alpha 
-        
-        ## bdag b
-        term = tensor(self.identity_q, self.adag_c, self.num_c)
-        self.Hd.append(
-            [eta * term, self.alpha1 ]
-        )
-        ## beta * bdag
-        term = tensor(self.identity_q, self.adag_c, self.adag_c)
-        self.Hd.append(
-            [eta * term, np.array([amp1 * amp2 for amp1, amp2 in zip(self.alpha1, self.alpha2) ])]
-        )
-        ## beta* * b
-        term = tensor(self.identity_q, self.adag_c, self.a_c)
-        self.Hd.append(
-            [eta * term, 
-            np.array( [amp1 * amp2 for amp1, amp2 in zip(self.alpha1, np.conjugate(self.alpha2)) ])]
-        )
-        ## |beta|^2
-        term = tensor(self.identity_q,self.adag_c, self.identity_c)
-        self.Hd.append(
-            [eta * term, 
-             np.array([amp1 * amp2 for amp1, amp2 in zip(self.alpha1, 
-                                                [(np.abs(amp))**2 for amp in self.alpha2]
-                                               ) ])]
-                    )
-        #a alpha ^*
-        
-        ## bdag b
-        term = tensor(self.identity_q, self.a_c, self.num_c)
-        self.Hd.append(
-            [eta * term, np.conjugate(self.alpha1 )]
-        )
-        ## beta * bdag
-        term = tensor(self.identity_q, self.a_c, self.adag_c)
-        self.Hd.append(
-            [eta * term, np.array([amp1 * amp2 for amp1, amp2 in zip(np.conjugate(self.alpha1 ), 
-                                                            self.alpha2) ])]
-        )
-        ## beta* * b
-        term = tensor(self.identity_q, self.a_c, self.a_c)
-        self.Hd.append(
-            [eta * term, 
-             np.array([amp1 * amp2 for amp1, amp2 in zip(np.conjugate(self.alpha1 ),
-                                                np.conjugate(self.alpha2)) ])]
-        )
-        ## |beta|^2
-        term = tensor(self.identity_q, self.a_c, self.identity_c)
-        self.Hd.append(
-            [eta * term, 
-             np.array([amp1 * amp2 for amp1, amp2 in zip(np.conjugate(self.alpha1 ), 
-                                                [(np.abs(amp))**2 for amp in self.alpha2]
-                                               ) ])]
-                    )
-        
-         #|alpha|^2
-        
-        ## bdag b
-        term = tensor(self.identity_q, self.identity_c, self.num_c)
-        self.Hd.append(
-            [eta * term, np.array([(np.abs(amp))**2 for amp in self.alpha1])]
-        )
-        ## beta * bdag
-        term = tensor(self.identity_q, self.identity_c, self.adag_c)
-        self.Hd.append(
-            [eta * term, np.array([amp1 * amp2 for amp1, amp2 in zip(
-                                    [(np.abs(amp))**2 for amp in self.alpha1], 
-                                                            self.alpha2)
-                         ])]
-        )
-        ## beta* * b
-        term = tensor(self.identity_q, self.identity_c, self.a_c)
-        self.Hd.append(
-            [eta * term, 
-            np.array( [amp1 * amp2 for amp1, amp2 in zip([(np.abs(amp))**2 for amp in self.alpha1],
-                                                np.conjugate(self.alpha2)) ])]
-        )
-        ## |beta|^2 just constant term
-        
+        if eta is None:
+            eta = [[self.chis[i][1] * self.chis[j][1] / self.qubit_anh for j in range(self.N_modes)]
+                   for i in range(self.N_modes)]
+        eta = np.array(eta)
+
+        ops = {'n': self.num_c, 'a': self.a_c, 'adag': self.adag_c, 'I': self.identity_c}
+        # displaced number operator of each mode: (label, coefficient)
+        expansions = []
+        for m in range(self.N_modes):
+            alpha = np.array(self.alphas[m])
+            expansions.append([('n', 1), ('adag', alpha), ('a', np.conjugate(alpha)), ('I', np.abs(alpha)**2)])
+
+        terms = {} # tuple of per mode labels -> coefficient (number or array)
+        for i in range(self.N_modes):
+            for j in range(i + 1, self.N_modes):
+                if eta[i][j] == 0: continue
+                for label_i, coeff_i in expansions[i]:
+                    for label_j, coeff_j in expansions[j]:
+                        labels = ['I' for _ in range(self.N_modes)]
+                        labels[i] = label_i
+                        labels[j] = label_j
+                        key = tuple(labels)
+                        if key == tuple('I' for _ in range(self.N_modes)): continue # just constant term
+                        terms[key] = terms.get(key, 0) + eta[i][j] * coeff_i * coeff_j
+
+        for key, coeff in terms.items():
+            term = tensor([self.identity_q] + [ops[label] for label in key])
+            if np.ndim(coeff) == 0:
+                self.H0 += coeff * term
+            else:
+                self.Hd.append([term, coeff])
+
+        logger.info('mode-mode coupling: ' + str(len(terms)) + ' terms for ' + str(self.N_modes) + ' modes')
         return None
         
           
@@ -914,32 +801,314 @@ class qutip_sim_multimode:
     #     self.add_cavity_dephasing_for_given_mode( T1_mode1, Techo_mode1, self.alpha1, mode_idx = 1, thermal = thermal, T_phi = T_phi)
     #     self.add_cavity_dephasing_for_given_mode( T1_mode2, Techo_mode2, self.alpha2, mode_idx = 2, thermal = thermal, T_phi= T_phi)        
     #     return None
+
+    def add_cavity_dephasing(self, T1 = 10e+6, Techo = 10e+6, T_phi = None):
+        '''
+        Cavity dephasing of all modes in the displaced frame (T1, Techo, T_phi in nanoseconds,
+        either one number for all modes or a list with one entry per mode)
+
+        Same terms as add_cavity_dephasing_for_given_mode above, but grouped by coefficient: one static
+        superoperator for all modes plus 3 time dependent ones per mode, with numpy coefficients
+        '''
+        def per_mode(x):
+            return list(x) if np.ndim(x) > 0 else [x for _ in range(self.N_modes)]
+        T1s, Techos, T_phis = per_mode(T1), per_mode(Techo), per_mode(T_phi)
+
+        D = lindblad_dissipator
+        static = 0
+        for m in range(self.N_modes):
+            #Rates 
+            if T_phis[m] != None: 
+                gamma_phi = 2*(1/T_phis[m])
+            else:
+                gamma_relax= (1/T1s[m])
+                gamma_echo = (1/Techos[m])
+                gamma_phi = gamma_echo - (gamma_relax/2)
+
+            # (a+ alpha)(a^dag + alpha^star) = a^adag + alpha^star * a + alpha* adag + |alpha|^2
+            n = tensor(self.identity_q, self.adag_mms[m] * self.a_mms[m])
+            a = tensor(self.identity_q, self.a_mms[m])
+            adag = tensor(self.identity_q, self.adag_mms[m])
+            alpha = np.array(self.alphas[m])
+
+            static = static + gamma_phi * D(n)
+            self.c_ops.append([gamma_phi * (D(a) + D(adag) + D(n, a) + D(n, adag) + D(a, n) + D(adag, n)),
+                               np.abs(alpha)**2])
+            self.c_ops.append([gamma_phi * D(a, adag), np.conjugate(alpha)**2])
+            self.c_ops.append([gamma_phi * D(adag, a), alpha**2])
+        self.c_ops.append(static)
+        return None
     
     
-    def me_solve(self, nsteps = 10000, initial = None, e_ops = None): 
+    def get_t_list(self):
         '''
-        Solve the master equation 
+        Time grid of the pulse (one sample per ns)
         '''
         T = len(self.alphas[0]) # total time length in nanoseconds
-        t_list = np.linspace(0, T, T)
+        return np.linspace(0, T, T)
+
+    @metrics.timed('hamiltonian.assembly', step = 'build')
+    def build_hamiltonian(self, compile = False):
+        '''
+        Full time dependent Hamiltonian [H0, [H1, c1(t)], ...] in qutip list format
+        (compile = True uses the grouped terms of compile_hamiltonian instead of self.Hd)
+        '''
+        if compile:
+            self.H = self.compile_hamiltonian()
+            return self.H
+        self.H = [self.H0]
+        for i in self.Hd:
+             self.H.append(i)
+        return self.H
+
+    @metrics.timed('hamiltonian.assembly', step = 'compile')
+    def compile_hamiltonian(self, tol = 1e-12):
+        '''
+        Groups the drive terms of self.Hd by coefficient
+
+        Each [op, c(t)] is split into op * Re(c) + (1j op) * Im(c) so that all coefficients are real,
+        operators sharing the same coefficient (up to sign) are summed into one term (conjugate
+        pairs like [A, alpha*], [A^dag, alpha] become the Hermitian A + A^dag and 1j(A^dag - A)),
+        zero terms are dropped and constant coefficients are folded into H0.
+
+        The remaining coefficients are stored in self.coeff_table (n_terms x T) and interpolated
+        once with qutip's Cubic_Spline. Returns the qutip list format Hamiltonian (self.H_compiled)
+        '''
+        t_list = self.get_t_list()
+        H0 = self.H0
+        groups = {} # coefficient bytes -> [coefficient, summed operator]
+
+        for op, coeff in self.Hd:
+            coeff = np.asarray(coeff, dtype = complex)
+            for part, part_op in [(np.real(coeff), op), (np.imag(coeff), 1j * op)]:
+                scale = np.max(np.abs(part))
+                if scale <= tol:
+                    continue
+                if np.max(np.abs(part - part[0])) <= tol * scale: # constant coefficient
+                    H0 = H0 + part[0] * part_op
+                    continue
+                sign = np.sign(part[np.nonzero(np.abs(part) > tol * scale)[0][0]])
+                part = np.ascontiguousarray(sign * part)
+                key = part.tobytes()
+                if key in groups:
+                    groups[key][1] = groups[key][1] + sign * part_op
+                else:
+                    groups[key] = [part, sign * part_op]
+
+        self.coeff_table = []
+        self.H_compiled = [H0]
+        for part, op in groups.values():
+            if op.norm() <= tol: # e.g. chi_g = 0 terms
+                continue
+            self.coeff_table.append(part)
+            self.H_compiled.append([op, Cubic_Spline(t_list[0], t_list[-1], part)])
+        self.coeff_table = np.array(self.coeff_table)
+
+        logger.info('compiled ' + str(len(self.Hd)) + ' drive terms into ' + str(len(self.H_compiled) - 1))
+        return self.H_compiled
+
+    @metrics.timed('mesolve', solver = 'propagator')
+    def compute_propagator(self, n_chunks = 1, num_cpus = None, nsteps = 10000):
+        '''
+        Propagator of the whole pulse from a single integration: a unitary if self.c_ops is empty,
+        a superoperator otherwise. The pulse is split into n_chunks time chunks that are integrated
+        in parallel and multiplied together.
+        '''
+        t_list = self.get_t_list()
+        H = self.build_hamiltonian()
+
+        edges = np.linspace(0, len(t_list) - 1, n_chunks + 1).astype(int)
+        bounds = [(edges[k], edges[k+1]) for k in range(n_chunks) if edges[k+1] > edges[k]]
+        if len(bounds) == 1:
+            chunk_props = [chunk_propagator(bounds[0], H, t_list, self.c_ops, nsteps)]
+        else:
+            chunk_props = parallel_map(chunk_propagator, bounds, task_args = (H, t_list, self.c_ops, nsteps),
+                                       num_cpus = num_cpus)
+
+        self.propagator = chunk_props[0]
+        for prop in chunk_props[1:]:
+            self.propagator = prop * self.propagator
+        return self.propagator
+
+    def propagator_fidelity(self, initial, target):
+        '''
+        Transfer probability |<target|U|initial>|^2 (or <target|S(|initial><initial|)|target> for a
+        superoperator) from the propagator computed by compute_propagator
+        '''
+        if self.propagator.issuper:
+            final = vector_to_operator(self.propagator * operator_to_vector(ket2dm(initial)))
+            return np.real((target.dag() * final * target).tr())
+        overlap = (target.dag() * self.propagator * initial).tr()
+        return np.real(overlap * np.conjugate(overlap))
+
+    @metrics.timed('mesolve', solver = 'me_solve')
+    def me_solve(self, nsteps = 10000, initial = None, e_ops = None, store_states = True,
+                 record_ops = None, record_stride = None, checkpoint_file = None, checkpoint_every = 100,
+                 compile = False):
+        '''
+        Solve the master equation (compile = True groups the drive terms first, see compile_hamiltonian)
+
+        store_states = False keeps only the final state; pair it with e_ops = self.population_e_ops()
+        to record populations on the fly (their basis indices are kept in self.output.population_indices,
+        None for other e_ops, see get_populations)
 
-        if initial == None: 
+        Recording mode (record_ops and/or record_stride given): mesolve keeps only the final state,
+        record_ops (operators or callables f(t, state)) are evaluated at every step and the state is
+        kept every record_stride steps. With checkpoint_file these are streamed to that h5 file every
+        checkpoint_every steps. See self.recorder.results()
+        '''
+        t_list = self.get_t_list()
+
+        if initial == None:
             initial = tensor(basis(self.n_q,0), basis(self.n_c1,0), basis(self.n_c2,0))
-            
-        opts = Options(store_states=True, store_final_state=True, nsteps = nsteps)#, max_step = 10)
+
+        opts = Options(store_states=store_states, store_final_state=True, nsteps = nsteps)#, max_step = 10)
         ## since smallest pulse is a pi pulse which is 40 ns long
         
         #Hamiltonian
-        self.H = [self.H0]
-        for i in self.Hd:
-             self.H.append(i)
+        self.build_hamiltonian(compile = compile)
             
+        self.recorder = None
+        if (record_ops is not None) or (record_stride is not None):
+            self.recorder = trajectory_recorder(record_ops = record_ops, stride = record_stride,
+                                                filename = checkpoint_file, flush_every = checkpoint_every)
+            e_ops = self.recorder
+            opts.store_states = False
+
+        # closed system with a ket: mesolve evolves the ket with sesolve, not rho
         self.output = mesolve(self.H, initial , t_list, self.c_ops, e_ops, options =opts)        
-        if self.save_states: 
+        self.output.population_indices = None if self.recorder is not None else projector_indices(e_ops)
+        if self.recorder is not None:
+            self.recorder.close(final_state = self.output.final_state)
+        elif self.save_states: 
             qsave(self.output.states, self.states_filename)
         
         return None
     
+    @metrics.timed('mesolve', solver = 'mc_solve')
+    def mc_solve(self, initial = None, target = None, ntraj = 200, batch_size = 20, num_cpus = None,
+                 populations = None, nsteps = 10000, seed = 0, compile = False):
+        '''
+        Trajectory (Monte Carlo wavefunction) alternative to me_solve for the same H and self.c_ops
+
+        Only state vectors of size d are evolved instead of the d^2 density matrix. The ntraj trajectories
+        are split into batches of batch_size, each batch runs in its own process (qutip parallel_map)
+        with its own seed (seed + batch number, so runs are reproducible).
+
+        populations : flat basis indices (see basis_index) to record, default all
+        target      : if given, the target population |<target|psi(T)>|^2 is averaged too
+
+        Returns (and stores in self.mc_result) a dict with the mean and standard error over trajectories
+        of the populations (n_times x n_indices, columns 'population_indices') and the target
+        population. Both are updated as each batch completes (in completion order, only the running
+        sums are kept) and logged; the values after every batch are in 'running_ntraj',
+        'running_populations' / 'running_populations_err' (final time, n_batches x n_indices) and
+        'running_target_population' / '..._err'.
+        'fidelity' = sqrt(target_population) is the fidelity of the trajectory averaged density matrix
+        as get_fidelity defines it after me_solve (sqrt(<target|rho|target>)), the same for
+        'running_fidelity'; the errors are propagated (err / (2 sqrt(target_population)))
+        '''
+        for c_op in self.c_ops:
+            op = c_op[0] if isinstance(c_op, list) else c_op
+            if op.issuper:
+                raise ValueError('mc_solve needs collapse operators, not superoperators (e.g. add_cavity_dephasing)')
+
+        t_list = self.get_t_list()
+        H = self.build_hamiltonian(compile = compile)
+        if initial == None:
+            initial = tensor([basis(self.n_q, 0)] + [basis(self.n_c, 0) for _ in range(self.N_modes)])
+
+        e_ops = self.population_e_ops(populations)
+        n_pops = len(e_ops)
+        if target is not None:
+            e_ops = e_ops + [target * target.dag()]
+
+        batches = [batch_size for _ in range(ntraj // batch_size)]
+        if ntraj % batch_size: batches.append(ntraj % batch_size)
+        tasks = [(seed + b, batches[b]) for b in range(len(batches))]
+
+        pops, fids = running_stats(), running_stats()
+        running = {'running_ntraj': [], 'running_populations': [], 'running_populations_err': [],
+                   'running_target_population': [], 'running_target_population_err': []}
+        def add_batch(expect): # (n_batch, n_e_ops, n_times) of one finished batch
+            pops.add(expect[:, :n_pops, :])
+            running['running_ntraj'].append(pops.n)
+            running['running_populations'].append(pops.mean[:, -1])
+            running['running_populations_err'].append(pops.err()[:, -1])
+            message = 'mc batch done: %d / %d trajectories' % (pops.n, ntraj)
+            if target is not None:
+                fids.add(expect[:, n_pops, -1])
+                running['running_target_population'].append(fids.mean)
+                running['running_target_population_err'].append(fids.err())
+                message += ', target population %.6f +- %.6f' % (fids.mean, fids.err())
+            logger.info(message)
+
+        if len(tasks) == 1:
+            add_batch(mc_batch(tasks[0][0], H, initial, t_list, self.c_ops, e_ops, tasks[0][1], nsteps))
+        else:
+            # like qutip's parallel_map, but every batch is accumulated as soon as it completes
+            lock = threading.Lock()
+            def on_done(expect):
+                with lock:
+                    add_batch(expect)
+            os.environ['QUTIP_IN_PARALLEL'] = 'TRUE'
+            pool = multiprocessing.Pool(processes = num_cpus)
+            try:
+                pending = [pool.apply_async(mc_batch_task, (task, H, initial, t_list, self.c_ops, e_ops, nsteps),
+                                            callback = on_done) for task in tasks]
+                for p in pending:
+                    p.get() # re-raises worker errors
+            finally:
+                pool.terminate()
+                pool.join()
+                os.environ['QUTIP_IN_PARALLEL'] = 'FALSE'
+
+        result = {'times' : t_list, 'ntraj' : pops.n, 'population_indices' : projector_indices(e_ops[:n_pops])}
+        result['populations'], result['populations_err'] = pops.mean.T, pops.err().T
+        result['running_ntraj'] = np.array(running['running_ntraj'])
+        result['running_populations'] = np.array(running['running_populations'])
+        result['running_populations_err'] = np.array(running['running_populations_err'])
+        if target is not None:
+            result['target_population'], result['target_population_err'] = fids.mean, fids.err()
+            result['running_target_population'] = np.array(running['running_target_population'])
+            result['running_target_population_err'] = np.array(running['running_target_population_err'])
+            for key in ['', 'running_']:
+                population, err = result[key + 'target_population'], result[key + 'target_population_err']
+                result[key + 'fidelity'] = np.sqrt(population)
+                result[key + 'fidelity_err'] = err / (2 * np.maximum(np.sqrt(population), 1e-12))
+            logger.info('mc fidelity: ' + str(result['fidelity']) + ' +- ' + str(result['fidelity_err']) + 
+                        ' (' + str(pops.n) + ' trajectories)')
+        self.mc_result = result
+        return result
+
+    @metrics.timed('mesolve', solver = 'pwc_solve')
+    def pwc_solve(self, initials, targets = None, store_states = False, compile = False, method = 'taylor'):
+        '''
+        Closed system evolution treating the pulse as piecewise constant over each 1 ns sample
+        (mcd.pwc_propagator) instead of mesolve; all initial states are propagated together
+
+        targets[i] is the target of initials[i] (defaults to the initial state)
+        Returns a structured array with fields 'index' and 'fidelity' like me_solve_many; the final
+        states are kept in self.final_states (and all states in self.pwc_states if store_states)
+        '''
+        if len(self.c_ops) > 0:
+            raise ValueError('pwc_solve is for closed systems, use me_solve / mc_solve with collapse operators')
+        if targets is None:
+            targets = initials
+        t_list = self.get_t_list()
+        self.pwc = pwc_propagator.from_qutip(self.build_hamiltonian(compile = compile), t_list, method = method)
+
+        if store_states:
+            finals, self.pwc_states = self.pwc.propagate(initials, store_states = True)
+        else:
+            finals = self.pwc.propagate(initials)
+        self.final_states = [Qobj(finals[:, i], dims = initials[i].dims) for i in range(len(initials))]
+
+        results = np.zeros(len(initials), dtype = [('index', int), ('fidelity', float)])
+        results['index'] = np.arange(len(initials))
+        results['fidelity'] = self.pwc.fidelities(initials, targets, finals = finals)
+        return results
+
     def dot(self, state1, state2):
         '''
         dotting both states
@@ -950,35 +1119,108 @@ class qutip_sim_multimode:
     
     def get_fidelity(self, target): 
         '''
-        dot final state after evolution with target
+        dot final state after evolution with target: |<target|psi>|^2 after a closed system (ket)
+        evolution, sqrt(<target|rho|target>) for a density matrix (mc_solve reports the same for the
+        trajectory averaged rho: 'fidelity' = sqrt('target_population'))
         '''
-        state = self.output.states[-1]
-        result = 0
-        
-        if (state.type == 'ket') and (target.type == 'ket'):
-            result = self.dot(state, target)
-        
-        elif (state.type == 'oper') and (target.type == 'ket'): #density matrix alert
-            target_rho= target*target.dag()
-            result = np.sqrt(self.dot(state, target_rho)) # Hilbert schmidt prod is enough, no need for squaring (try to do this for pure states and you'll get why sqrt used here)
-            
-        elif (state.type == 'oper') and (target.type == 'oper'): #density matrix alert
-            #target_rho= target*target.dag()
-            result = np.sqrt(self.dot(state, target_rho)) # Hilbert schmidt prod is enough, no need for squaring (try to do this for pure states and you'll get why sqrt used here)
-        
-        
-        return np.real(result) #result's imag [art should be 0
+        state = self.output.states[-1] if len(self.output.states) > 0 else self.output.final_state
+        return state_fidelity(state, target) #result's imag [art should be 0
+
+    @metrics.timed('mesolve', solver = 'me_solve_many')
+    def me_solve_many(self, initials, targets = None, num_cpus = None, nsteps = 10000, compile = False):
+        '''
+        Solves the master equation for several initial states of the same pulse in parallel
+
+        The Hamiltonian is built once and the initial states are fanned out over a process pool
+        (qutip parallel_map). targets[i] is the target of initials[i] (defaults to the initial state).
+
+        Returns a structured array with fields 'index' and 'fidelity'; the final states are kept in
+        self.final_states (same order as initials)
+        '''
+        if targets is None:
+            targets = initials
+        t_list = self.get_t_list()
+        H = self.build_hamiltonian(compile = compile)
+
+        tasks = [(i, initials[i], targets[i]) for i in range(len(initials))]
+        if len(tasks) == 1:
+            outputs = [solve_initial_state(tasks[0], H, t_list, self.c_ops, nsteps)]
+        else:
+            outputs = parallel_map(solve_initial_state, tasks, task_args = (H, t_list, self.c_ops, nsteps),
+                                   num_cpus = num_cpus)
+
+        results = np.zeros(len(tasks), dtype = [('index', int), ('fidelity', float)])
+        self.final_states = [None for _ in tasks]
+        for index, fidelity, final_state in outputs:
+            results[index] = (index, fidelity)
+            self.final_states[index] = final_state
+        return results
     
     
+    def basis_index(self, q_level, mode_levels = []):
+        '''
+        Flat index of |q, m_1, m_2, ...> in the qubit x modes Hilbert space
+        (modes not listed in mode_levels are taken to be in vacuum)
+        '''
+        levels = list(mode_levels) + [0 for _ in range(self.N_modes - len(mode_levels))]
+        return int(np.ravel_multi_index([q_level] + levels, [self.n_q] + [self.n_c for _ in range(self.N_modes)]))
+
+    def population_e_ops(self, indices = None):
+        '''
+        Projectors |k><k| on the bare basis states with flat indices k (all of them by default)
+
+        Pass these as e_ops to me_solve (with store_states = False) to record populations
+        during the integration instead of storing every state
+        '''
+        dim = self.n_q * (self.n_c ** self.N_modes)
+        dims = [[self.n_q] + [self.n_c for _ in range(self.N_modes)]] * 2
+        if indices is None:
+            indices = range(dim)
+        return [Qobj(fock_dm(dim, k).data, dims = dims) for k in indices]
+
+    def get_populations(self, indices = None, output = None):
+        '''
+        Populations of the bare basis states as an (n_times, n_basis) array
+
+        If me_solve recorded the projectors from population_e_ops, these are returned directly
+        (one column per output.population_indices), otherwise the stored states are stacked into one
+        array and |<k|psi>|^2 (or <k|rho|k>) is read off for every basis state at once. Raises
+        ValueError when there are no stored states and output.expect does not hold populations
+        (other e_ops, no e_ops or the record_ops recording mode)
+        indices : flat basis indices (see basis_index) of the columns to return, all if None
+        '''
+        if output is None:
+            output = self.output
+
+        if len(output.states) == 0: # recorded on the fly
+            columns = getattr(output, 'population_indices', None)
+            if columns is None:
+                raise ValueError('no stored states and output.expect does not hold populations: run me_solve '
+                                 'with store_states = True or e_ops = self.population_e_ops()')
+            pops = np.real(np.array(output.expect)).T
+        elif output.states[0].type == 'ket':
+            psis = np.array([state.full().ravel() for state in output.states])
+            pops = psis.real**2 + psis.imag**2
+            columns = np.arange(pops.shape[1])
+        else: # density matrices
+            pops = np.real(np.array([state.diag() for state in output.states]))
+            columns = np.arange(pops.shape[1])
+
+        if indices is None:
+            return pops
+        lookup = {k : i for i, k in enumerate(columns)}
+        return pops[:, [lookup[k] for k in indices]]
+
     def plot_populations_single_mode(self, figname = 'figure', title = None):
         '''
         Given output of mesolve, outputs populations with qubit as ground
         '''
+        import matplotlib.pyplot as plt
         
-        output_states = self.output.states
+        all_pops = self.get_populations()
         fig, axs = plt.subplots(self.n_q, 1, figsize=(10, 2 * (self.n_q + 1)))
         probs = []
-        times = [k/1000 for k in range(len(output_states))]
+        times = np.arange(all_pops.shape[0])/1000
         max_num_levels = self.n_c # to be shown on the plot
         pops_list = []
 
@@ -992,11 +1234,7 @@ class qutip_sim_multimode:
             for mode_level_index in range(max_num_levels): 
 
                 #target state
-                target = tensor(basis(self.n_q, q_state_index), basis(self.n_c, mode_level_index))
-                pops = []
-                for k in range(len(output_states)): 
-                    z = target.overlap(output_states[k])
-                    pops.append(z.real**2 + z.imag**2)
+                pops = all_pops[:, self.basis_index(q_state_index, [mode_level_index])]
                 axs[q_state_index].plot(times, pops, label = q_state_labels[q_state_index] + str(mode_level_index) +'>')
 
 
@@ -1027,11 +1265,12 @@ class qutip_sim_multimode:
         '''
         Given output of mesolve, outputs populations with qubit as ground
         '''
+        import matplotlib.pyplot as plt
         
-        output_states = self.output.states
+        all_pops = self.get_populations()
         fig, axs = plt.subplots(self.n_q, 1, figsize=(10, 2 * (self.n_q + 1)))
         probs = []
-        times = [k/1000 for k in range(len(output_states))]
+        times = np.arange(all_pops.shape[0])/1000
         max_num_levels = 2#self.n_c # to be shown on the plot
         pops_list = []
 
@@ -1045,13 +1284,7 @@ class qutip_sim_multimode:
             for mode_level_index1 in range(max_num_levels): 
                 for mode_level_index2 in range(max_num_levels): 
                     #target state
-                    target = tensor(basis(self.n_q, q_state_index), 
-                                    basis(self.n_c, mode_level_index1), 
-                                    basis(self.n_c, mode_level_index2))
-                    pops = []
-                    for k in range(len(output_states)): 
-                        z = target.overlap(output_states[k])
-                        pops.append(z.real**2 + z.imag**2)
+                    pops = all_pops[:, self.basis_index(q_state_index, [mode_level_index1, mode_level_index2])]
                     axs[q_state_index].plot(times, pops, 
                                             label = q_state_labels[q_state_index] + str(mode_level_index1) + ', ' + str(mode_level_index2) +'>')
 
@@ -1080,10 +1313,14 @@ class qutip_sim_multimode:
         return fig , pops_list
     
 
-    def plot_matrix(self, figname = 'figure', title = None):
+    def plot_matrix(self, figname = 'figure', title = None, use_propagator = False, n_chunks = 1, num_cpus = None):
         '''
         Computes the unitary matrix and shows as colorplot 
+
+        use_propagator : build the matrix from one propagator (compute_propagator, integrated over
+                         n_chunks parallel time chunks) instead of one me_solve per basis state
         '''
+        import matplotlib.pyplot as plt
         # Generate all the possible states 
         states = []
         labels = []
@@ -1093,7 +1330,8 @@ class qutip_sim_multimode:
         for q_state_index in range(self.n_q): 
             for m_state_index in range(self.n_c): 
 
-                state = tensor(basis(self.n_q, q_state_index), basis(self.n_c, m_state_index))
+                state = tensor([basis(self.n_q, q_state_index), basis(self.n_c, m_state_index)] +
+                               [basis(self.n_c, 0) for _ in range(1, self.N_modes)])
                 states.append(state)
                
                 #labels
@@ -1105,17 +1343,23 @@ class qutip_sim_multimode:
         
         # Now compute the matrix
         matrix = np.zeros(shape = (len(states), len(states)))
-        for i in range(len(states)): 
-
-            #act pulse on initial
-            initial_state = states[i]
-            self.me_solve(initial = initial_state)
-            final_state = self.output.states[-1]
-
-            #compute dot product with all other states
-            for t in range(len(states)): 
-                target_state = states[t]
-                matrix[i,t] = np.abs( final_state.overlap(target_state) )
+        if use_propagator:
+            self.compute_propagator(n_chunks = n_chunks, num_cpus = num_cpus)
+            for i in range(len(states)):
+                for t in range(len(states)):
+                    matrix[i,t] = np.sqrt(self.propagator_fidelity(states[i], states[t]))
+        else:
+            for i in range(len(states)): 
+
+                #act pulse on initial
+                initial_state = states[i]
+                self.me_solve(initial = initial_state)
+                final_state = self.output.states[-1]
+
+                #compute dot product with all other states
+                for t in range(len(states)): 
+                    target_state = states[t]
+                    matrix[i,t] = np.abs( final_state.overlap(target_state) )
             
 
             # plt.rcParams["figure.figsize"] = [7.50, 3.50]
@@ -1187,34 +1431,27 @@ class qutip_sim_multimode:
         '''
         Given output of mesolve, outputs populations with qubit as ground
         '''
+        import matplotlib.pyplot as plt
 #         if self.save_states:
 #             output_states = qload(self.states_filename)
-        output_states = self.output.states
+        all_pops = self.get_populations()
         
         
         fig, axs = plt.subplots(2,1, figsize=(10,8))
         probs = []
-        times = [k/1000 for k in range(len(output_states))]
+        times = np.arange(all_pops.shape[0])/1000
         max_num_levels = 5 # to be shown on the plot
         
         #qubit grounded
         for i in range(max_num_levels):
             for j in range(max_num_levels):
-                target = tensor(basis(self.n_q,0), basis(self.n_c, i), basis(self.n_c, j))
-                pops = []
-                for k in range(len(output_states)): 
-                    z = self.dot(target ,output_states[k])
-                    pops.append(z)
+                pops = all_pops[:, self.basis_index(0, [i, j])]
                 axs[0].plot(times, pops, label = '|g,'+str(i)+',' + str(j)+'>')
         
         #qubit excited
         for i in range(max_num_levels):
             for j in range(max_num_levels):
-                target = tensor(basis(self.n_q,1), basis(self.n_c, i), basis(self.n_c, j))
-                pops = []
-                for k in range(len(output_states)): 
-                    z = self.dot(target ,output_states[k])
-                    pops.append(z)
+                pops = all_pops[:, self.basis_index(1, [i, j])]
                 axs[1].plot(times, pops, linestyle = '--',  label = '|e,'+str(i)+',' + str(j)+'>')
                 
         axs[1].set_xlabel(r"Time ($\mu$s)", fontsize = 18)
@@ -1231,5 +1468,3 @@ class qutip_sim_multimode:
     #           ncol=3, fancybox=True, shadow=True)   
         axs[0].legend(loc='center left', bbox_to_anchor=(1, 0.5), fontsize = '15')
         axs[1].legend(loc='center left', bbox_to_anchor=(1, 0.5), fontsize = '15')
-
-print('hi')
\ No newline at end of file
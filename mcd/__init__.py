@@ -0,0 +1,42 @@
+'''
+Shared numerical engines for the multimode conditional displacement code
+(ECD simulation classes and circle GRAPE)
+
+The names below are imported from their submodules on first use (PEP 562), so importing mcd
+only costs numpy/scipy; tensorflow is only imported by get_operators(backend = 'tf').
+'''
+import importlib
+
+# eager: the submodule has the same name as the class, importing mcd.pwc_propagator would
+# otherwise replace the lazily bound class by the module
+from .pwc_propagator import pwc_propagator
+
+_exports = {
+    'get_operators': 'operators',
+    'split_operator_propagator': 'split_operator',
+    'native_grape': 'grape',
+    'minimal_search': 'search',
+    'resample_pulses': 'search',
+    'warm_start_circuit': 'search',
+    'run_sweep': 'sweep',
+    'load_config': 'sweep',
+    'run_graph': 'scheduler',
+    'run_suite': 'bench',
+    'get_logger': 'runtime',
+    'headless': 'runtime',
+    'set_headless': 'runtime',
+}
+
+__all__ = ['pwc_propagator'] + list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module 'mcd' has no attribute " + repr(name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
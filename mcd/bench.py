@@ -0,0 +1,382 @@
+'''
+CPU benchmark suite for the ECD optimizer, the pulse compiler and the simulators, with a history of
+the results to catch performance regressions
+
+    mcd bench                            # all benchmarks, appended to benchmarks/history.json
+    mcd bench --filter pulse --repeat 5  # the benchmarks with 'pulse' in their name
+    mcd bench --list
+
+    optimizer_step      BatchOptimizer Adam step vs N_cav, N_modes, N_multistart, N_blocks (and
+                        the adjoint gradients)
+    pulse_cd            conditional_displacement vs depth (CD gates of the first layers)
+    pulse_circuit       conditional_displacement_circuit vs depth
+    pulse_analytic_cd   analytic_CD_ef vs pulse length
+    sim_me_solve        qutip_sim_multimode.me_solve vs truncation (closed, and with qubit T1)
+    grape_iteration     circle GRAPE fidelity + gradient (one iteration) vs number of modes
+
+Benchmarks are asv style: a setup function of one parameter point (a dict) returns the call to time;
+the setup (optimizer construction, pulse compilation, ...) is not timed. The call runs once untimed
+(tensorflow tracing, caches) unless warmup = False, then repeat times; min and median are kept.
+
+Fixtures are the bundled data files (also the defaults of the parameters):
+    Echoed Conditional Displacements/Examples/data/ECD_control_test5.h5
+        ECD optimization, 2 modes, N_cav 5, 5 blocks, 4 multistarts, 2 level ancilla: optimizer
+        settings and states (embedded in the 3 level ancilla of BatchOptimizer), the best circuit
+        for the pulse compiler
+    Circle Grape/Examples/Data/00000_opt_data0.h5
+        circle GRAPE pulses, 3 transmon levels, 2 modes of 5 levels, 250 steps of 2 ns: the drive
+        of the GRAPE and simulator benchmarks
+
+Every run appends {time, commit, machine, results} to the history. A result is compared with the
+median of the last (window) results of the same benchmark and parameters on the same machine (host
+and platform); more than threshold slower is a regression (mcd bench exits with status 1).
+'''
+import os
+import json
+import time
+import socket
+import platform
+import functools
+import subprocess
+import numpy as np
+from .runtime import get_logger
+from . import stages
+
+logger = get_logger('bench')
+
+ecd_fixture = ('Echoed Conditional Displacements', 'Examples', 'data', 'ECD_control_test5.h5')
+cgrape_fixture = ('Circle Grape', 'Examples', 'Data', '00000_opt_data0.h5')
+chis = [0, -4.79148181e-05, -8.75366869e-05] # GHz, g/e/f of the first mode of qutip_sim_multimode
+alpha_CD = 30
+
+suite = {}
+
+
+def benchmark(params, repeat = 3, warmup = True):
+    '''
+    Registers setup(**point) for every point of params (list of dicts)
+    '''
+    def decorator(setup):
+        suite[setup.__name__] = {'setup': setup, 'params': params, 'repeat': repeat, 'warmup': warmup}
+        return setup
+    return decorator
+
+
+def axes(base, **values):
+    '''
+    Points varying one parameter of base at a time (base itself first)
+    '''
+    points = [dict(base)]
+    for key, vals in values.items():
+        for v in vals:
+            point = dict(base, **{key: v})
+            if point not in points:
+                points.append(point)
+    return points
+
+
+def fixture(parts):
+    filename = os.path.join(stages.repo_root(), *parts)
+    if not os.path.exists(filename):
+        raise FileNotFoundError(filename + ' not found (benchmark fixtures come with the source tree, set MCD_ROOT)')
+    return filename
+
+
+@functools.lru_cache(maxsize = None)
+def ecd_run():
+    '''
+    Settings, states and best circuit (betas, phis, thetas: N_modes x N_blocks) of the last
+    optimization in the ECD fixture
+    '''
+    import h5py
+    with h5py.File(fixture(ecd_fixture), 'r') as f:
+        group = f[list(f.keys())[-1]]
+        best = int(np.argmax(group['fidelities'][-1]))
+        return {'attrs': dict(group.attrs), 'initial_states': group['initial_states'][()],
+                'target_states': group['target_states'][()], 'betas': group['betas'][-1][best],
+                'phis': group['phis'][-1][best], 'thetas': group['thetas'][-1][best]}
+
+
+@functools.lru_cache(maxsize = None)
+def cgrape_run():
+    import h5py
+    with h5py.File(fixture(cgrape_fixture), 'r') as f:
+        return {'uks': np.array(f['uks'][-1], dtype = float), 'total_time': float(f['total_time'][()]),
+                'steps': int(f['steps'][()])}
+
+
+@functools.lru_cache(maxsize = None)
+def pulse_system():
+    '''
+    MECD_PulseV5 and the storage / qubit of ecd_pulse_multimode's defaults
+    '''
+    stages.import_classes('ecd')
+    import MECD_PulseV5
+    storage = MECD_PulseV5.FakeStorage(chi_kHz = 1e+6 * np.array(chis), chi_prime_Hz = np.zeros(3), Ks_Hz = 0,
+                                       epsilon_m_MHz = 400, unit_amp = 0.01, sigma = 11, chop = 4)
+    qubit = MECD_PulseV5.FakeQubit(unit_amp = 0.5, sigma = 6, chop = 4)
+    return MECD_PulseV5, storage, qubit
+
+
+@functools.lru_cache(maxsize = None)
+def cd_pulse():
+    '''
+    Cavity and qubit pulse of the first ef CD gate (beta/2) of the ECD fixture circuit
+    '''
+    P, storage, qubit = pulse_system()
+    e_cd, o_cd, alpha, tw = P.conditional_displacement(ecd_run()['betas'][0][0] / 2, alpha = alpha_CD, storage = storage,
+                                                       qubit = qubit, version = 'ef', kappa = 0)
+    return e_cd, o_cd
+
+
+#----------------------------------------------------------------------------------------------
+# benchmarks
+#----------------------------------------------------------------------------------------------
+
+@benchmark(axes(dict(N_cav = 5, N_modes = 2, N_multistart = 4, N_blocks = 5, gradient_backend = 'autodiff'),
+                N_cav = [3, 8], N_modes = [1, 3], N_multistart = [1, 16], N_blocks = [2, 10],
+                gradient_backend = ['adjoint']), repeat = 5)
+def optimizer_step(N_cav, N_modes, N_multistart, N_blocks, gradient_backend):
+    '''
+    One Adam step of BatchOptimizer (fidelities, gradients and update) with a 3 level ancilla (ge and
+    ef rotations), settings of the ECD fixture; its (2 level ancilla) states embedded for N_cav 5,
+    N_modes 2, else |g,0,0,..> -> |g,1,0,..>
+    '''
+    import tensorflow as tf
+    from qutip import Qobj, tensor, basis
+    stages.import_classes('ecd')
+    from MECD_paramV2 import BatchOptimizer
+    run = ecd_run()
+    dims = [3] + [N_cav for _ in range(N_modes)]
+    if dims == [3, 5, 5]:
+        embed = lambda s: Qobj(np.concatenate([s, np.zeros((25, 1))]), dims = [dims, [1, 1, 1]]) # f level empty
+        initial = [embed(s) for s in run['initial_states']]
+        target = [embed(s) for s in run['target_states']]
+    else:
+        initial = [tensor([basis(3, 0)] + [basis(N_cav, 0) for _ in range(N_modes)])]
+        target = [tensor([basis(3, 0), basis(N_cav, 1)] + [basis(N_cav, 0) for _ in range(N_modes - 1)])]
+    opt = BatchOptimizer(N_cav = N_cav, N_modes = N_modes, N_multistart = N_multistart, N_blocks = N_blocks,
+                         N_ancilla_levels = 3, N_single_layer = 2, initial_states = initial, target_states = target,
+                         BCH_approx = bool(run['attrs']['BCH_approx']), beta_scale = float(run['attrs']['beta_scale']),
+                         learning_rate = float(run['attrs']['learning_rate']), gradient_backend = gradient_backend)
+    optimizer = tf.optimizers.Adam(opt.parameters['learning_rate'])
+    variables = opt._optimization_variables()
+    return lambda: opt._train_step(optimizer, variables).numpy()
+
+
+@benchmark([{'depth': d} for d in [1, 2, 3]], repeat = 1, warmup = False)
+def pulse_cd(depth):
+    '''
+    conditional_displacement (ef) of the CD gates beta/2 of the first depth layers of the ECD fixture
+    circuit (first mode)
+    '''
+    P, storage, qubit = pulse_system()
+    betas = ecd_run()['betas'][0][:depth]
+    def run():
+        for beta in betas:
+            P.conditional_displacement(beta / 2, alpha = alpha_CD, storage = storage, qubit = qubit,
+                                       version = 'ef', kappa = 0)
+    return run
+
+
+@benchmark([{'depth': d} for d in [1, 2, 3]], repeat = 1, warmup = False)
+def pulse_circuit(depth):
+    '''
+    conditional_displacement_circuit of the first depth layers of the ECD fixture circuit (ge
+    rotations of the fixture, no ef rotations)
+    '''
+    P, storage, qubit = pulse_system()
+    run = ecd_run()
+    betas = run['betas'][:, :depth]
+    phis = np.stack([run['phis'][:, :depth], np.zeros(betas.shape)], axis = -1)
+    thetas = np.stack([run['thetas'][:, :depth], np.zeros(betas.shape)], axis = -1)
+    N_modes = len(betas)
+    return lambda: P.conditional_displacement_circuit(betas, phis, thetas, [storage for _ in range(N_modes)], qubit,
+                                                      alpha_CD = alpha_CD, kappa = [0 for _ in range(N_modes)])
+
+
+@benchmark([{'length': n} for n in [250, 500, 1000, 2000]], warmup = False)
+def pulse_analytic_cd(length):
+    '''
+    analytic_CD_ef of the first CD pulse of the ECD fixture, padded with zeros to length ns
+    '''
+    P, storage, qubit = pulse_system()
+    e_cd, o_cd = cd_pulse()
+    pad = (0, max(0, length - len(e_cd)))
+    epsilon = -1j * 2 * np.pi * 1e-3 * storage.epsilon_m_MHz * np.pad(e_cd, pad)
+    Omega = np.pad(o_cd, pad)
+    return lambda: P.analytic_CD_ef(epsilon, Omega, 2 * np.pi * 1e-6 * storage.chi_kHz)
+
+
+@benchmark([{'n_c': n, 'T1': T1} for T1 in [None, 30e+3] for n in [3, 4, 5, 6]], warmup = False)
+def sim_me_solve(n_c, T1):
+    '''
+    qutip_sim_multimode.me_solve of the circle GRAPE fixture pulses, 3 transmon levels and 2 modes of
+    n_c levels: sesolve, or mesolve with qubit relaxation T1
+    '''
+    from qutip import tensor, basis
+    stages.import_classes('ecd')
+    from Simulation_Classes_Multimode_V12 import qutip_sim_multimode
+    sim = qutip_sim_multimode(3, n_c, 2, method = 'cgrape', version = 'ge', filename = fixture(cgrape_fixture),
+                              plot_pulses = False)
+    sim.initialize_ECD_and_qubit_drive()
+    if T1 is not None:
+        sim.add_qubit_relaxation(T1 = T1)
+    initial = tensor(basis(3, 0), basis(n_c, 0), basis(n_c, 0))
+    return lambda: sim.me_solve(initial = initial, store_states = False)
+
+
+@benchmark([{'modes': m, 'propagator': 'exact'} for m in [1, 2]] + # 3 modes: ~1 min per call
+           [{'modes': m, 'propagator': 'split'} for m in [1, 2, 3]])
+def grape_iteration(modes, propagator):
+    '''
+    Fidelity and gradient (the cost of one native GRAPE iteration) of the circle GRAPE fixture
+    pulses, 3 transmon levels and modes modes of 5 levels, |g,0,..> -> |g,1,0,..>
+    '''
+    from .grape import exact_fidelity_and_gradient
+    from .split_operator import split_operator_propagator
+    stages.import_classes('cgrape')
+    from circle_grape_v5 import multimode_circle_grape_optimal_control
+    run = cgrape_run()
+    hparams = {'chis_e': [chis[1] for _ in range(modes)], 'chis_f': [chis[2] for _ in range(modes)],
+               'kappas': [0 for _ in range(modes)], 'alpha': alpha_CD, 'delta_c': 0.005}
+    op = multimode_circle_grape_optimal_control(5, modes, hparams, 3, False)
+    H0, Hops = op.H_rot(), np.array(op.controlHs(), dtype = complex)
+    basis = np.eye(len(H0))
+    initials = basis[:, [stages.cgrape_index([0], op)]]
+    targets = basis[:, [stages.cgrape_index([0, 1], op)]]
+    dt = run['total_time'] / run['steps']
+    if propagator == 'split':
+        split = split_operator_propagator.from_full(H0, Hops, dt, op.qnum)
+        return lambda: split.fidelity_and_gradient(initials, targets, run['uks'])
+    return lambda: exact_fidelity_and_gradient(H0, Hops, dt, run['uks'], initials, targets)
+
+
+#----------------------------------------------------------------------------------------------
+# runs and history
+#----------------------------------------------------------------------------------------------
+
+def machine():
+    from importlib import metadata
+    packages = {}
+    for name in ['numpy', 'scipy', 'qutip', 'tensorflow', 'tensorflow-cpu', 'h5py']:
+        try:
+            packages[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            pass
+    return {'host': socket.gethostname(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpus': os.cpu_count(), 'python': platform.python_version(), 'packages': packages}
+
+
+def commit():
+    '''
+    Short hash of the checked out commit ('+' if there are local changes), None outside git
+    '''
+    try:
+        run = lambda *args: subprocess.run(['git'] + list(args), cwd = stages.repo_root(), capture_output = True,
+                                           text = True, check = True).stdout.strip()
+        return run('rev-parse', '--short', 'HEAD') + ('+' if run('status', '--porcelain', '--untracked-files=no') else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case(result):
+    return result['name'] + ' ' + json.dumps(result['params'], sort_keys = True)
+
+
+def run_benchmark(name, point, repeat = None):
+    '''
+    {'name', 'params', 'min', 'median', 'first' (warm up call), 'repeat'}, or with 'error' if it failed
+    '''
+    spec = suite[name]
+    repeat = repeat or spec['repeat']
+    result = {'name': name, 'params': point, 'repeat': repeat}
+    try:
+        call = spec['setup'](**point)
+        if spec['warmup']:
+            start = time.perf_counter()
+            call()
+            result['first'] = time.perf_counter() - start
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call()
+            times.append(time.perf_counter() - start)
+    except Exception as e:
+        logger.warning('%s failed: %s: %s' % (case(result), type(e).__name__, str(e)))
+        result['error'] = '%s: %s' % (type(e).__name__, str(e))
+        return result
+    result.update(min = min(times), median = float(np.median(times)))
+    logger.info('%s: %.4g s' % (case(result), result['min']))
+    return result
+
+
+def default_history():
+    return os.path.join(stages.repo_root(), 'benchmarks', 'history.json')
+
+
+def load_history(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_history(filename, history):
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok = True)
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(history, f, indent = 1)
+    os.replace(tmp, filename)
+
+
+def compare(history, run, threshold = 0.25, window = 5):
+    '''
+    Per result of run: baseline = median of the minimum times of the last window earlier results on
+    the same machine (host and platform), ratio = min / baseline, regression if ratio > 1 + threshold
+    '''
+    same = [r for r in history if r['machine']['host'] == run['machine']['host']
+            and r['machine']['platform'] == run['machine']['platform']]
+    rows = []
+    for result in run['results']:
+        earlier = [r['min'] for old in same for r in old['results'] if case(r) == case(result) and 'min' in r]
+        row = {'case': case(result), 'min': result.get('min'), 'baseline': None, 'ratio': None,
+               'regression': False, 'error': result.get('error')}
+        if earlier and 'min' in result:
+            row['baseline'] = float(np.median(earlier[-window:]))
+            row['ratio'] = result['min'] / row['baseline']
+            row['regression'] = row['ratio'] > 1 + threshold
+        rows.append(row)
+    return rows
+
+
+def report(rows):
+    width = max([len(row['case']) for row in rows] + [9])
+    print('%-*s %11s %11s %7s' % (width, 'benchmark', 'min (s)', 'baseline', 'ratio'))
+    for row in rows:
+        if row['error']:
+            print('%-*s %s' % (width, row['case'], 'failed: ' + row['error']))
+            continue
+        print('%-*s %11.4g %11s %7s%s' % (width, row['case'], row['min'],
+              '-' if row['baseline'] is None else '%.4g' % row['baseline'],
+              '-' if row['ratio'] is None else '%.2f' % row['ratio'], '  REGRESSION' if row['regression'] else ''))
+
+
+def run_suite(names = None, repeat = None, history = None, threshold = 0.25, window = 5, save = True):
+    '''
+    Runs the benchmarks names (default all), compares them with the history file (default
+    benchmarks/history.json of the repository) and appends the run to it if save
+    Returns (run, comparison rows)
+    '''
+    history = history or default_history()
+    names = names or list(suite)
+    run = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit(), 'machine': machine(), 'results': []}
+    for name in names:
+        for point in suite[name]['params']:
+            run['results'].append(run_benchmark(name, point, repeat = repeat))
+    past = load_history(history)
+    rows = compare(past, run, threshold = threshold, window = window)
+    if save:
+        save_history(history, past + [run])
+        logger.info('results appended to ' + history)
+    return run, rows
@@ -0,0 +1,97 @@
+'''
+mcd command line (installed by pip install -e . as the mcd script, or python -m mcd.cli)
+
+    mcd optimize --config sweep.yaml      # optimize stage of every task of the grid
+    mcd compile  --config sweep.yaml      # parameters / GRAPE files -> pulses (needs optimize)
+    mcd verify   --config sweep.yaml      # simulate the pulses (needs optimize)
+    mcd sweep    --config sweep.yaml      # all stages of the config (default optimize, compile, verify)
+    mcd merge    --config sweep.yaml      # only rewrite results.csv from the task records
+    mcd worker   --config sweep.yaml      # serve the job queue of a running sweep (mcd.scheduler)
+    mcd bench    [--filter pulse]         # benchmark suite with history (mcd.bench)
+
+Options: --workers N, --set key=value (dotted keys, values parsed as YAML/JSON, e.g.
+--set optimize.steps=400 --set grid.optimize.total_time=[500,1000]), --restart (ignore the records
+of earlier runs instead of resuming). See mcd.sweep for the config file.
+'''
+import sys
+import json
+import argparse
+from .runtime import set_headless
+from .sweep import load_config, set_dotted, run_sweep, merge_results
+from .scheduler import worker_loop
+
+
+def parse_value(text):
+    try:
+        import yaml
+        return yaml.safe_load(text)
+    except ImportError:
+        pass
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parser():
+    p = argparse.ArgumentParser(prog = 'mcd', description = 'ECD / circle GRAPE optimization, pulse compilation and verification sweeps')
+    sub = p.add_subparsers(dest = 'command')
+    sub.required = True
+    for command in ['optimize', 'compile', 'verify', 'sweep', 'merge', 'worker']:
+        c = sub.add_parser(command)
+        c.add_argument('--config', required = True, help = 'sweep config (.yaml or .json)')
+        c.add_argument('--set', action = 'append', default = [], metavar = 'KEY=VALUE', help = 'override a config value')
+        c.add_argument('--workers', type = int, default = None, help = 'process pool size')
+        c.add_argument('--restart', action = 'store_true', help = 'rerun every task instead of resuming')
+        if command == 'worker':
+            c.add_argument('--stages', default = None, help = 'comma separated stages this worker runs (default all)')
+    c = sub.add_parser('bench')
+    c.add_argument('--filter', action = 'append', default = [], help = 'run the benchmarks whose name contains this')
+    c.add_argument('--repeat', type = int, default = None, help = 'timed calls per benchmark (default per benchmark)')
+    c.add_argument('--history', default = None, help = 'history file (default benchmarks/history.json)')
+    c.add_argument('--threshold', type = float, default = 0.25, help = 'slowdown counted as a regression (0.25 = 25%%)')
+    c.add_argument('--no-save', action = 'store_true', help = 'do not append this run to the history')
+    c.add_argument('--list', action = 'store_true', help = 'list the benchmarks and their parameters')
+    return p
+
+
+def run_bench(args):
+    from . import bench
+    names = [n for n in bench.suite if not args.filter or any(f in n for f in args.filter)]
+    if args.list:
+        for name in names:
+            print(name + ': ' + ', '.join(json.dumps(p, sort_keys = True) for p in bench.suite[name]['params']))
+        return 0
+    run, rows = bench.run_suite(names, repeat = args.repeat, history = args.history, threshold = args.threshold,
+                                save = not args.no_save)
+    bench.report(rows)
+    return 1 if any(row['regression'] or row['error'] for row in rows) else 0
+
+
+def main(argv = None):
+    args = parser().parse_args(argv)
+    set_headless(True)
+    if args.command == 'bench':
+        return run_bench(args)
+    config = load_config(args.config)
+    for item in args.set:
+        key, _, value = item.partition('=')
+        if key.startswith('grid.'): # grid keys are dotted themselves
+            config.setdefault('grid', {})[key[len('grid.'):]] = parse_value(value)
+        else:
+            set_dotted(config, key, parse_value(value))
+
+    if args.command == 'merge':
+        merge_results(config['output'])
+        return 0
+    if args.command == 'worker':
+        worker_loop(config['output'], stages = args.stages.split(',') if args.stages else None)
+        return 0
+    stages = None if args.command == 'sweep' else [args.command]
+    records = run_sweep(config, stages = stages, workers = args.workers, resume = not args.restart)
+    failed = [r for r in records if r is None or any(s['status'] == 'failed' for s in r['stages'].values())]
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+'''
+Native (numpy/scipy) GRAPE for state transfer with piecewise constant controls
+
+Drop-in CPU replacement for quantum_optimal_control.Grape in circle GRAPE (state transfer only):
+
+    H(t) = H0 + sum_j u_j[k] Hops[j]  on step k (dt = total_time/steps)
+    error = 1 - |mean_s <target_s|U psi0_s>|^2 (+ regularization)
+
+The amplitudes are optimized with L-BFGS-B inside the bounds |u_j| <= maxA_j, with exact gradients:
+propagator = 'exact' diagonalizes every step Hamiltonian (propagator derivatives from the
+eigendecomposition, O(steps d^3)); propagator = 'split' uses the split operator propagator of
+mcd.split_operator for transmon only controls (O(steps d^2), n_sub Trotter substeps per step).
+
+reg_coeffs : 'dwdt'   * sum_jk (u_j[k+1] - u_j[k])^2 / maxA_j^2 / steps
+             'd2wdt2' * sum_jk (u_j[k+2] - 2 u_j[k+1] + u_j[k])^2 / maxA_j^2 / steps
+             (the other quantum_optimal_control penalties, e.g. forbidden states, are not implemented:
+             their keys are ignored with a warning)
+convergence: 'max_iterations' (L-BFGS-B iterations), 'conv_target' (stop when error < conv_target),
+             'update_step' (iterations between saved snapshots)
+
+The data file has the same keys as the quantum_optimal_control ones (uks, error, reg_error,
+iteration, run_time, total_time, steps, Hops, Hnames, H0, U, maxA, convergence, reg_coeffs,
+inter_vecs_*), so return_pulses/plot_optimal_control work unchanged.
+'''
+import os
+import time
+import numpy as np
+import h5py
+from scipy.optimize import minimize
+from .split_operator import split_operator_propagator
+from .runtime import get_logger
+from . import metrics
+
+logger = get_logger('grape')
+
+
+supported_reg_coeffs = ['dwdt', 'd2wdt2']
+
+
+class converged(Exception):
+    pass
+
+
+def step_eigh(H0, Hops, amplitudes, k):
+    '''
+    eigendecomposition of the Hamiltonian of step k
+    '''
+    return np.linalg.eigh(H0 + np.einsum('j,jab->ab', amplitudes[:, k], Hops))
+
+
+def exact_propagate(H0, Hops, dt, amplitudes, initials, store_states = False):
+    '''
+    Final states (and, if store_states, the states after every step) of the piecewise constant evolution
+    '''
+    states = np.array(initials, dtype = complex)
+    stored = [states] if store_states else None
+    for k in range(amplitudes.shape[1]):
+        evals, W = step_eigh(H0, Hops, amplitudes, k)
+        states = W @ (np.exp(-1j * dt * evals)[:, None] * (np.conjugate(W.T) @ states))
+        if store_states:
+            stored.append(states)
+    if store_states:
+        return states, np.array(stored)
+    return states
+
+
+def exact_fidelity_and_gradient(H0, Hops, dt, amplitudes, initials, targets):
+    '''
+    |mean_s <target_s|U psi0_s>|^2 and its gradient with respect to the amplitudes (n_controls, steps)
+
+    Forward sweep for the final states, then a backward sweep of states and targets through the
+    inverse steps (memory O(d n_states)); on each step
+    <chi|dU/du_j|psi> = sum_cd Hops[j]_cd (W (Gamma o X)^T W^dag)_dc with X_ab = sum_s conj(chi_a) psi_b
+    in the eigenbasis W of the step Hamiltonian (Daleckii-Krein)
+    '''
+    states = exact_propagate(H0, Hops, dt, amplitudes, initials)
+    chis = np.array(targets, dtype = complex)
+    n = chis.shape[1]
+    overlap = np.mean(np.sum(np.conjugate(chis) * states, axis = 0))
+    doverlap = np.zeros(amplitudes.shape, dtype = complex)
+    for k in reversed(range(amplitudes.shape[1])):
+        evals, W = step_eigh(H0, Hops, amplitudes, k)
+        f = np.exp(-1j * dt * evals)
+        W_dag = np.conjugate(W.T)
+        psi_in = np.conjugate(f)[:, None] * (W_dag @ states) # eigenbasis
+        chi_out = W_dag @ chis
+        diff = evals[:, None] - evals[None, :]
+        degenerate = np.abs(diff) < 1e-12
+        Gamma = np.where(degenerate, -1j * dt * f[:, None], (f[:, None] - f[None, :]) / np.where(degenerate, 1, diff))
+        X = Gamma * (np.conjugate(chi_out) @ psi_in.T)
+        Y = W @ X.T @ W_dag
+        doverlap[:, k] = np.einsum('jcd,dc->j', Hops, Y)
+        states = W @ psi_in
+        chis = W @ (np.conjugate(f)[:, None] * chi_out)
+    doverlap = doverlap / n
+    return np.abs(overlap)**2, 2 * np.real(np.conjugate(overlap) * doverlap)
+
+
+def regularization(amplitudes, maxA, reg_coeffs):
+    '''
+    dwdt / d2wdt2 penalties on the amplitudes (relative to maxA) and their gradient
+    '''
+    steps = amplitudes.shape[1]
+    x = amplitudes / maxA[:, None]
+    reg, grad = 0.0, np.zeros_like(x)
+    coeff = reg_coeffs.get('dwdt', 0)
+    if coeff and steps > 1:
+        d = np.diff(x, axis = 1)
+        reg += coeff * np.sum(d**2) / steps
+        grad[:, 1:] += 2 * coeff * d / steps
+        grad[:, :-1] -= 2 * coeff * d / steps
+    coeff = reg_coeffs.get('d2wdt2', 0)
+    if coeff and steps > 2:
+        d2 = np.diff(x, n = 2, axis = 1)
+        reg += coeff * np.sum(d2**2) / steps
+        grad[:, 2:] += 2 * coeff * d2 / steps
+        grad[:, 1:-1] -= 4 * coeff * d2 / steps
+        grad[:, :-2] += 2 * coeff * d2 / steps
+    return reg, grad / maxA[:, None]
+
+
+def next_filename(data_path, file_name):
+    '''
+    data_path/NNNNN_file_name.h5 with the first unused index (quantum_optimal_control convention)
+    '''
+    ii = 0
+    while os.path.exists(os.path.join(data_path, '%05d_%s.h5' % (ii, file_name))):
+        ii += 1
+    return os.path.join(data_path, '%05d_%s.h5' % (ii, file_name))
+
+
+def native_grape(H0, Hops, Hnames, U, total_time, steps, psi0, convergence = {}, reg_coeffs = {},
+                 maxA = None, initial_guess = None, file_name = 'test', data_path = '.', save = True,
+                 propagator = 'exact', qnum = None, n_sub = 1):
+    '''
+    State transfer GRAPE psi0[s] -> U[s] (lists of d dimensional vectors), see module docstring
+
+    Returns (uks, final states (d, n_states), filename); filename is None if save is False
+    '''
+    H0 = np.asarray(H0, dtype = complex)
+    Hops = np.array([np.asarray(Hop, dtype = complex) for Hop in Hops])
+    n_ctrl = len(Hops)
+    dt = float(total_time) / steps
+    maxA = np.ones(n_ctrl) * np.inf if maxA is None else np.array(maxA, dtype = float)
+    initials = np.array(psi0, dtype = complex).T
+    targets = np.array(U, dtype = complex).T
+    conv = {'update_step': 10, 'max_iterations': 1000, 'conv_target': 1e-8}
+    conv.update(convergence)
+    ignored = sorted(key for key in reg_coeffs if key not in supported_reg_coeffs)
+    if ignored:
+        logger.warning('reg_coeffs %s are not supported by native_grape and are ignored (supported: %s)'
+                       % (', '.join(ignored), ', '.join(supported_reg_coeffs)))
+
+    if propagator == 'split':
+        split = split_operator_propagator.from_full(H0, Hops, dt, qnum, n_sub = n_sub)
+        fidelity_and_gradient = lambda u: split.fidelity_and_gradient(initials, targets, u)
+    elif propagator == 'exact':
+        fidelity_and_gradient = lambda u: exact_fidelity_and_gradient(H0, Hops, dt, u, initials, targets)
+    else:
+        raise ValueError("propagator must be 'exact' or 'split', not " + str(propagator))
+
+    # optimize x = u / maxA in [-1, 1] (u itself if there is no bound)
+    scale = np.where(np.isfinite(maxA), maxA, 1.0)
+    if initial_guess is not None:
+        x0 = np.array(initial_guess, dtype = float).reshape(n_ctrl, steps) / scale[:, None]
+    else:
+        x0 = np.random.uniform(-0.1, 0.1, size = (n_ctrl, steps))
+    bounds = [(-1, 1) if np.isfinite(a) else (None, None) for a in maxA for _ in range(steps)]
+
+    history = {'uks': [], 'error': [], 'reg_error': [], 'iteration': [], 'run_time': []}
+    last = {}
+    start = time.time()
+
+    def cost(x):
+        u = x.reshape(n_ctrl, steps) * scale[:, None]
+        with metrics.timer('grape.fidelity_and_gradient', detail = False, propagator = propagator):
+            fid, dfid = fidelity_and_gradient(u)
+        reg, dreg = regularization(u, scale, reg_coeffs)
+        last['x'], last['error'], last['reg'] = x.copy(), 1 - fid, reg
+        return 1 - fid + reg, ((dreg - dfid) * scale[:, None]).ravel()
+
+    def snapshot(iteration):
+        history['uks'].append(last['x'].reshape(n_ctrl, steps) * scale[:, None])
+        history['error'].append(last['error'])
+        history['reg_error'].append(last['reg'])
+        history['iteration'].append(iteration)
+        history['run_time'].append(time.time() - start)
+        logger.info('Iteration %d: error = %.3e, reg_error = %.3e, run time = %.1f s'
+                    % (iteration, last['error'], last['reg'], time.time() - start))
+
+    iteration = [0]
+    accepted = {'x': x0.ravel()} # last iterate of L-BFGS-B (cost also sees rejected line search points)
+    def callback(x):
+        iteration[0] += 1
+        accepted['x'] = x.copy()
+        metrics.count('grape.iterations')
+        if not np.array_equal(x, last['x']):
+            cost(x)
+        if iteration[0] % conv['update_step'] == 0:
+            snapshot(iteration[0])
+        if last['error'] < conv['conv_target']:
+            raise converged
+
+    cost(x0.ravel())
+    snapshot(0)
+    try:
+        res = minimize(cost, x0.ravel(), jac = True, method = 'L-BFGS-B', bounds = bounds, callback = callback,
+                       options = {'maxiter': conv['max_iterations'], 'ftol': 1e-15, 'gtol': 1e-12})
+        accepted['x'] = res.x
+        logger.info('L-BFGS-B stopped: ' + str(res.message))
+    except converged:
+        logger.info('Target error reached')
+    except KeyboardInterrupt:
+        logger.warning('Optimization stopped on keyboard interrupt')
+    if not history['iteration'] or history['iteration'][-1] != iteration[0]:
+        if not np.array_equal(accepted['x'], last['x']):
+            cost(accepted['x'])
+        snapshot(iteration[0])
+
+    uks = history['uks'][-1]
+    finals, inter_vecs = exact_propagate(H0, Hops, dt, uks, initials, store_states = True)
+    exact_error = 1 - np.abs(np.mean(np.sum(np.conjugate(targets) * finals, axis = 0)))**2
+    if propagator == 'split':
+        logger.info('error of the split operator pulse with exact steps: %.3e' % exact_error)
+
+    if not save:
+        return uks, finals, None
+    filename = next_filename(data_path, file_name)
+    with metrics.timer('hdf5.write', writer = 'grape'), h5py.File(filename, 'w') as f:
+        for key, value in history.items():
+            f.create_dataset(key, data = np.array(value))
+        f.create_dataset('total_time', data = total_time)
+        f.create_dataset('steps', data = steps)
+        f.create_dataset('H0', data = H0)
+        f.create_dataset('Hops', data = Hops)
+        f.create_dataset('Hnames', data = np.array(Hnames, dtype = 'S'))
+        f.create_dataset('U', data = targets.T)
+        f.create_dataset('initial_vectors_c', data = initials.T)
+        f.create_dataset('states_concerned_list', data = initials.T)
+        f.create_dataset('maxA', data = maxA)
+        f.create_dataset('method', data = np.bytes_('L-BFGS-B ' + propagator))
+        f.create_dataset('exact_error', data = exact_error)
+        f.create_dataset('wall_clock_time', data = time.time() - start)
+        grp = f.create_group('convergence')
+        for key, value in conv.items():
+            grp.create_dataset(key, data = value)
+        grp = f.create_group('reg_coeffs')
+        for key, value in reg_coeffs.items():
+            grp.create_dataset(key, data = value)
+        # states along the final pulse, (1, n_states, d, steps + 1)
+        inter_vecs = np.transpose(inter_vecs, (2, 1, 0))[None]
+        f.create_dataset('inter_vecs_real', data = np.real(inter_vecs))
+        f.create_dataset('inter_vecs_imag', data = np.imag(inter_vecs))
+        f.create_dataset('inter_vecs_mag_squared', data = np.abs(inter_vecs)**2)
+    logger.info('data saved as: ' + filename)
+    metrics.flush()
+    return uks, finals, filename
@@ -0,0 +1,193 @@
+'''
+Performance instrumentation (timers, counters, peak memory) for the long running stages
+
+Off unless MCD_METRICS is set (or configure() is called); then
+
+    MCD_METRICS=run.jsonl  JSON lines, appended: one 'timer' line per timed call (duration, process
+                           peak RSS), 'summary' lines (count, total, min, max per timer and label set,
+                           counter totals, peak RSS and GPU memory) on flush()
+    MCD_METRICS=run.prom   Prometheus textfile (node exporter textfile collector), rewritten on
+                           flush(): mcd_<name>_seconds_{count,sum,max}, mcd_<name>_total, mcd_peak_rss_bytes
+
+'{pid}' in the name gives every process its own file (sweep workers). Lines carry host, pid and
+SLURM_JOB_ID, so peak_rss_bytes / the timer sums size --mem and --time requests.
+
+    with timer('mesolve', solver = 'sesolve'): ...     # context manager
+    @timed('pulse.conditional_displacement')           # decorator
+    timer(..., detail = False)                         # aggregate only, for per step timers
+    count('optimizer.adam_steps', n)
+
+flush() runs at exit; call it at the end of a run (and e.g. once per epoch) for up to date files.
+'''
+import os
+import sys
+import json
+import time
+import atexit
+import socket
+import resource
+import functools
+import contextlib
+
+_state = {'path': None, 'format': None, 'timers': {}, 'counters': {}}
+
+
+def configure(path = None, format = None):
+    '''
+    Writes metrics to path (format 'jsonl' or 'prom', default from the suffix); path None switches off
+    '''
+    if path is not None:
+        path = path.replace('{pid}', str(os.getpid()))
+        format = format or ('prom' if path.endswith('.prom') else 'jsonl')
+    _state.update(path = path, format = format)
+
+
+def enabled():
+    return _state['path'] is not None
+
+
+def peak_rss_bytes():
+    '''
+    Peak resident memory of this process (ru_maxrss is in kB on Linux, bytes on macOS)
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else 1024 * peak
+
+
+def gpu_peak_bytes():
+    '''
+    Peak tensorflow memory of the first GPU, None without tensorflow (already imported) or GPU
+    '''
+    if 'tensorflow' not in sys.modules:
+        return None
+    tf = sys.modules['tensorflow']
+    try:
+        if not tf.config.list_physical_devices('GPU'):
+            return None
+        return int(tf.config.experimental.get_memory_info('GPU:0')['peak'])
+    except (AttributeError, ValueError, RuntimeError):
+        return None
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _emit(line):
+    if _state['format'] != 'jsonl':
+        return None
+    line.update(time = time.time(), host = socket.gethostname(), pid = os.getpid())
+    if 'SLURM_JOB_ID' in os.environ:
+        line['slurm_job_id'] = os.environ['SLURM_JOB_ID']
+    with open(_state['path'], 'a') as f:
+        f.write(json.dumps(line, default = str) + '\n')
+
+
+def record(name, seconds, detail = True, **labels):
+    '''
+    Adds one timing of name (labels: str/int values) to the aggregates (and the JSON lines if detail)
+    '''
+    if not enabled():
+        return None
+    agg = _state['timers'].setdefault(_key(name, labels), {'count': 0, 'sum': 0., 'min': float('inf'), 'max': 0.})
+    agg['count'] += 1
+    agg['sum'] += seconds
+    agg['min'] = min(agg['min'], seconds)
+    agg['max'] = max(agg['max'], seconds)
+    if detail:
+        _emit(dict(type = 'timer', name = name, seconds = seconds, peak_rss_bytes = peak_rss_bytes(), labels = labels))
+
+
+@contextlib.contextmanager
+def timer(name, detail = True, **labels):
+    if not enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, detail = detail, **labels)
+
+
+def timed(name, detail = True, **labels):
+    '''
+    Decorator version of timer
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return function(*args, **kwargs)
+            with timer(name, detail = detail, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n = 1, **labels):
+    if not enabled():
+        return None
+    key = _key(name, labels)
+    _state['counters'][key] = _state['counters'].get(key, 0) + n
+
+
+def summary():
+    '''
+    Aggregates so far: {'timers': [...], 'counters': [...], 'peak_rss_bytes': ..., 'gpu_peak_bytes': ...}
+    '''
+    return {
+        'timers': [dict(name = name, labels = dict(labels), **agg) for (name, labels), agg in _state['timers'].items()],
+        'counters': [dict(name = name, labels = dict(labels), value = value) for (name, labels), value in _state['counters'].items()],
+        'peak_rss_bytes': peak_rss_bytes(),
+        'gpu_peak_bytes': gpu_peak_bytes(),
+    }
+
+
+def _prom_name(name):
+    return 'mcd_' + ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def _prom_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('%s="%s"' % (k, str(v).replace('"', "'")) for k, v in labels) + '}'
+
+
+def flush():
+    '''
+    Writes the summary: appended summary lines (jsonl) or the rewritten textfile (prom)
+    '''
+    if not enabled():
+        return None
+    s = summary()
+    if _state['format'] == 'jsonl':
+        _emit(dict(type = 'summary', **s))
+        return None
+    lines = []
+    def family(metric, kind, samples):
+        lines.append('# TYPE %s %s' % (metric, kind)) # once per metric, label sets follow
+        lines.extend(samples)
+    timers = sorted(_state['timers'].items())
+    counters = sorted(_state['counters'].items())
+    for name in sorted(set(name for (name, _), _ in timers)):
+        base = _prom_name(name) + '_seconds'
+        ours = [(labels, agg) for (n, labels), agg in timers if n == name]
+        family(base, 'summary', ['%s_count%s %d' % (base, _prom_labels(l), agg['count']) for l, agg in ours] +
+                                ['%s_sum%s %.9g' % (base, _prom_labels(l), agg['sum']) for l, agg in ours])
+        family(base + '_max', 'gauge', ['%s_max%s %.9g' % (base, _prom_labels(l), agg['max']) for l, agg in ours])
+    for name in sorted(set(name for (name, _), _ in counters)):
+        metric = _prom_name(name) + '_total'
+        family(metric, 'counter', ['%s%s %.9g' % (metric, _prom_labels(l), v) for (n, l), v in counters if n == name])
+    family('mcd_peak_rss_bytes', 'gauge', ['mcd_peak_rss_bytes %d' % s['peak_rss_bytes']])
+    if s['gpu_peak_bytes'] is not None:
+        family('mcd_gpu_peak_bytes', 'gauge', ['mcd_gpu_peak_bytes %d' % s['gpu_peak_bytes']])
+    tmp = _state['path'] + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, _state['path']) # atomic for the textfile collector
+
+
+if os.environ.get('MCD_METRICS'):
+    configure(os.environ['MCD_METRICS'])
+atexit.register(flush)
@@ -0,0 +1,253 @@
+'''
+Shared, memoized multimode operator factory
+
+get_operators(n_q, n_c, N_modes, backend) returns one operator_set per (n_q, n_c, N_modes, backend,
+sparse, dtype); every operator is built on first access and then cached on that set, so classes that
+are created over and over in sweeps (qutip_sim_multimode, multimode_circle_grape_optimal_control,
+BatchOptimizer, Calculator_gef_ECD) share the same matrices instead of rebuilding them.
+
+backend : 'numpy' (arrays, or scipy csr matrices with sparse = True), 'qutip' (Qobj with tensor dims)
+          or 'tf' (tensorflow tensors of the given dtype, complex64 by default)
+
+Naming: *_q act on the qubit/transmon, *_c on a single mode, *_mm on all modes (list with one entry per
+mode, identity on the others), *_full on qubit x modes.
+Operators are shared between callers: numpy ones are read only (lists are returned as new lists).
+Operators are real where that is natural (ladder, number, x operators) and complex otherwise.
+'''
+import functools
+import numpy as np
+import scipy.sparse as sp
+from .metrics import timer
+
+
+@functools.lru_cache(maxsize = None)
+def get_operators(n_q, n_c, N_modes, backend = 'numpy', sparse = False, dtype = None):
+    '''
+    Cached operator_set for the given truncations and backend
+    '''
+    return operator_set(n_q, n_c, N_modes, backend = backend, sparse = sparse, dtype = dtype)
+
+
+def cached(build):
+    '''
+    Lazily built, cached operator: build(self) returns numpy arrays (or lists of them), which are
+    converted to the backend of the set once
+    '''
+    name = build.__name__
+
+    @property
+    @functools.wraps(build)
+    def getter(self):
+        if name not in self._cache:
+            with timer('operators.build', operator = name, backend = self.backend):
+                self._cache[name] = self.convert(build(self), name)
+        value = self._cache[name]
+        return list(value) if isinstance(value, list) else value
+    return getter
+
+
+class operator_set:
+
+    def __init__(self, n_q, n_c, N_modes, backend = 'numpy', sparse = False, dtype = None):
+        '''
+        n_q, n_c = # of levels in qubit, each cavity mode; N_modes = # of modes
+        '''
+        if backend not in ['numpy', 'qutip', 'tf']:
+            raise ValueError('backend must be numpy, qutip or tf, not ' + str(backend))
+        self.n_q = n_q
+        self.n_c = n_c
+        self.N_modes = N_modes
+        self.backend = backend
+        self.sparse = sparse
+        self.dtype = dtype
+        self._cache = {}
+
+    def embed(self, op, mode_idx):
+        '''
+        Single mode operator on mode mode_idx, identity on the other modes (numpy)
+        '''
+        ops = [np.identity(self.n_c) for _ in range(self.N_modes)]
+        ops[mode_idx] = op
+        return functools.reduce(np.kron, ops)
+
+    def convert(self, value, name):
+        '''
+        numpy array (or list of them) -> backend
+        '''
+        if isinstance(value, list):
+            return [self.convert(v, name) for v in value]
+        if self.backend == 'numpy':
+            if self.sparse and value.ndim == 2:
+                return sp.csr_matrix(value)
+            value.flags.writeable = False # shared between callers
+            return value
+        if self.backend == 'qutip':
+            from qutip import Qobj
+            if value.ndim == 1:
+                return value
+            return Qobj(value, dims = self.dims(name))
+        import tensorflow as tf
+        # eigenvalues too are complex, as from tf.linalg.eigh, so they multiply the complex tensors directly
+        dtype = tf.complex64 if self.dtype is None else tf.as_dtype(self.dtype)
+        return tf.constant(np.asarray(value, dtype = dtype.as_numpy_dtype))
+
+    def dims(self, name):
+        '''
+        qutip dims of the operator called name
+        '''
+        modes = [self.n_c for _ in range(self.N_modes)]
+        if name.endswith('_q') or name == 'q_projectors':
+            return [[self.n_q], [self.n_q]]
+        if name.endswith('_c'):
+            return [[self.n_c], [self.n_c]]
+        if name.endswith('_mm'):
+            return [modes, modes]
+        return [[self.n_q] + modes, [self.n_q] + modes]
+
+    # qubit / transmon
+    @cached
+    def identity_q(self):
+        return np.identity(self.n_q)
+
+    @cached
+    def a_q(self):
+        return np.diag(np.sqrt(np.arange(1, self.n_q)), 1)
+
+    @cached
+    def adag_q(self):
+        return np.diag(np.sqrt(np.arange(1, self.n_q)), -1)
+
+    @cached
+    def num_q(self):
+        return np.diag(np.arange(self.n_q))
+
+    @cached
+    def x_q(self):
+        return np.diag(np.sqrt(np.arange(1, self.n_q)), 1) + np.diag(np.sqrt(np.arange(1, self.n_q)), -1)
+
+    @cached
+    def y_q(self):
+        return (0-1j) * (np.diag(np.sqrt(np.arange(1, self.n_q)), 1) - np.diag(np.sqrt(np.arange(1, self.n_q)), -1))
+
+    @cached
+    def q_projectors(self):
+        return [np.diag(np.identity(self.n_q)[j]) for j in range(self.n_q)]
+
+    # single mode
+    @cached
+    def identity_c(self):
+        return np.identity(self.n_c)
+
+    @cached
+    def a_c(self):
+        return np.diag(np.sqrt(np.arange(1, self.n_c)), 1)
+
+    @cached
+    def adag_c(self):
+        return np.diag(np.sqrt(np.arange(1, self.n_c)), -1)
+
+    @cached
+    def num_c(self):
+        return np.diag(np.arange(self.n_c))
+
+    @cached
+    def x_c(self):
+        return np.diag(np.sqrt(np.arange(1, self.n_c)), 1) + np.diag(np.sqrt(np.arange(1, self.n_c)), -1)
+
+    @cached
+    def y_c(self):
+        return (0-1j) * (np.diag(np.sqrt(np.arange(1, self.n_c)), 1) - np.diag(np.sqrt(np.arange(1, self.n_c)), -1))
+
+    @cached
+    def position_c(self):
+        return self.position_c_np()
+
+    @cached
+    def momentum_c(self):
+        return self.momentum_c_np()
+
+    def position_c_np(self):
+        a = np.diag(np.sqrt(np.arange(1, self.n_c)), 1)
+        return np.sqrt(0.5) * (a + a.T)
+
+    def momentum_c_np(self):
+        a = np.diag(np.sqrt(np.arange(1, self.n_c)), 1)
+        return 1j * np.sqrt(0.5) * (a.T - a)
+
+    # all modes
+    @cached
+    def identity_mm(self):
+        return np.identity(self.n_c ** self.N_modes)
+
+    @cached
+    def a_mm(self):
+        a = np.diag(np.sqrt(np.arange(1, self.n_c)), 1)
+        return [self.embed(a, m) for m in range(self.N_modes)]
+
+    @cached
+    def adag_mm(self):
+        adag = np.diag(np.sqrt(np.arange(1, self.n_c)), -1)
+        return [self.embed(adag, m) for m in range(self.N_modes)]
+
+    @cached
+    def num_mm(self):
+        return [self.embed(np.diag(np.arange(self.n_c)), m) for m in range(self.N_modes)]
+
+    @cached
+    def x_mm(self):
+        x = np.diag(np.sqrt(np.arange(1, self.n_c)), 1) + np.diag(np.sqrt(np.arange(1, self.n_c)), -1)
+        return [self.embed(x, m) for m in range(self.N_modes)]
+
+    @cached
+    def y_mm(self):
+        y = (0-1j) * (np.diag(np.sqrt(np.arange(1, self.n_c)), 1) - np.diag(np.sqrt(np.arange(1, self.n_c)), -1))
+        return [self.embed(y, m) for m in range(self.N_modes)]
+
+    # position/momentum eigendecompositions for the displacement operators of BatchOptimizer
+    def eigh_mm(self, kind):
+        '''
+        numpy eigh of position ('q') or momentum ('p') of every mode, computed once
+        '''
+        key = '_eigh_' + kind
+        if key not in self._cache:
+            op = self.position_c_np() if kind == 'q' else self.momentum_c_np()
+            self._cache[key] = [np.linalg.eigh(self.embed(op, m)) for m in range(self.N_modes)]
+        return self._cache[key]
+
+    @cached
+    def eig_q_mm(self):
+        return [e for e, U in self.eigh_mm('q')]
+
+    @cached
+    def U_q_mm(self):
+        return [U for e, U in self.eigh_mm('q')]
+
+    @cached
+    def eig_p_mm(self):
+        return [e for e, U in self.eigh_mm('p')]
+
+    @cached
+    def U_p_mm(self):
+        return [U for e, U in self.eigh_mm('p')]
+
+    @cached
+    def qp_comm_mm(self):
+        qp = []
+        for m in range(self.N_modes):
+            q, p = self.embed(self.position_c_np(), m), self.embed(self.momentum_c_np(), m)
+            qp.append(np.diag(q @ p - p @ q))
+        return qp
+
+    # qubit x modes
+    @cached
+    def identity_full(self):
+        return np.identity(self.n_q * self.n_c ** self.N_modes)
+
+    @cached
+    def a_full(self):
+        a = np.diag(np.sqrt(np.arange(1, self.n_c)), 1)
+        return [np.kron(np.identity(self.n_q), self.embed(a, m)) for m in range(self.N_modes)]
+
+    @cached
+    def a_q_full(self):
+        return np.kron(np.diag(np.sqrt(np.arange(1, self.n_q)), 1), np.identity(self.n_c ** self.N_modes))
@@ -0,0 +1,192 @@
+'''
+Piecewise constant propagation of pulses sampled on a uniform time grid (1 ns everywhere in this project)
+
+H(t) = H0 + sum_j c_j(t) H_j is treated as piecewise constant over each sample interval and the states
+are stepped with exp(-i H_k dt) applied directly to the state, so no adaptive ODE solver and no d x d
+propagator is needed. Several initial states are propagated together as the columns of one
+(d, n_states) array.
+
+order = 2: one exponential per step with the coefficients at the interval midpoint
+order = 4: commutator free Magnus, two exponentials per step with the coefficients (cubic spline of the
+           samples, like qutip's array coefficients) at the two Gauss points of the interval
+
+All operators are stored on the union sparsity pattern so that H_k is assembled with one small matrix
+product (H_k.data = data_0 + c[:, k] @ data_j) instead of adding sparse matrices every step.
+'''
+import numpy as np
+import scipy.sparse as sp
+from scipy.linalg import expm
+from scipy.sparse.linalg import expm_multiply
+from scipy.interpolate import CubicSpline
+
+
+def to_matrix(op):
+    '''
+    qutip Qobj / numpy array / scipy sparse matrix -> scipy csr matrix
+    '''
+    if hasattr(op, 'data') and hasattr(op, 'dims'): # Qobj
+        op = op.data
+    return sp.csr_matrix(op, dtype = complex)
+
+def to_states(states):
+    '''
+    ket, list of kets or (d,)/(d, n) array -> (d, n) complex array (one column per state)
+    '''
+    if hasattr(states, 'dims'):
+        states = [states]
+    if isinstance(states, (list, tuple)):
+        return np.column_stack([np.asarray(s.full() if hasattr(s, 'dims') else s, dtype = complex).ravel()
+                                for s in states])
+    states = np.asarray(states, dtype = complex)
+    return states.reshape(-1, 1) if states.ndim == 1 else states
+
+
+class pwc_propagator:
+
+    def __init__(self, H0, Hs = [], coeffs = [], dt = 1.0, method = 'taylor', tol = 1e-12, order = 4):
+        '''
+        H0     : time independent part
+        Hs     : control operators H_j
+        coeffs : coefficient samples c_j[k] on the time grid, shape (len(Hs), n_samples)
+        dt     : grid spacing (ns)
+        method : 'taylor' (default, truncated Taylor series of exp(-iH dt) on the states, substepped so
+                 that |H dt| <= 1), 'expm_multiply' (scipy) or 'expm' (dense step propagators, small d)
+        tol    : truncation tolerance of the Taylor series
+        order  : 2 (midpoint) or 4 (commutator free Magnus at the Gauss points)
+        '''
+        self.H0 = to_matrix(H0)
+        self.Hs = [to_matrix(op) for op in Hs]
+        self.coeffs = np.array(coeffs, dtype = complex).reshape(len(self.Hs), -1)
+        self.dt = dt
+        self.method = method
+        self.tol = tol
+        self.dim = self.H0.shape[0]
+
+        # union sparsity pattern and the data of every operator on it
+        pattern = abs(self.H0)
+        for op in self.Hs:
+            pattern = pattern + abs(op)
+        pattern = sp.csr_matrix(pattern)
+        pattern.sort_indices()
+        self.pattern = pattern
+        rows = np.repeat(np.arange(self.dim), np.diff(pattern.indptr))
+        linear = rows * self.dim + pattern.indices
+        def on_pattern(op):
+            coo = op.tocoo()
+            data = np.zeros(len(linear), dtype = complex)
+            np.add.at(data, np.searchsorted(linear, coo.row * self.dim + coo.col), coo.data)
+            return data
+        self.data0 = on_pattern(self.H0)
+        self.data = np.array([on_pattern(op) for op in self.Hs]).reshape(len(self.Hs), len(linear))
+
+        # stages of each step: exp(-i dt (w0 H0 + sum_j c_j H_j)) with (w0, c[:, k]) per stage
+        self.order = order
+        n_samples = self.coeffs.shape[1]
+        self.n_steps = max(n_samples - 1, 1)
+        if n_samples < 2 or len(self.Hs) == 0:
+            self.stages = [(1.0, self.coeffs[:, :self.n_steps])]
+        elif order == 2:
+            self.stages = [(1.0, 0.5 * (self.coeffs[:, :-1] + self.coeffs[:, 1:]))]
+        else:
+            spline = CubicSpline(np.arange(n_samples), self.coeffs, axis = 1)
+            starts = np.arange(self.n_steps)
+            c1 = spline(starts + 0.5 - np.sqrt(3) / 6)
+            c2 = spline(starts + 0.5 + np.sqrt(3) / 6)
+            a1, a2 = (3 - 2 * np.sqrt(3)) / 12, (3 + 2 * np.sqrt(3)) / 12
+            self.stages = [(0.5, a2 * c1 + a1 * c2), (0.5, a1 * c1 + a2 * c2)]
+
+    @classmethod
+    def from_qutip(cls, H, t_list, method = 'taylor', order = 4):
+        '''
+        From a qutip list format Hamiltonian [H0, [H1, c1], ...] with array coefficients sampled on t_list
+        '''
+        H0 = 0
+        Hs, coeffs = [], []
+        for term in H:
+            if isinstance(term, list):
+                op, coeff = term
+                if callable(coeff): # e.g. Cubic_Spline
+                    coeff = coeff(t_list)
+                Hs.append(op)
+                coeffs.append(np.asarray(coeff)[:len(t_list)])
+            else:
+                H0 = H0 + term
+        return cls(H0, Hs, coeffs, dt = t_list[1] - t_list[0], method = method, order = order)
+
+    def step_hamiltonian(self, k, stage = 0):
+        '''
+        Hamiltonian of the given stage of step k
+        '''
+        w0, coeffs = self.stages[stage]
+        data = w0 * self.data0 + coeffs[:, k] @ self.data
+        return sp.csr_matrix((data, self.pattern.indices, self.pattern.indptr), shape = self.pattern.shape)
+
+    def norm_bound(self, H):
+        '''
+        Max absolute row sum of H (bounds its spectral norm)
+        '''
+        if H.nnz == 0:
+            return 0
+        return np.max(np.abs(H).sum(axis = 1))
+
+    def step(self, k, states):
+        '''
+        Step k (all its stages) applied to the (d, n) states
+        '''
+        for stage in range(len(self.stages)):
+            states = self.exp_step(self.step_hamiltonian(k, stage), states)
+        return states
+
+    def exp_step(self, H, states):
+        '''
+        exp(-i H dt) applied to the (d, n) states
+        '''
+        if self.method == 'expm':
+            return expm(-1j * self.dt * H.toarray()) @ states
+        if self.method == 'expm_multiply':
+            return expm_multiply(-1j * self.dt * H, states)
+
+        # Taylor series, substepped so that |H dt_sub| <= 1 (row sum norm, H is hermitian)
+        n_sub = max(1, int(np.ceil(self.norm_bound(H) * self.dt)))
+        dt_sub = self.dt / n_sub
+        for _ in range(n_sub):
+            term = states
+            out = states.copy()
+            for n in range(1, 40):
+                term = (-1j * dt_sub / n) * (H @ term)
+                out += term
+                if np.max(np.abs(term)) <= self.tol:
+                    break
+            states = out
+        return states
+
+    def propagate(self, initials, store_states = False, stride = 1):
+        '''
+        Propagates the initial states through all steps
+
+        Returns the final states (d, n) and, if store_states, every stride'th state (n_stored, d, n)
+        '''
+        states = to_states(initials)
+        stored = [states] if store_states else None
+        for k in range(self.n_steps):
+            states = self.step(k, states)
+            if store_states and ((k + 1) % stride == 0 or k == self.n_steps - 1):
+                stored.append(states)
+        if store_states:
+            return states, np.array(stored)
+        return states
+
+    def unitary(self):
+        '''
+        Full propagator (d x d), only sensible for small d
+        '''
+        return self.propagate(np.identity(self.dim, dtype = complex))
+
+    def fidelities(self, initials, targets, finals = None):
+        '''
+        |<target_i|U|initial_i>|^2 for each pair
+        '''
+        if finals is None:
+            finals = self.propagate(initials)
+        overlaps = np.sum(np.conjugate(to_states(targets)) * finals, axis = 0)
+        return np.abs(overlaps)**2
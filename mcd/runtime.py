@@ -0,0 +1,66 @@
+'''
+Headless (batch) mode and logging for the simulation, pulse construction and GRAPE code
+
+Batch jobs (HPC, process pools) set MCD_HEADLESS=1 in the environment (or call set_headless()):
+matplotlib switches to the Agg backend and figures are only built when a plot is explicitly
+requested (e.g. plot = True / show_plots = True arguments or calling plot_* methods directly),
+instead of on every pulse load or GRAPE run.
+
+Diagnostic output goes through the 'mcd' loggers (get_logger) instead of print: per gate / per
+layer values are logged at DEBUG, run summaries at INFO. The level is MCD_LOG_LEVEL (default INFO).
+'''
+import os
+import logging
+
+_state = {
+    'headless': os.environ.get('MCD_HEADLESS', '0').lower() not in ['', '0', 'false', 'no'],
+}
+
+
+def headless():
+    '''
+    True in headless (batch) mode
+    '''
+    return _state['headless']
+
+
+def set_headless(value = True):
+    '''
+    Switches headless mode on or off (the matplotlib backend is switched to Agg when switching on)
+    '''
+    _state['headless'] = bool(value)
+    if _state['headless']:
+        _use_agg()
+
+
+def plots_requested(plot = None):
+    '''
+    Whether to build a figure: plot if it is given, otherwise only when not headless
+    '''
+    return (not headless()) if plot is None else bool(plot)
+
+
+def _use_agg():
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+    except ImportError:
+        pass
+
+
+def get_logger(name):
+    '''
+    'mcd.<name>' logger; the 'mcd' handler (time, name, level, message) is set up on first use
+    '''
+    root = logging.getLogger('mcd')
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s'))
+        root.addHandler(handler)
+        root.setLevel(os.environ.get('MCD_LOG_LEVEL', 'INFO').upper())
+        root.propagate = False
+    return logging.getLogger('mcd.' + name)
+
+
+if _state['headless']:
+    _use_agg()
@@ -0,0 +1,284 @@
+'''
+Local scheduler for sweep task graphs (stand-in for a cluster queue)
+
+Every (task, stage) pair of a sweep is a job; a stage depends on the previous stage of its task
+(optimize -> compile -> verify). The jobs live in a file queue, <output>/queue.json, that is only
+read or changed while holding an exclusive lock on <output>/queue.lock (fcntl), so any number of
+worker processes, also other jobs sharing the file system (mcd worker), can serve the same sweep.
+
+    cost-aware ordering: tasks are sorted by estimated cost (estimate_cost, or a 'cost' value in
+                         the task) and dealt out to per-worker queues, most expensive first, each to
+                         the least loaded worker (longest processing time first)
+    work stealing:       a worker runs the most expensive ready job of its own queue; when it has
+                         none it takes the cheapest ready job from the back of the most loaded queue
+    retries:             a failed job goes back to the end of its queue until it failed 1 + retries
+                         times; then the later stages of its task are skipped. Jobs of a worker
+                         process that died are requeued the same way
+    results catalog:     the stage records in <output>/state (see mcd.sweep), merged into results.csv
+
+Pipelined execution: with pools = {'optimize': 1, 'compile': 2, 'verify': 4} every stage gets its
+own workers, which only run (and steal) jobs of their stage, so the optimizers never wait for a
+compilation or simulation and the sweep runs at the rate of the slowest pool. queue_size bounds the
+results waiting between two stages: a stage starts no new job while queue_size finished results
+wait for the next stage (at most queue_size + the pool size of the stage can pile up), which holds
+back e.g. fast optimizers when verification falls behind (backpressure). In the shared pool it makes the workers turn to the
+downstream jobs when a buffer is full (ties in cost go to the later stage anyway).
+'''
+import os
+import json
+import time
+import fcntl
+import socket
+import contextlib
+import multiprocessing
+from .runtime import get_logger, set_headless
+from . import sweep
+
+logger = get_logger('scheduler')
+
+
+def estimate_cost(task):
+    '''
+    Relative cost of all stages of a task, dominated by the optimization
+    ecd   : multistarts x depth x state dimension^2 x Adam steps
+    cgrape: steps x dimension^3 (exact propagator; ^2 for split) x iterations
+    '''
+    if 'cost' in task:
+        return float(task['cost'])
+    p = task.get('optimize', {})
+    if task['method'] == 'ecd':
+        d = p.get('N_ancilla_levels', 2) * p.get('N_cav', 10)**p.get('N_modes', 1)
+        return float(p.get('N_multistart', 10) * p.get('N_blocks', 5) * d**2 *
+                     p.get('epochs', 100) * p.get('epoch_size', 10))
+    s = task.get('system', {})
+    d = s.get('transmon_levels', 2) * s.get('mode_state_num', 10)**s.get('number_of_modes', 1)
+    power = 2 if p.get('propagator', 'exact') == 'split' else 3
+    return float(p.get('steps', 800) * d**power * p.get('convergence', {}).get('max_iterations', 100))
+
+
+def job_id(tid, stage):
+    return tid + ':' + stage
+
+
+class file_queue:
+    '''
+    Job queue in output/queue.json; use as "with queue.locked() as state:", changes to state are
+    written back when the block exits
+    '''
+    def __init__(self, output):
+        self.output = output
+        self.filename = os.path.join(output, 'queue.json')
+        self.lockname = os.path.join(output, 'queue.lock')
+
+    @contextlib.contextmanager
+    def locked(self):
+        with open(self.lockname, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.filename) as f:
+                    state = json.load(f)
+                yield state
+                tmp = self.filename + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp, self.filename)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def create(self, tasks, stages, serves, retries = 1, queue_size = None):
+        '''
+        Queue with the pending stages of tasks dealt out to the workers of serves ({name: stages
+        the worker runs, None for all}); all stages of a task that one pool serves go to one worker
+        '''
+        os.makedirs(self.output, exist_ok = True)
+        jobs, queues, loads = {}, dict((w, []) for w in serves), dict((w, 0.) for w in serves)
+        for task in sorted(tasks, key = estimate_cost, reverse = True):
+            pending = sweep.pending_stages(sweep.load_record(self.output, task['task_id']), stages)
+            cost = estimate_cost(task)
+            owners, after = {}, None
+            for stage in pending:
+                pool = tuple(w for w in serves if serves[w] is None or stage in serves[w])
+                if not pool:
+                    raise ValueError('no worker runs the ' + stage + ' stage')
+                if pool not in owners:
+                    owners[pool] = min(pool, key = lambda w: loads[w])
+                    loads[owners[pool]] += cost
+                jid = job_id(task['task_id'], stage)
+                jobs[jid] = {'task_id': task['task_id'], 'stage': stage, 'cost': cost, 'after': after,
+                             'next': None, 'status': 'queued', 'attempts': 0, 'worker': None}
+                if after is not None:
+                    jobs[after]['next'] = jid
+                queues[owners[pool]].append(jid)
+                after = jid
+        with open(self.lockname, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.filename, 'w') as f:
+                json.dump({'tasks': dict((t['task_id'], t) for t in tasks), 'jobs': jobs, 'queues': queues,
+                           'serves': serves, 'retries': retries, 'queue_size': queue_size}, f)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return jobs
+
+
+def ready(state, jid):
+    job = state['jobs'][jid]
+    return job['status'] == 'queued' and (job['after'] is None or state['jobs'][job['after']]['status'] == 'done')
+
+
+def buffered(state, stage):
+    '''
+    Finished results waiting for stage
+    '''
+    return len([jid for jid, job in state['jobs'].items() if job['stage'] == stage and ready(state, jid)
+                and job['after'] is not None])
+
+
+def blocked(state, jid):
+    '''
+    Backpressure: queue_size results of jid's stage already wait for the next stage
+    '''
+    job = state['jobs'][jid]
+    if not state.get('queue_size') or job['next'] is None:
+        return False
+    return buffered(state, state['jobs'][job['next']]['stage']) >= state['queue_size']
+
+
+def next_job(state, worker):
+    '''
+    Most expensive ready job (of the stages worker runs) of worker's own queue, else the cheapest
+    ready one of the most loaded queue; jobs whose output buffer is full wait
+    '''
+    serves = state['serves'].get(worker)
+    def eligible(jid):
+        return ready(state, jid) and (serves is None or state['jobs'][jid]['stage'] in serves) and not blocked(state, jid)
+
+    own = [jid for jid in state['queues'].setdefault(worker, []) if eligible(jid)]
+    if own:
+        return max(own, key = lambda jid: (state['jobs'][jid]['cost'], sweep.stage_functions.stage_order.index(state['jobs'][jid]['stage'])))
+    loads = dict((w, sum(state['jobs'][jid]['cost'] for jid in q if state['jobs'][jid]['status'] == 'queued'))
+                 for w, q in state['queues'].items() if w != worker)
+    for victim in sorted(loads, key = loads.get, reverse = True):
+        stealable = [jid for jid in state['queues'][victim] if eligible(jid)]
+        if stealable:
+            jid = stealable[-1]
+            state['queues'][victim].remove(jid)
+            state['queues'][worker].append(jid)
+            logger.debug('worker %s stole %s from worker %s' % (worker, jid, victim))
+            return jid
+    return None
+
+
+def unfinished(state):
+    return [jid for jid, job in state['jobs'].items() if job['status'] in ['queued', 'running']]
+
+
+def finish(state, jid, record):
+    '''
+    Marks jid done or failed (requeued while attempts remain; later stages skipped when not)
+    '''
+    job = state['jobs'][jid]
+    job['attempts'] += 1
+    if record['stages'][job['stage']]['status'] == 'done':
+        job['status'] = 'done'
+    elif job['attempts'] <= state['retries']:
+        job['status'] = 'queued'
+        queue = state['queues'][job['worker']]
+        queue.remove(jid)
+        queue.append(jid)
+        logger.warning('%s failed (attempt %d), requeued' % (jid, job['attempts']))
+    else:
+        job['status'] = 'failed'
+        skip_dependents(state, jid)
+
+
+def skip_dependents(state, jid):
+    for other, job in state['jobs'].items():
+        if job['after'] == jid:
+            job['status'] = 'skipped'
+            skip_dependents(state, other)
+
+
+def worker_loop(output, worker = None, poll = 1.0, stages = None):
+    '''
+    Runs jobs of the queue in output until no job is queued or running (the worker function of
+    run_graph; other processes can join an existing queue with any new worker name, running only
+    the jobs of stages if given)
+    '''
+    set_headless(True)
+    worker = worker or '%s-%d' % (socket.gethostname(), os.getpid())
+    queue = file_queue(output)
+    with queue.locked() as state:
+        state['serves'].setdefault(worker, stages)
+    while True:
+        with queue.locked() as state:
+            if not unfinished(state):
+                return None
+            jid = next_job(state, worker)
+            if jid is not None:
+                job = state['jobs'][jid]
+                job.update(status = 'running', worker = worker, pid = os.getpid())
+                task = state['tasks'][job['task_id']]
+        if jid is None:
+            time.sleep(poll)
+            continue
+
+        logger.info('worker %s: %s' % (worker, jid))
+        record = sweep.run_task(task, [job['stage']], sweep.load_record(output, job['task_id']))
+        record['stages'][job['stage']].update(worker = worker, attempt = job['attempts'] + 1)
+        sweep.save_record(output, record)
+        sweep.log_record(record)
+        with queue.locked() as state:
+            finish(state, jid, record)
+
+
+def requeue_dead(queue, pids):
+    '''
+    Jobs left running by the dead worker processes pids count as a failed attempt
+    '''
+    with queue.locked() as state:
+        for jid, job in state['jobs'].items():
+            if job['status'] == 'running' and job.get('pid') in pids:
+                job['attempts'] += 1
+                job['status'] = 'queued' if job['attempts'] <= state['retries'] else 'failed'
+                logger.warning('worker of %s died (attempt %d)' % (jid, job['attempts']))
+                if job['status'] == 'failed':
+                    skip_dependents(state, jid)
+
+
+def run_graph(tasks, stages, output, workers = 1, retries = 1, poll = 1.0, pools = None, queue_size = None):
+    '''
+    Schedules the pending stages of tasks on workers local processes (workers = 1: in this process),
+    or on per stage pools ({stage: number of workers}, stages not listed get one worker), and waits
+    for all of them; dead worker processes are replaced while jobs remain
+    '''
+    if pools:
+        serves = dict(('%s-%d' % (stage, w), [stage]) for stage in stages for w in range(pools.get(stage, 1)))
+    else:
+        serves = dict((str(w), None) for w in range(workers))
+    queue = file_queue(output)
+    jobs = queue.create(tasks, stages, serves, retries = retries, queue_size = queue_size)
+    logger.info('%d jobs of %d tasks on %d workers%s' % (len(jobs), len(tasks), len(serves),
+                ' (' + ', '.join('%s: %d' % (s, pools.get(s, 1)) for s in stages) + ')' if pools else ''))
+    if len(serves) == 1:
+        worker_loop(output, list(serves)[0], poll = poll)
+        return None
+
+    context = multiprocessing.get_context('spawn') # no forked tensorflow / qutip state
+    processes = {}
+    for w in serves:
+        processes[w] = context.Process(target = worker_loop, args = (output, w, poll))
+        processes[w].start()
+    while processes:
+        time.sleep(poll)
+        for w, p in list(processes.items()):
+            if p.is_alive():
+                continue
+            del processes[w]
+            if p.exitcode != 0:
+                requeue_dead(queue, [p.pid])
+                with queue.locked() as state:
+                    remaining = len(unfinished(state))
+                if remaining:
+                    logger.warning('worker %s exited with %s, restarting' % (w, str(p.exitcode)))
+                    processes[w] = context.Process(target = worker_loop, args = (output, w, poll))
+                    processes[w].start()
+    return None
@@ -0,0 +1,161 @@
+'''
+Minimal duration / depth search for optimization sweeps
+
+The drivers used to scan a parameter (circle GRAPE total_time, ECD N_blocks) upwards one step at a
+time until an optimization reached the target. minimal_search finds the smallest feasible value on the
+grid start + k*resolution assuming feasibility is monotonic in the value:
+
+    1. bracket: evaluate start, start + step, start + 3 step, ... (doubling increments) until a feasible
+       value is found (or downwards from start if start is already feasible)
+    2. bisect between the largest infeasible and the smallest feasible value down to the resolution
+
+Every evaluation gets the result of the closest already evaluated value as warm start (ties go to the
+feasible one), e.g. the best pulse or circuit of the neighbouring bracket point; resample_pulses and
+resize_circuit (warm_start_circuit for BatchOptimizer) adapt those to the new duration / depth.
+'''
+import numpy as np
+from .runtime import get_logger
+
+logger = get_logger('search')
+
+
+def minimal_search(evaluate, start, step, resolution = None, max_value = None, min_value = None):
+    '''
+    evaluate(value, warm_start) -> (feasible, result); warm_start is None for the first evaluation
+    resolution : grid spacing of the answer (default step); ints everywhere give an integer search
+    max_value / min_value : limits of the bracket search (min_value defaults to resolution)
+
+    Returns (smallest feasible value or None if none up to max_value, history) where history is the
+    list of (value, feasible, result) in evaluation order
+    '''
+    resolution = step if resolution is None else resolution
+    history = []
+    evaluated = {}
+
+    def run(value):
+        warm_start = None
+        if evaluated:
+            # closest evaluated value, feasible first on ties
+            closest = min(evaluated, key = lambda v: (abs(v - value), not evaluated[v][0]))
+            warm_start = evaluated[closest][1]
+        logger.info('evaluating %s' % str(value))
+        feasible, result = evaluate(value, warm_start)
+        evaluated[value] = (feasible, result)
+        history.append((value, feasible, result))
+        logger.info('%s is %s' % (str(value), 'feasible' if feasible else 'infeasible'))
+        return feasible
+
+    # bracket
+    lo, hi = None, None
+    increment = step
+    if run(start):
+        hi = start
+        floor = resolution if min_value is None else min_value # durations / depths are positive
+        while lo is None:
+            if hi <= floor:
+                return hi, history
+            value = max(hi - increment, floor)
+            if run(value):
+                hi, increment = value, 2 * increment
+            else:
+                lo = value
+    else:
+        lo = start
+        while hi is None:
+            value = lo + increment if max_value is None else min(lo + increment, max_value)
+            if value <= lo:
+                logger.info('no feasible value up to %s' % str(max_value))
+                return None, history
+            if run(value):
+                hi = value
+            else:
+                lo, increment = value, 2 * increment
+
+    # bisect on the grid lo + k*resolution
+    while hi - lo > resolution:
+        n = (hi - lo) / resolution
+        k = max(1, int(round(n / 2)))
+        mid = lo + k * resolution
+        if mid >= hi:
+            break
+        if run(mid):
+            hi = mid
+        else:
+            lo = mid
+    return hi, history
+
+
+def resample_pulses(uks, steps, max_amp = None):
+    '''
+    Warm start pulses for a different number of steps: (n_controls, old_steps) pulses stretched
+    or compressed in time by linear interpolation, clipped to |u| <= max_amp
+    '''
+    uks = np.atleast_2d(np.asarray(uks, dtype = float))
+    old = np.linspace(0, 1, uks.shape[1])
+    new = np.linspace(0, 1, steps)
+    resampled = np.array([np.interp(new, old, uk) for uk in uks])
+    if max_amp is not None:
+        resampled = np.clip(resampled, -max_amp, max_amp)
+    return resampled
+
+
+def resize_circuit(circuit, N_blocks, N_ancilla_levels = 3):
+    '''
+    Warm start circuit for a different depth from circuit (dict with betas (N_modes, layers), phis and
+    thetas (N_modes, layers, N_single_layer) for MECD_paramV2 or (N_modes, layers) for MECD_paramV1,
+    e.g. best_circuit()): shallower circuits keep the first N_blocks layers, deeper ones get identity
+    layers appended. beta = 0 makes the ECD X_ge (f untouched), so the padding undoes it:
+
+        qutrit (V2, 3 levels) : ge rotation theta = pi about phi = 0 and ef rotation theta = 2 pi, layer = -1
+        qubit (V1, V2 with 2 levels) : ge rotation theta = pi about phi = pi/2, layer = -i
+
+    (an X times rotations has determinant -1 on a qubit, so -i is the closest to a real identity there)
+    '''
+    betas, phis, thetas = (np.array(circuit[key]) for key in ['betas', 'phis', 'thetas'])
+    n_layers = betas.shape[1]
+    if N_blocks <= n_layers:
+        return {'betas': betas[:, :N_blocks], 'phis': phis[:, :N_blocks], 'thetas': thetas[:, :N_blocks]}
+    extra = N_blocks - n_layers
+    pad_phis = np.zeros((phis.shape[0], extra) + phis.shape[2:])
+    pad_thetas = np.zeros_like(pad_phis)
+    if phis.ndim == 2: # V1: one rotation per layer, qubit
+        pad_phis[:] = np.pi / 2
+        pad_thetas[:] = np.pi
+    elif N_ancilla_levels == 2:
+        pad_phis[:, :, 0] = np.pi / 2
+        pad_thetas[:, :, 0] = np.pi
+    else:
+        pad_thetas[:, :, 0] = np.pi
+        pad_thetas[:, :, 1] = 2 * np.pi
+    return {
+        'betas': np.concatenate([betas, np.zeros((betas.shape[0], extra), dtype = betas.dtype)], axis = 1),
+        'phis': np.concatenate([phis, pad_phis], axis = 1),
+        'thetas': np.concatenate([thetas, pad_thetas], axis = 1),
+    }
+
+
+def warm_start_circuit(opt, circuit, fraction = 0.5, noise = 0.05):
+    '''
+    Replaces the first fraction of the multistarts of a BatchOptimizer opt by circuit (best_circuit() of
+    an optimizer of any depth) resized to opt's depth, plus gaussian noise of relative size noise;
+    the other multistarts keep their random initialization
+    '''
+    N_blocks = opt.parameters['N_blocks']
+    M = opt.parameters['N_multistart']
+    n_warm = max(1, int(round(fraction * M)))
+    betas = opt.betas_rho.numpy() * np.exp(1j * opt.betas_angle.numpy()) # (N_modes, N_blocks, M)
+    phis, thetas = opt.phis.numpy(), opt.thetas.numpy() # (N_modes, N_blocks[, N_single_layer], M)
+
+    warm = resize_circuit(circuit, N_blocks, opt.parameters.get('N_ancilla_levels', 2))
+    warm_betas, warm_phis, warm_thetas = warm['betas'], warm['phis'], warm['thetas']
+    scale = noise * (np.mean(np.abs(warm_betas)) + 1e-12)
+    for m in range(n_warm):
+        if m == 0:
+            betas[..., m], phis[..., m], thetas[..., m] = warm_betas, warm_phis, warm_thetas
+            continue
+        betas[..., m] = warm_betas + scale * (np.random.normal(size = warm_betas.shape)
+                                              + 1j * np.random.normal(size = warm_betas.shape))
+        phis[..., m] = warm_phis + noise * np.random.normal(size = warm_phis.shape)
+        thetas[..., m] = warm_thetas + noise * np.random.normal(size = warm_thetas.shape)
+    opt.set_tf_vars(betas = betas, phis = phis, thetas = thetas)
+    return opt
@@ -0,0 +1,214 @@
+'''
+Split operator (symmetric Trotter) propagation for Hamiltonians H(t) = H0 + sum_j u_j(t) h_j x I_modes
+
+In circle GRAPE every control acts on the transmon only and H0 (H_rot) is time independent, so each
+step is split as
+
+    exp(-i H dt) ~ exp(-i H0 dt/2) exp(-i dt sum_j u_j h_j) exp(-i H0 dt/2)
+
+exp(-i H0 dt/2) is computed once (eigendecomposition of H0) and the control exponential is a
+qnum x qnum matrix acting on the transmon index of the state reshaped to (qnum, d_modes, n_states).
+Consecutive half steps are merged, so a (sub)step costs one d x d matrix-vector product per state
+instead of a d x d matrix exponential.
+
+The splitting error is controlled by step doubling: every pulse sample is split into n_sub substeps,
+and n_sub is doubled until the final states change by less than tol (propagate_adaptive).
+samples = 'constant' holds the amplitudes constant over each sample (GRAPE pulses); samples = 'spline'
+takes amplitudes at the sample boundaries and evaluates their cubic spline at every substep midpoint,
+so that refining the substeps converges to smoothly interpolated pulses (like qutip's array coefficients).
+Gradients of the state transfer fidelity with respect to the amplitudes are exact for the split
+propagator (one forward and one backward sweep, derivatives of the small control exponentials from
+their eigendecompositions).
+'''
+import numpy as np
+from scipy.interpolate import CubicSpline
+from .runtime import get_logger
+
+logger = get_logger('split_operator')
+
+
+def hermitian_expm(H, tau, Es = None):
+    '''
+    exp(-i tau H) of a stack of hermitian matrices H (..., n, n) and, if Es (n_E, n, n) is given,
+    its directional derivatives d/dx exp(-i tau (H + x E)) for each E, shape (n_E, ..., n, n)
+    '''
+    evals, W = np.linalg.eigh(H)
+    f = np.exp(-1j * tau * evals)
+    U = (W * f[..., None, :]) @ np.conjugate(np.swapaxes(W, -1, -2))
+    if Es is None:
+        return U
+    # Daleckii-Krein: D exp(-i tau H)[E] = W (Gamma o W^dag E W) W^dag
+    diff = evals[..., :, None] - evals[..., None, :]
+    degenerate = np.abs(diff) < 1e-12
+    Gamma = np.where(degenerate, -1j * tau * f[..., :, None],
+                     (f[..., :, None] - f[..., None, :]) / np.where(degenerate, 1, diff))
+    W_dag = np.conjugate(np.swapaxes(W, -1, -2))
+    dU = np.array([W @ (Gamma * (W_dag @ E @ W)) @ W_dag for E in Es])
+    return U, dU
+
+
+class split_operator_propagator:
+
+    def __init__(self, H0, controls, dt, tol = 1e-6, n_sub = 1, max_sub = 64):
+        '''
+        H0       : time independent Hamiltonian (d x d), transmon x modes (transmon index first)
+        controls : transmon only control operators h_j (qnum x qnum); the full control Hamiltonians
+                   are h_j x identity of the modes (see from_full for d x d controls)
+        dt       : duration of one amplitude sample
+        tol      : step doubling tolerance (max norm of the change of the final states)
+        n_sub    : initial number of substeps per sample; max_sub : largest n_sub propagate_adaptive tries
+        '''
+        self.H0 = np.asarray(H0, dtype = complex)
+        self.controls = np.array([np.asarray(h, dtype = complex) for h in controls])
+        self.dim = self.H0.shape[0]
+        self.qnum = self.controls.shape[1]
+        self.d_modes = self.dim // self.qnum
+        self.dt = dt
+        self.tol = tol
+        self.n_sub = n_sub
+        self.max_sub = max_sub
+        self.H0_evals, self.H0_V = np.linalg.eigh(self.H0)
+        self._free = {}
+
+    @classmethod
+    def from_full(cls, H0, Hops, dt, qnum, **kwargs):
+        '''
+        From full d x d control Hamiltonians (e.g. controlHs()), which must be of the form h x I_modes
+        '''
+        d_modes = np.shape(H0)[0] // qnum
+        controls = []
+        for Hop in Hops:
+            Hop = np.asarray(Hop)
+            h = Hop[::d_modes, ::d_modes]
+            if not np.allclose(np.kron(h, np.identity(d_modes)), Hop):
+                raise ValueError('control Hamiltonian does not act on the transmon only')
+            controls.append(h)
+        return cls(H0, controls, dt, **kwargs)
+
+    def free_propagator(self, tau):
+        '''
+        exp(-i H0 tau), computed once per tau
+        '''
+        if tau not in self._free:
+            V = self.H0_V
+            self._free[tau] = (V * np.exp(-1j * tau * self.H0_evals)) @ np.conjugate(V.T)
+        return self._free[tau]
+
+    def control_hamiltonians(self, amplitudes):
+        '''
+        sum_j u_j[k] h_j for every sample k, shape (n_samples, qnum, qnum)
+        '''
+        amplitudes = np.asarray(amplitudes, dtype = float).reshape(len(self.controls), -1)
+        return np.einsum('jk,jab->kab', amplitudes, self.controls)
+
+    def substep_controls(self, amplitudes, n_sub, samples = 'constant'):
+        '''
+        Control exponentials of every substep, shape (n_samples * n_sub, qnum, qnum)
+        '''
+        amplitudes = np.asarray(amplitudes, dtype = float).reshape(len(self.controls), -1)
+        if samples == 'spline':
+            n_samples = amplitudes.shape[1] - 1
+            spline = CubicSpline(np.arange(n_samples + 1), amplitudes, axis = 1)
+            amplitudes = spline((np.arange(n_samples * n_sub) + 0.5) / n_sub)
+        else:
+            amplitudes = np.repeat(amplitudes, n_sub, axis = 1)
+        return hermitian_expm(self.control_hamiltonians(amplitudes), self.dt / n_sub)
+
+    def apply_control(self, C, states):
+        '''
+        (C x I_modes) applied to the (d, n) states
+        '''
+        n = states.shape[1]
+        states = states.reshape(self.qnum, self.d_modes, n)
+        return np.einsum('ab,bxn->axn', C, states).reshape(self.dim, n)
+
+    def propagate(self, initials, amplitudes, n_sub = None, store_states = False, samples = 'constant'):
+        '''
+        Propagates the (d, n) initial states through all samples with n_sub substeps each
+
+        Returns the final states and, if store_states, the states at every sample boundary
+        (n_samples + 1, d, n)
+        '''
+        n_sub = self.n_sub if n_sub is None else n_sub
+        tau = self.dt / n_sub
+        Cs = self.substep_controls(amplitudes, n_sub, samples)
+        P_half, P = self.free_propagator(tau / 2), self.free_propagator(tau)
+        states = np.array(initials, dtype = complex).reshape(self.dim, -1)
+        stored = [states] if store_states else None
+        # P_half^dag (P C)^N P_half = (P_half C P_half)^N
+        states = P_half @ states
+        for ii, C in enumerate(Cs):
+            states = P @ self.apply_control(C, states)
+            if store_states and (ii + 1) % n_sub == 0:
+                stored.append(np.conjugate(P_half.T) @ states)
+        states = np.conjugate(P_half.T) @ states
+        if store_states:
+            return states, np.array(stored)
+        return states
+
+    def propagate_adaptive(self, initials, amplitudes, tol = None, samples = 'constant'):
+        '''
+        Doubles the number of substeps until the final states change by less than tol; the chosen
+        n_sub is kept for later calls. Returns the final states and the error estimate
+        '''
+        tol = self.tol if tol is None else tol
+        n_sub = self.n_sub
+        states = self.propagate(initials, amplitudes, n_sub, samples = samples)
+        while True:
+            finer = self.propagate(initials, amplitudes, 2 * n_sub, samples = samples)
+            error = np.max(np.linalg.norm(finer - states, axis = 0))
+            n_sub = 2 * n_sub
+            states = finer
+            if error < tol:
+                break
+            if n_sub >= self.max_sub:
+                logger.warning('split operator: error %.2e > tol %.2e with %d substeps' % (error, tol, n_sub))
+                break
+        self.n_sub = n_sub
+        return states, error
+
+    def fidelity(self, initials, targets, amplitudes, n_sub = None):
+        '''
+        |mean_s <target_s|U|initial_s>|^2
+        '''
+        finals = self.propagate(initials, amplitudes, n_sub)
+        targets = np.array(targets, dtype = complex).reshape(self.dim, -1)
+        return np.abs(np.mean(np.sum(np.conjugate(targets) * finals, axis = 0)))**2
+
+    def fidelity_and_gradient(self, initials, targets, amplitudes, n_sub = None):
+        '''
+        Fidelity |mean_s <target_s|U|initial_s>|^2 and its gradient with respect to the amplitudes
+        (n_controls, n_samples), exact for the split propagator with n_sub substeps
+
+        The backward sweep runs the states and the targets back through the inverse (unitary) steps,
+        so the memory is O(d n_states)
+        '''
+        n_sub = self.n_sub if n_sub is None else n_sub
+        tau = self.dt / n_sub
+        amplitudes = np.asarray(amplitudes, dtype = float).reshape(len(self.controls), -1)
+        Cs, dCs = hermitian_expm(self.control_hamiltonians(amplitudes), tau, self.controls)
+        P_half, P = self.free_propagator(tau / 2), self.free_propagator(tau)
+        P_dag = np.conjugate(P.T)
+
+        states = self.propagate(initials, amplitudes, n_sub)
+        chis = np.array(targets, dtype = complex).reshape(self.dim, -1)
+        n = chis.shape[1]
+        overlap = np.mean(np.sum(np.conjugate(chis) * states, axis = 0))
+
+        # undo the final P_half^dag, then step back through (C P) per substep
+        states = P_half @ states
+        chis = P_half @ chis
+        doverlap = np.zeros(amplitudes.shape, dtype = complex)
+        for k in reversed(range(len(Cs))):
+            C_dag = np.conjugate(Cs[k].T)
+            for _ in range(n_sub):
+                states = P_dag @ states
+                chis = P_dag @ chis
+                states = self.apply_control(C_dag, states)
+                # <chi|dC|psi> = sum_ab dC_ab O_ab with O_ab = sum_{x,s} conj(chi_a) psi_b
+                O = np.einsum('axn,bxn->ab', np.conjugate(chis.reshape(self.qnum, self.d_modes, n)),
+                              states.reshape(self.qnum, self.d_modes, n))
+                doverlap[:, k] += np.einsum('jab,ab->j', dCs[:, k], O)
+                chis = self.apply_control(C_dag, chis)
+        doverlap = doverlap / n
+        return np.abs(overlap)**2, 2 * np.real(np.conjugate(overlap) * doverlap)
@@ -0,0 +1,196 @@
+'''
+Optimize / compile / verify stages of a sweep task for the two pulse families
+
+    ecd   : optimize = MECD_paramV2.BatchOptimizer (ECD circuit parameters)
+            compile  = ecd_pulse_multimode.get_pulses (parameters -> qubit and cavity dac pulses)
+            verify   = qutip_sim_multimode.me_solve (pulses -> final state fidelity)
+    cgrape: optimize = circle_grape_v5 run_optimal_control (native or qoc GRAPE)
+            compile  = return_pulses (GRAPE steps -> pulses at SAMPLE_RATE)
+            verify   = split_mesolve (split operator simulation of the pulses) or qutip_mesolve
+
+A task is a dict with the sections of the sweep config (see mcd.sweep): 'method', 'output' and the
+keyword arguments of the classes in 'system', 'optimize', 'compile' and 'verify'. States are level
+lists [q, n_1, n_2, ...] (qubit level, then the mode Fock numbers; cgrape also takes flat indices).
+Every stage gets the results of the earlier stages of the task and returns a dict of scalars and
+file names (one row of the merged results).
+
+The class files live in the source tree, not in the mcd package: they are imported from the
+repository root (parent of mcd, or MCD_ROOT).
+'''
+import os
+import sys
+import numpy as np
+from .runtime import get_logger
+
+logger = get_logger('stages')
+
+class_dirs = {
+    'ecd': os.path.join('Echoed Conditional Displacements', 'Two Mode', 'class_description'),
+    'cgrape': os.path.join('Circle Grape', 'class description'),
+}
+
+
+def repo_root():
+    return os.environ.get('MCD_ROOT', os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+def import_classes(method):
+    '''
+    Puts the class directory of method on sys.path
+    '''
+    path = os.path.join(repo_root(), class_dirs[method])
+    if not os.path.isdir(path):
+        raise ImportError(path + ' not found: install with pip install -e . or set MCD_ROOT to the repository')
+    if path not in sys.path:
+        sys.path.append(path)
+
+
+def data_path(task):
+    path = os.path.join(task['output'], 'data')
+    os.makedirs(path, exist_ok = True)
+    return path
+
+
+def previous(results, stage, key):
+    if stage not in results or key not in results[stage]:
+        raise KeyError('no ' + key + ' from the ' + stage + ' stage of task ' + str(results.get('task_id')) +
+                       ', run ' + stage + ' first')
+    return results[stage][key]
+
+
+def ecd_state(levels, n_q, n_c):
+    '''
+    |q> x |n_1> x |n_2> ... from levels = [q, n_1, n_2, ...]
+    '''
+    from qutip import basis, tensor
+    return tensor([basis(n_q, levels[0])] + [basis(n_c, n) for n in levels[1:]])
+
+
+def cgrape_index(state, op):
+    '''
+    Flat index of a level list [q, n_1, ...] in the qubit x modes space of op (ints are kept)
+    '''
+    if np.ndim(state) == 0:
+        return int(state)
+    levels = list(state) + [0 for _ in range(op.mmnum + 1 - len(state))]
+    return int(np.ravel_multi_index(levels, [op.qnum] + [op.mnum for _ in range(op.mmnum)]))
+
+
+#----------------------------------------------------------------------------------------------
+# ECD
+#----------------------------------------------------------------------------------------------
+
+def ecd_optimize(task, results):
+    import_classes('ecd')
+    from MECD_paramV2 import BatchOptimizer
+    params = dict(task.get('optimize', {}))
+    n_q, n_c = params['N_ancilla_levels'], params['N_cav']
+    params['initial_states'] = [ecd_state(s, n_q, n_c) for s in params['initial_states']]
+    params['target_states'] = [ecd_state(s, n_q, n_c) for s in params['target_states']]
+    params['filename'] = os.path.join(data_path(task), results['task_id'] + '_opt.h5')
+    params.setdefault('name', results['task_id'])
+
+    opt = BatchOptimizer(**params)
+    opt.optimize()
+    return {'param_file': opt.filename, 'optimizer_fidelity': float(np.real(opt.best_fidelity()))}
+
+
+def ecd_sim(task, param_file):
+    import_classes('ecd')
+    from Simulation_Classes_Multimode_V12 import qutip_sim_multimode
+    system = task.get('system', {})
+    return qutip_sim_multimode(system['n_q'], system['n_c'], system['N_modes'], method = 'ecd',
+                               version = system.get('version', 'ge'), filename = param_file,
+                               sim_params = system.get('sim_params'), plot_pulses = False)
+
+
+def ecd_compile(task, results):
+    param_file = previous(results, 'optimize', 'param_file')
+    pulse_sim = ecd_sim(task, param_file).pulse_sim
+    filename = os.path.join(data_path(task), results['task_id'] + '_pulses.npz')
+    np.savez(filename, qubit_dac_pulse_GHz = np.array(pulse_sim.qubit_dac_pulse_GHz),
+             alpha = np.array(pulse_sim.alpha))
+    return {'pulse_file': filename, 'pulse_time': int(np.shape(pulse_sim.alpha)[-1])}
+
+
+def ecd_verify(task, results):
+    param_file = previous(results, 'optimize', 'param_file')
+    system = task.get('system', {})
+    settings = dict(task.get('verify', {}))
+    states = settings.pop('states', None) or list(zip(task['optimize']['initial_states'],
+                                                      task['optimize']['target_states']))
+    sim = ecd_sim(task, param_file)
+    sim.initialize_ECD_and_qubit_drive()
+    for name, kwargs in settings.get('dissipation', {}).items(): # e.g. add_qubit_relaxation: {T1: 30e+3}
+        getattr(sim, name)(**kwargs)
+    fids = []
+    for initial, target in states:
+        sim.me_solve(initial = ecd_state(initial, system['n_q'], system['n_c']), store_states = False,
+                     nsteps = settings.get('nsteps', 10000))
+        fids.append(float(sim.get_fidelity(ecd_state(target, system['n_q'], system['n_c']))))
+    return {'fidelity': float(np.mean(fids)), 'min_fidelity': float(np.min(fids))}
+
+
+#----------------------------------------------------------------------------------------------
+# circle GRAPE
+#----------------------------------------------------------------------------------------------
+
+def cgrape_system(task):
+    import_classes('cgrape')
+    from circle_grape_v5 import multimode_circle_grape_optimal_control
+    system = dict(task.get('system', {}))
+    system['hparams'] = dict((k, np.array(v) if isinstance(v, list) else v) for k, v in system['hparams'].items())
+    return multimode_circle_grape_optimal_control(**system)
+
+
+def cgrape_optimize(task, results):
+    op = cgrape_system(task)
+    params = dict(task.get('optimize', {}))
+    params['initial_states'] = [cgrape_index(s, op) for s in params['initial_states']]
+    params['target_states'] = [cgrape_index(s, op) for s in params['target_states']]
+    params.setdefault('backend', 'native')
+    params.update(file_name = results['task_id'], data_path = data_path(task), show_plots = False)
+
+    op.run_optimal_control(**params)
+    import h5py
+    with h5py.File(op.filename, 'r') as f:
+        error = float(np.array(f['error'])[-1])
+    return {'grape_file': op.filename, 'grape_error': error}
+
+
+def cgrape_compile(task, results):
+    op = cgrape_system(task)
+    pulses = np.array(op.return_pulses(previous(results, 'optimize', 'grape_file')))
+    filename = os.path.join(data_path(task), results['task_id'] + '_pulses.npz')
+    np.savez(filename, pulses = pulses, tlist = op.tlist)
+    return {'pulse_file': filename, 'pulse_time': float(op.total_time)}
+
+
+def cgrape_verify(task, results):
+    op = cgrape_system(task)
+    settings = task.get('verify', {})
+    initials = [cgrape_index(s, op) for s in task['optimize']['initial_states']]
+    targets = [cgrape_index(s, op) for s in task['optimize']['target_states']]
+    d = op.qnum * op.mnum**op.mmnum
+    starts = np.eye(d)[initials]
+    grape_file = previous(results, 'optimize', 'grape_file')
+    # simulator: 'split' (closed system) or 'qutip' (qutip_mesolve, with the t1params dissipation)
+    if settings.get('simulator', 'qutip' if op.t1params is not None else 'split') == 'qutip':
+        fids = []
+        for start, target in zip(starts, targets):
+            tlist, out = op.qutip_mesolve(start, filename = grape_file)
+            final = out.final_state.full()
+            fids.append(abs(final[target, 0])**2 if final.shape[1] == 1 else np.real(final[target, target]))
+        fids = np.array(fids)
+    else:
+        tlist, finals = op.split_mesolve(starts, filename = grape_file, store_states = False,
+                                         tol = settings.get('tol', 1e-6))
+        fids = np.abs(finals[targets, np.arange(len(targets))])**2
+    return {'fidelity': float(np.mean(fids)), 'min_fidelity': float(np.min(fids))}
+
+
+stages = {
+    'ecd': {'optimize': ecd_optimize, 'compile': ecd_compile, 'verify': ecd_verify},
+    'cgrape': {'optimize': cgrape_optimize, 'compile': cgrape_compile, 'verify': cgrape_verify},
+}
+stage_order = ['optimize', 'compile', 'verify']
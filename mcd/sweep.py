@@ -0,0 +1,228 @@
+'''
+Task grids with resumable state for optimization / compile / verify sweeps (mcd command line)
+
+Sweep config (YAML, or JSON):
+
+    method: cgrape                    # or ecd (see mcd.stages)
+    output: sweeps/fock_transfer      # state/, data/ and results.csv go here
+    workers: 4                        # scheduler worker processes (1 runs in this process)
+    retries: 1                        # reruns of a failed stage (mcd.scheduler)
+    pipeline: {optimize: 1, verify: 4} # or: worker pool per stage instead of workers
+    queue_size: 4                     # results waiting between two stages (backpressure)
+    stages: [optimize, compile, verify]
+    system:   {...}                   # class keyword arguments, see mcd.stages
+    optimize: {...}
+    verify:   {...}
+    grid:                             # cartesian product, dotted keys into the sections above
+      optimize.total_time: [1000, 2000, 4000]
+      optimize.initial_states,optimize.target_states: [[[[0, 1, 0]], [[0, 0, 1]]], ...] # varied together
+
+Every grid point is a task, identified by a hash of its whole configuration (method, system, optimize,
+verify, ... with the grid values set; output and the scheduler settings workers, retries, pipeline,
+queue_size and stages are left out), so changing anything that affects the results gives new tasks
+instead of resuming stale records. When a stage of a task finishes
+(or fails) its record is written to state/<task_id>.json, so an interrupted sweep continues where it
+stopped: finished stages are skipped, failed ones are run again. merge_results collects the records
+into results.csv (one row per task: grid values, status and the stage results).
+'''
+import os
+import csv
+import copy
+import json
+import time
+import hashlib
+import itertools
+import traceback
+from .runtime import get_logger, set_headless
+from . import stages as stage_functions
+from . import metrics
+
+logger = get_logger('sweep')
+
+
+def load_config(filename):
+    with open(filename) as f:
+        text = f.read()
+    if filename.endswith('.json'):
+        return json.loads(text)
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError('pyyaml is needed for YAML configs (pip install pyyaml), or use a .json config')
+    return yaml.safe_load(text)
+
+
+def set_dotted(config, key, value):
+    '''
+    config['a']['b'] = value for key = 'a.b' (missing sections are created)
+    '''
+    keys = key.split('.')
+    for k in keys[:-1]:
+        config = config.setdefault(k, {})
+    config[keys[-1]] = value
+
+
+# config keys that do not change the results of a task (left out of its id)
+run_keys = ['output', 'workers', 'retries', 'pipeline', 'queue_size', 'stages', 'point', 'task_id']
+
+
+def task_id(task):
+    '''
+    Hash of the expanded task (config with the grid values set) without the run_keys
+    '''
+    config = dict((k, v) for k, v in task.items() if k not in run_keys)
+    return hashlib.sha1(json.dumps(config, sort_keys = True, default = str).encode()).hexdigest()[:12]
+
+
+def expand_grid(config):
+    '''
+    One task (config with the grid values set, plus 'task_id' and 'point') per grid point
+    '''
+    base = dict((k, v) for k, v in config.items() if k != 'grid')
+    grid = config.get('grid') or {}
+    keys = sorted(grid)
+    tasks = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        point = {}
+        for k, v in zip(keys, values):
+            point.update(zip(k.split(','), v) if ',' in k else [(k, v)])
+        task = copy.deepcopy(base)
+        for k, v in point.items():
+            set_dotted(task, k, v)
+        task['point'] = point
+        task['task_id'] = task_id(task)
+        tasks.append(task)
+    return tasks
+
+
+def state_file(output, tid):
+    return os.path.join(output, 'state', tid + '.json')
+
+
+def load_record(output, tid):
+    filename = state_file(output, tid)
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_record(output, record):
+    '''
+    Atomic write (temporary file + rename), a killed sweep never leaves a half written record
+    '''
+    filename = state_file(output, record['task_id'])
+    os.makedirs(os.path.dirname(filename), exist_ok = True)
+    tmp = filename + '.tmp%d' % os.getpid()
+    with open(tmp, 'w') as f:
+        json.dump(record, f, indent = 1, default = str)
+    os.replace(tmp, filename)
+
+
+def pending_stages(record, stages):
+    done = {} if record is None else record.get('stages', {})
+    return [s for s in stages if s not in done or done[s].get('status') != 'done']
+
+
+def run_task(task, stages, record = None):
+    '''
+    Runs the pending stages of task in order (the scheduler workers run one stage at a time); stops
+    at the first failing stage. Returns the updated record
+    '''
+    set_headless(True)
+    record = record or {'task_id': task['task_id'], 'point': task['point'], 'method': task['method'], 'stages': {}}
+    functions = stage_functions.stages[task['method']]
+    for stage in pending_stages(record, stages):
+        results = dict((s, r['results']) for s, r in record['stages'].items() if r.get('status') == 'done')
+        results['task_id'] = task['task_id']
+        start = time.time()
+        try:
+            with metrics.timer('sweep.stage', stage = stage, method = task['method']):
+                out = functions[stage](task, results)
+            record['stages'][stage] = {'status': 'done', 'results': out, 'run_time': time.time() - start}
+        except Exception:
+            record['stages'][stage] = {'status': 'failed', 'error': traceback.format_exc(),
+                                       'run_time': time.time() - start}
+            save_record(task['output'], record)
+            break
+        save_record(task['output'], record)
+    metrics.flush()
+    return record
+
+
+def run_sweep(config, stages = None, workers = None, resume = True):
+    '''
+    Runs stages (default config['stages'], else all) of every task of the grid with the local
+    scheduler (mcd.scheduler) on workers processes (default config['workers'], else 1) or on the
+    per stage pools of config['pipeline'], failed stages are retried config['retries'] times
+    (default 1); resume = False starts over
+    Returns the records and writes results.csv
+    '''
+    stages = stages or config.get('stages') or stage_functions.stage_order
+    stages = [s for s in stage_functions.stage_order if s in stages]
+    workers = workers or config.get('workers', 1)
+    output = config['output']
+    os.makedirs(output, exist_ok = True)
+
+    tasks = expand_grid(config)
+    todo = []
+    for task in tasks:
+        if not resume and os.path.exists(state_file(output, task['task_id'])):
+            os.remove(state_file(output, task['task_id']))
+        if pending_stages(load_record(output, task['task_id']), stages):
+            todo.append(task)
+    logger.info('%d tasks, %d to run (%s) on %d workers' % (len(tasks), len(todo), ', '.join(stages), workers))
+
+    from .scheduler import run_graph
+    run_graph(todo, stages, output, workers = workers, retries = config.get('retries', 1),
+              pools = config.get('pipeline'), queue_size = config.get('queue_size'))
+    records = dict((t['task_id'], load_record(output, t['task_id'])) for t in tasks)
+
+    merge_results(output, [t['task_id'] for t in tasks])
+    return [records[t['task_id']] for t in tasks]
+
+
+def log_record(record):
+    failed = [s for s, r in record['stages'].items() if r['status'] == 'failed']
+    if failed:
+        logger.warning('task %s (%s) failed in %s:\n%s' % (record['task_id'], str(record['point']), failed[0],
+                                                           record['stages'][failed[0]]['error']))
+    else:
+        logger.info('task %s (%s) done' % (record['task_id'], str(record['point'])))
+    return record
+
+
+def merge_results(output, task_ids = None):
+    '''
+    results.csv with one row per task record in output/state (or per task_ids): task_id, method,
+    status, the grid values and the results of every stage
+    '''
+    if task_ids is None:
+        state = os.path.join(output, 'state')
+        task_ids = sorted(f[:-5] for f in os.listdir(state) if f.endswith('.json')) if os.path.isdir(state) else []
+    rows = []
+    for tid in task_ids:
+        record = load_record(output, tid)
+        if record is None:
+            continue
+        statuses = dict((s, r['status']) for s, r in record['stages'].items())
+        row = {'task_id': tid, 'method': record.get('method'),
+               'status': 'failed' if 'failed' in statuses.values() else 'done'}
+        row.update(record['point'])
+        for stage in stage_functions.stage_order:
+            if stage in record['stages']:
+                row[stage + '_time'] = record['stages'][stage]['run_time']
+                row.update(record['stages'][stage].get('results', {}))
+        rows.append(row)
+
+    columns = []
+    for row in rows:
+        columns.extend(k for k in row if k not in columns)
+    filename = os.path.join(output, 'results.csv')
+    with open(filename, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict((k, json.dumps(v) if isinstance(v, (list, dict)) else v) for k, v in row.items()))
+    logger.info('%d tasks merged into %s' % (len(rows), filename))
+    return filename
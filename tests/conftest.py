@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def transmon_mode():
+    '''
+    Small circle GRAPE like system: a 3 level transmon dispersively coupled to a 4 level mode, x and y
+    drives on the transmon only (h x I_mode), random amplitudes and states
+    '''
+    rng = np.random.default_rng(7)
+    qnum, mnum = 3, 4
+    q = np.diag(np.sqrt(np.arange(1, qnum)), 1)
+    a = np.diag(np.sqrt(np.arange(1, mnum)), 1)
+    nq, na = q.T @ q, a.T @ a
+    H0 = -0.2 / 2 * np.kron(nq @ (nq - np.eye(qnum)), np.eye(mnum)) - 0.01 * np.kron(nq, na)
+    Hops = np.array([np.kron(q + q.T, np.eye(mnum)), np.kron(1j * (q - q.T), np.eye(mnum))])
+    d, steps = qnum * mnum, 12
+
+    def random_states(n):
+        states = rng.normal(size = (d, n)) + 1j * rng.normal(size = (d, n))
+        return states / np.linalg.norm(states, axis = 0)
+
+    return {'H0': H0, 'Hops': Hops, 'qnum': qnum, 'dt': 2.0, 'steps': steps,
+            'amplitudes': 0.05 * rng.normal(size = (2, steps)),
+            'initials': random_states(2), 'targets': random_states(2)}
@@ -0,0 +1,81 @@
+'''
+Adjoint gradients of the ECD circuit (MECD_paramV2 ecd_kernels.adjoint_gradients, BatchOptimizer
+gradient_backend = 'adjoint') against GradientTape through the layer matrices, in complex128 with a
+3 level ancilla and a small N_cav
+'''
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('ECD_control')
+
+from mcd import stages
+
+stages.import_classes('ecd')
+import MECD_paramV2 # noqa: E402
+
+N_cav, N_blocks, N_multistart = 4, 3, 2
+
+
+def random_circuit(rng, N_modes):
+    shape = [N_modes, N_blocks, N_multistart]
+    return [rng.uniform(0, 2, shape), rng.uniform(-np.pi, np.pi, shape),
+            rng.uniform(0, 1, [1, N_multistart]), rng.uniform(-np.pi, np.pi, [1, N_multistart]),
+            rng.uniform(-np.pi, np.pi, shape[:2] + [2] + shape[2:]), rng.uniform(-np.pi, np.pi, shape[:2] + [2] + shape[2:])]
+
+
+def random_states(rng, dim, n):
+    states = rng.normal(size = (n, dim, 1)) + 1j * rng.normal(size = (n, dim, 1))
+    return states / np.linalg.norm(states, axis = 1, keepdims = True)
+
+
+@pytest.mark.parametrize('N_modes', [1, 2])
+@pytest.mark.parametrize('BCH_approx', [True, False])
+@pytest.mark.parametrize('real_part', [True, False])
+def test_adjoint_gradients(N_modes, BCH_approx, real_part):
+    rng = np.random.default_rng(N_modes)
+    kernels = MECD_paramV2.get_kernels(N_modes, 3, N_cav, N_blocks, 2, N_multistart, BCH_approx, 'complex128')
+    variables = [tf.Variable(v, dtype = tf.float64) for v in random_circuit(rng, N_modes)]
+    initials = tf.constant(random_states(rng, kernels.dim, 2))
+    targets_dag = tf.linalg.adjoint(tf.constant(random_states(rng, kernels.dim, 2)))
+
+    if real_part:
+        fidelities, adjoint = kernels.tf_state_transfer_fidelities_real_part, kernels.tf_adjoint_gradients_real_part
+    else:
+        fidelities, adjoint = kernels.tf_state_transfer_fidelities, kernels.tf_adjoint_gradients
+    with tf.GradientTape() as tape:
+        fids = fidelities(*variables, initials, targets_dag)
+        loss = MECD_paramV2.loss_fun(fids)
+    tape_grads = tape.gradient(loss, variables)
+    adjoint_fids, adjoint_grads = adjoint(*variables, initials, targets_dag)
+
+    np.testing.assert_allclose(adjoint_fids.numpy(), fids.numpy(), atol = 1e-13)
+    for tape_grad, adjoint_grad, variable in zip(tape_grads, adjoint_grads, variables):
+        expected = np.zeros(variable.shape) if tape_grad is None else tape_grad.numpy() # final displacement
+        np.testing.assert_allclose(adjoint_grad.numpy(), expected, atol = 1e-12)
+
+
+@pytest.mark.parametrize('N_modes', [1, 2])
+def test_train_step(N_modes):
+    from qutip import Qobj
+    rng = np.random.default_rng(10 + N_modes)
+    dims = [3] + [N_cav for _ in range(N_modes)]
+    dim = int(np.prod(dims))
+    states = lambda: [Qobj(s, dims = [dims, [1 for _ in dims]]) for s in random_states(rng, dim, 2)]
+    initial, target = states(), states()
+    optimizers = dict((backend, MECD_paramV2.BatchOptimizer(
+        N_cav = N_cav, N_modes = N_modes, N_multistart = N_multistart, N_blocks = N_blocks, N_ancilla_levels = 3,
+        N_single_layer = 2, initial_states = initial, target_states = target, real_part_only = True,
+        precision = 'double', gradient_backend = backend)) for backend in ['autodiff', 'adjoint'])
+    for a, b in zip(optimizers['autodiff']._optimization_variables(), optimizers['adjoint']._optimization_variables()):
+        b.assign(a)
+
+    steps = {}
+    for backend, opt in optimizers.items():
+        variables = opt._optimization_variables()
+        before = [v.numpy() for v in variables]
+        fids = opt._train_step(tf.optimizers.SGD(1.0), variables)
+        steps[backend] = fids.numpy(), [v.numpy() - b for v, b in zip(variables, before)]
+    np.testing.assert_allclose(steps['adjoint'][0], steps['autodiff'][0], atol = 1e-13)
+    for adjoint_step, autodiff_step in zip(steps['adjoint'][1], steps['autodiff'][1]):
+        np.testing.assert_allclose(adjoint_step, autodiff_step, atol = 1e-12)
@@ -0,0 +1,68 @@
+'''
+BatchOptimizer precision: kernel sets keyed on the dtype, 'double' training and the 'mixed' complex128
+polish, which keeps per multistart the better of the polished and the verified parameters
+'''
+import h5py
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+pytest.importorskip('ECD_control')
+
+from mcd import stages
+
+stages.import_classes('ecd')
+import MECD_paramV2 # noqa: E402
+
+
+def optimizer(precision, filename = None, **kwargs):
+    from qutip import basis, tensor
+    N_cav = 4
+    initial = [tensor(basis(3, 0), basis(N_cav, 0))]
+    target = [tensor(basis(3, 0), basis(N_cav, 1))]
+    return MECD_paramV2.BatchOptimizer(
+        N_cav = N_cav, N_modes = 1, N_multistart = 3, N_blocks = 2, N_ancilla_levels = 3, N_single_layer = 2,
+        initial_states = initial, target_states = target, precision = precision, filename = filename,
+        epochs = 2, epoch_size = 3, term_fid = 2, dfid_stop = -1, timestamps = [], **kwargs)
+
+
+def test_kernels_keyed_on_precision():
+    single, double, other_single = optimizer('single'), optimizer('double'), optimizer('single')
+    assert single.kernels is not double.kernels
+    assert single.kernels is other_single.kernels
+    assert single.kernels.dtype == tf.complex64
+    assert double.kernels.dtype == tf.complex128
+    assert double.betas_rho.dtype == tf.float64
+
+
+def test_double(tmp_path):
+    opt = optimizer('double', str(tmp_path / 'double.h5'))
+    timestamp = opt.optimize(do_prints = False)
+    with h5py.File(opt.filename, 'r') as f:
+        fids = f[timestamp]['fidelities'][()]
+        assert f[timestamp].attrs['precision'] == 'double'
+    assert fids.shape == (3, 3) # initial + 2 epochs
+    assert np.all((fids >= 0) & (fids <= 1))
+    assert opt.dtype == tf.complex128
+    assert opt.all_fidelities().dtype == np.float64
+
+
+def test_mixed_polish_keeps_better(tmp_path):
+    opt = optimizer('mixed', str(tmp_path / 'mixed.h5'), polish_epochs = 2, polish_learning_rate = 0.5)
+    verified = {}
+    polish = opt._polish
+
+    def checked_polish(*args, **kwargs):
+        assert opt.dtype == tf.complex64
+        opt.set_dtype(tf.complex128)
+        verified['fids'] = opt.all_fidelities()
+        return polish(*args, **kwargs)
+    opt._polish = checked_polish
+
+    timestamp = opt.optimize(do_prints = False)
+    assert opt.dtype == tf.complex128
+    assert opt.kernels.dtype == tf.complex128
+    with h5py.File(opt.filename, 'r') as f:
+        saved = f[timestamp]['fidelities'][-1]
+    assert np.all(saved >= verified['fids'] - 1e-12)
+    np.testing.assert_allclose(saved, opt.all_fidelities(), atol = 1e-12)
@@ -0,0 +1,71 @@
+import logging
+import numpy as np
+import h5py
+import pytest
+from scipy.optimize import OptimizeResult
+
+from mcd import grape
+from mcd.grape import exact_fidelity_and_gradient, exact_propagate, native_grape
+from mcd.split_operator import split_operator_propagator
+
+
+def finite_difference(fidelity, amplitudes, eps = 1e-6):
+    grad = np.zeros_like(amplitudes)
+    for idx in np.ndindex(*amplitudes.shape):
+        step = np.zeros_like(amplitudes)
+        step[idx] = eps
+        grad[idx] = (fidelity(amplitudes + step) - fidelity(amplitudes - step)) / (2 * eps)
+    return grad
+
+
+def overlap_fidelity(finals, targets):
+    return np.abs(np.mean(np.sum(np.conjugate(targets) * finals, axis = 0)))**2
+
+
+def test_exact_gradient(transmon_mode):
+    s = transmon_mode
+    fid, grad = exact_fidelity_and_gradient(s['H0'], s['Hops'], s['dt'], s['amplitudes'], s['initials'], s['targets'])
+    fidelity = lambda u: overlap_fidelity(exact_propagate(s['H0'], s['Hops'], s['dt'], u, s['initials']), s['targets'])
+    assert fid == pytest.approx(fidelity(s['amplitudes']), abs = 1e-12)
+    np.testing.assert_allclose(grad, finite_difference(fidelity, s['amplitudes']), atol = 1e-7)
+
+
+@pytest.mark.parametrize('n_sub', [1, 3])
+def test_split_gradient(transmon_mode, n_sub):
+    s = transmon_mode
+    split = split_operator_propagator.from_full(s['H0'], s['Hops'], s['dt'], s['qnum'], n_sub = n_sub)
+    fid, grad = split.fidelity_and_gradient(s['initials'], s['targets'], s['amplitudes'])
+    fidelity = lambda u: split.fidelity(s['initials'], s['targets'], u)
+    assert fid == pytest.approx(fidelity(s['amplitudes']), abs = 1e-12)
+    np.testing.assert_allclose(grad, finite_difference(fidelity, s['amplitudes']), atol = 1e-7)
+
+
+def test_native_grape_snapshots_accepted_iterates(transmon_mode, tmp_path, monkeypatch):
+    s = transmon_mode
+    accepted = s['amplitudes'].ravel() * 0.5
+
+    def minimize(fun, x0, callback = None, **kwargs):
+        # one accepted iterate, then a line search point that L-BFGS-B rejects
+        fun(accepted)
+        callback(accepted)
+        fun(accepted + 0.3)
+        return OptimizeResult(x = accepted, message = 'stopped')
+
+    monkeypatch.setattr(grape, 'minimize', minimize)
+    uks, finals, filename = native_grape(s['H0'], s['Hops'], ['x', 'y'], list(s['targets'].T), s['dt'] * s['steps'],
+                                         s['steps'], list(s['initials'].T), initial_guess = s['amplitudes'],
+                                         data_path = str(tmp_path))
+    np.testing.assert_allclose(uks, accepted.reshape(2, -1))
+    with h5py.File(filename, 'r') as f:
+        np.testing.assert_allclose(f['uks'][-1], uks)
+        assert f['error'][-1] == pytest.approx(1 - overlap_fidelity(finals, s['targets']), abs = 1e-12)
+
+
+def test_native_grape_warns_on_unsupported_reg_coeffs(transmon_mode, caplog):
+    s = transmon_mode
+    with caplog.at_level(logging.WARNING, logger = 'mcd.grape'):
+        native_grape(s['H0'], s['Hops'], ['x', 'y'], list(s['targets'].T), s['dt'] * s['steps'], s['steps'],
+                     list(s['initials'].T), convergence = {'max_iterations': 1},
+                     reg_coeffs = {'dwdt': 0.1, 'states_forbidden_list': [5], 'forbidden_coeff_list': [1.0]},
+                     save = False)
+    assert 'forbidden_coeff_list, states_forbidden_list' in caplog.text
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from scipy.linalg import expm
+from scipy.interpolate import CubicSpline
+
+from mcd.pwc_propagator import pwc_propagator
+
+
+@pytest.fixture
+def system():
+    '''
+    Closed two level system x 3 level mode with two drives, coefficients sampled on a 1 ns grid
+    '''
+    rng = np.random.default_rng(3)
+    a = np.diag(np.sqrt(np.arange(1, 3)), 1)
+    sz = np.diag([1., -1.])
+    H0 = 0.05 * np.kron(sz, np.eye(3)) - 0.01 * np.kron(sz, a.T @ a)
+    Hs = [np.kron(np.array([[0, 1], [1, 0]]), np.eye(3)), np.kron(np.eye(2), a + a.T)]
+    coeffs = 0.1 * np.cumsum(rng.normal(size = (2, 21)), axis = 1) / 5
+    initials = np.eye(6)[:, [0, 4]]
+    return H0, Hs, coeffs, initials
+
+
+def expm_product(H0, Hs, stages, dt, initials):
+    '''
+    prod_k prod_stages expm(-i dt (w0 H0 + sum_j c_j H_j)) on the initial states
+    '''
+    states = initials.astype(complex)
+    for k in range(stages[0][1].shape[1]):
+        for w0, c in stages:
+            H = w0 * H0 + sum(c[j, k] * Hs[j] for j in range(len(Hs)))
+            states = expm(-1j * dt * H) @ states
+    return states
+
+
+@pytest.mark.parametrize('method', ['taylor', 'expm_multiply', 'expm'])
+def test_midpoint_steps_match_expm(system, method):
+    H0, Hs, coeffs, initials = system
+    prop = pwc_propagator(H0, Hs, coeffs, dt = 1.0, method = method, order = 2)
+    midpoints = 0.5 * (coeffs[:, :-1] + coeffs[:, 1:])
+    reference = expm_product(H0, Hs, [(1.0, midpoints)], 1.0, initials)
+    np.testing.assert_allclose(prop.propagate(initials), reference, atol = 1e-10)
+
+
+def test_magnus_steps_match_expm_and_converge(system):
+    H0, Hs, coeffs, initials = system
+    prop = pwc_propagator(H0, Hs, coeffs, dt = 1.0, order = 4)
+    np.testing.assert_allclose(prop.propagate(initials), expm_product(H0, Hs, prop.stages, 1.0, initials), atol = 1e-10)
+
+    # fine midpoint steps of the cubic spline of the samples (what qutip integrates)
+    n_fine = 64
+    spline = CubicSpline(np.arange(coeffs.shape[1]), coeffs, axis = 1)
+    fine = spline((np.arange(20 * n_fine) + 0.5) / n_fine)
+    reference = expm_product(H0, Hs, [(1.0, fine)], 1.0 / n_fine, initials)
+    error = np.max(np.abs(prop.propagate(initials) - reference))
+    midpoint_error = np.max(np.abs(pwc_propagator(H0, Hs, coeffs, order = 2).propagate(initials) - reference))
+    assert error < 1e-4 and error < midpoint_error / 100
+
+
+def test_unitary_and_stored_states(system):
+    H0, Hs, coeffs, initials = system
+    prop = pwc_propagator(H0, Hs, coeffs, dt = 1.0)
+    U = prop.unitary()
+    np.testing.assert_allclose(U.conj().T @ U, np.eye(6), atol = 1e-10)
+    final, stored = prop.propagate(initials, store_states = True, stride = 6)
+    assert stored.shape == (1 + 4, 6, 2) # steps 6, 12, 18 and the last one (20)
+    np.testing.assert_allclose(stored[-1], final)
+    np.testing.assert_allclose(stored[1], expm_product(H0, Hs, [(w0, c[:, :6]) for w0, c in prop.stages], 1.0, initials),
+                               atol = 1e-10)
+    np.testing.assert_allclose(prop.fidelities(initials, U @ initials), [1, 1], atol = 1e-10)
@@ -0,0 +1,122 @@
+'''
+Local scheduler (mcd.scheduler) with a fake sweep method registered in mcd.stages.stages: retries,
+skipped stages and resumed sweeps on one worker (in this process), work stealing and backpressure
+on hand built queue states (shared pool and per stage pools)
+'''
+import json
+import os
+
+import pytest
+
+from mcd import scheduler, stages, sweep
+
+calls = []
+failing = set()
+
+
+def fake_stage(name):
+    def run(task, results):
+        calls.append((task['point']['x'], name))
+        if (task['point']['x'], name) in failing:
+            raise RuntimeError('fake failure')
+        return {name + '_x': task['point']['x']}
+    return run
+
+
+@pytest.fixture
+def fake_method(monkeypatch):
+    monkeypatch.setitem(stages.stages, 'fake', dict((s, fake_stage(s)) for s in stages.stage_order))
+    calls.clear()
+    failing.clear()
+    yield
+    calls.clear()
+    failing.clear()
+
+
+def config(output, **kwargs):
+    out = {'method': 'fake', 'output': str(output), 'grid': {'x': [1, 2]}, 'workers': 1}
+    out.update(kwargs)
+    return out
+
+
+def queue_jobs(output):
+    with open(os.path.join(str(output), 'queue.json')) as f:
+        return json.load(f)['jobs']
+
+
+def test_retry_then_skip(tmp_path, fake_method):
+    failing.add((1, 'compile'))
+    records = sweep.run_sweep(config(tmp_path, retries = 1))
+    assert calls.count((1, 'compile')) == 2
+    assert (1, 'verify') not in calls
+    assert records[0]['stages']['compile']['status'] == 'failed'
+    assert 'verify' not in records[0]['stages']
+    assert [r['status'] for r in records[1]['stages'].values()] == ['done'] * 3
+
+    jobs = queue_jobs(tmp_path)
+    tid = records[0]['task_id']
+    assert jobs[scheduler.job_id(tid, 'compile')]['status'] == 'failed'
+    assert jobs[scheduler.job_id(tid, 'compile')]['attempts'] == 2
+    assert jobs[scheduler.job_id(tid, 'verify')]['status'] == 'skipped'
+
+
+def test_resume_runs_pending_stages(tmp_path, fake_method):
+    failing.add((2, 'verify'))
+    sweep.run_sweep(config(tmp_path, retries = 0))
+    failing.clear()
+    calls.clear()
+    records = sweep.run_sweep(config(tmp_path, retries = 0))
+    assert calls == [(2, 'verify')]
+    assert all(r['stages']['verify']['status'] == 'done' for r in records)
+
+    calls.clear()
+    sweep.run_sweep(config(tmp_path, retries = 0), resume = False)
+    assert sorted(calls) == sorted((x, s) for x in [1, 2] for s in stages.stage_order)
+
+
+def job(stage, cost, status = 'queued', after = None, next = None):
+    return {'task_id': 't', 'stage': stage, 'cost': cost, 'after': after, 'next': next, 'status': status,
+            'attempts': 0, 'worker': None}
+
+
+def test_next_job_steals_cheapest_from_most_loaded():
+    state = {'jobs': {'a': job('optimize', 5.), 'b': job('optimize', 3.), 'c': job('optimize', 1.),
+                      'd': job('optimize', 4.)},
+             'queues': {'idle': [], 'busy': ['a', 'b', 'c'], 'light': ['d']},
+             'serves': {'idle': None, 'busy': None, 'light': None}, 'retries': 1, 'queue_size': None}
+    assert scheduler.next_job(state, 'idle') == 'c'
+    assert state['queues']['idle'] == ['c']
+    assert state['queues']['busy'] == ['a', 'b']
+    # own queue first, most expensive job
+    assert scheduler.next_job(state, 'busy') == 'a'
+    assert scheduler.next_job(state, 'light') == 'd'
+
+
+def test_blocked_by_queue_size():
+    state = {'jobs': {'1:optimize': job('optimize', 1., 'done', next = '1:compile'),
+                      '1:compile': job('compile', 1., after = '1:optimize'),
+                      '2:optimize': job('optimize', 1., next = '2:compile'),
+                      '2:compile': job('compile', 1., after = '2:optimize')},
+             'queues': {'0': ['1:optimize', '1:compile', '2:optimize', '2:compile']},
+             'serves': {'0': None}, 'retries': 1, 'queue_size': 1}
+    assert scheduler.buffered(state, 'compile') == 1
+    assert scheduler.blocked(state, '2:optimize')
+    assert not scheduler.blocked(state, '1:compile') # last stage, no buffer after it
+    state['queue_size'] = 2
+    assert not scheduler.blocked(state, '2:optimize')
+    state['queue_size'] = None
+    assert not scheduler.blocked(state, '2:optimize')
+
+
+def test_pipeline_backpressure():
+    # queue_size 1 and one finished optimize result waiting: the optimizer waits, the compiler runs
+    state = {'jobs': {'1:optimize': job('optimize', 1., 'done', next = '1:compile'),
+                      '1:compile': job('compile', 1., after = '1:optimize'),
+                      '2:optimize': job('optimize', 1., next = '2:compile'),
+                      '2:compile': job('compile', 1., after = '2:optimize')},
+             'queues': {'optimize-0': ['2:optimize'], 'compile-0': ['1:compile', '2:compile']},
+             'serves': {'optimize-0': ['optimize'], 'compile-0': ['compile']}, 'retries': 1, 'queue_size': 1}
+    assert scheduler.next_job(state, 'optimize-0') is None
+    assert scheduler.next_job(state, 'compile-0') == '1:compile'
+    state['jobs']['1:compile']['status'] = 'done'
+    assert scheduler.next_job(state, 'optimize-0') == '2:optimize'
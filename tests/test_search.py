@@ -0,0 +1,86 @@
+'''
+resize_circuit for MECD_paramV1 (phis (N_modes, layers)) and MECD_paramV2 (phis (N_modes, layers,
+N_single_layer)) circuits; the padding layers are checked with the layer matrices at beta = 0
+(displacements = identity) written out in numpy
+'''
+import numpy as np
+import pytest
+
+from mcd.search import minimal_search, resize_circuit
+
+
+def rotation(phi, theta):
+    # ancilla_rotation of MECD_paramV1/V2 on a qubit
+    Phi, c, s = phi - np.pi / 2, np.cos(theta / 2), np.sin(theta / 2)
+    return np.array([[c, -1j * np.exp(-1j * Phi) * s], [-1j * np.exp(1j * Phi) * s, c]])
+
+
+def embed(u, version):
+    out = np.eye(3, dtype = complex)
+    idx = [0, 1] if version == 'ge' else [1, 2]
+    out[np.ix_(idx, idx)] = u
+    return out
+
+
+X = np.array([[0, 1], [1, 0]])
+
+
+def v1_layer(phi, theta):
+    # batch_construct_singlemode_block_operators of V1 at beta = 0: pi pulse swaps the rows
+    return X @ rotation(phi, theta)
+
+
+def v2_layer(phis, thetas, N_ancilla_levels):
+    if N_ancilla_levels == 2:
+        return X @ rotation(phis[0], thetas[0]) @ rotation(phis[1], thetas[1])
+    return embed(X, 'ge') @ embed(rotation(phis[0], thetas[0]), 'ge') @ embed(rotation(phis[1], thetas[1]), 'ef')
+
+
+def random_circuit(n_modes, n_layers, n_single_layer = None):
+    shape = (n_modes, n_layers) if n_single_layer is None else (n_modes, n_layers, n_single_layer)
+    return {
+        'betas': np.random.normal(size = (n_modes, n_layers)) + 1j * np.random.normal(size = (n_modes, n_layers)),
+        'phis': np.random.uniform(0, 2 * np.pi, size = shape),
+        'thetas': np.random.uniform(0, np.pi, size = shape),
+    }
+
+
+def test_resize_v1_circuit():
+    circuit = random_circuit(2, 3)
+    deeper = resize_circuit(circuit, 5)
+    assert deeper['betas'].shape == (2, 5) and deeper['phis'].shape == (2, 5) and deeper['thetas'].shape == (2, 5)
+    np.testing.assert_allclose(deeper['phis'][:, :3], circuit['phis'])
+    assert np.all(deeper['betas'][:, 3:] == 0)
+    for mode in range(2):
+        for layer in range(3, 5):
+            u = v1_layer(deeper['phis'][mode, layer], deeper['thetas'][mode, layer])
+            np.testing.assert_allclose(u, -1j * np.eye(2), atol = 1e-12)
+
+    shallower = resize_circuit(circuit, 2)
+    np.testing.assert_allclose(shallower['thetas'], circuit['thetas'][:, :2])
+
+
+@pytest.mark.parametrize('N_ancilla_levels, phase', [(3, -1), (2, -1j)])
+def test_resize_v2_circuit(N_ancilla_levels, phase):
+    circuit = random_circuit(2, 3, 2)
+    deeper = resize_circuit(circuit, 6, N_ancilla_levels)
+    assert deeper['betas'].shape == (2, 6) and deeper['phis'].shape == (2, 6, 2)
+    np.testing.assert_allclose(deeper['thetas'][:, :3], circuit['thetas'])
+    for mode in range(2):
+        for layer in range(3, 6):
+            u = v2_layer(deeper['phis'][mode, layer], deeper['thetas'][mode, layer], N_ancilla_levels)
+            np.testing.assert_allclose(u, phase * np.eye(N_ancilla_levels), atol = 1e-12)
+
+    shallower = resize_circuit(circuit, 1)
+    assert shallower['phis'].shape == (2, 1, 2)
+
+
+def test_minimal_search_respects_min_value():
+    evaluated = []
+    def evaluate(value, warm_start):
+        evaluated.append(value)
+        return value >= 3, value
+    best, history = minimal_search(evaluate, 15, 1, max_value = 19, min_value = 15)
+    assert best == 15 and min(evaluated) == 15
+    best, history = minimal_search(evaluate, 15, 1)
+    assert best == 3 and [v for v, _, _ in history][0] == 15
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from mcd.grape import exact_fidelity_and_gradient, exact_propagate
+from mcd.split_operator import split_operator_propagator
+
+
+def split(system, **kwargs):
+    return split_operator_propagator.from_full(system['H0'], system['Hops'], system['dt'], system['qnum'], **kwargs)
+
+
+def test_gradient_matches_finite_differences(transmon_mode):
+    s = transmon_mode
+    prop = split(s, n_sub = 2)
+    fid, grad = prop.fidelity_and_gradient(s['initials'], s['targets'], s['amplitudes'])
+    eps = 1e-6
+    fd = np.zeros_like(grad)
+    for idx in np.ndindex(*grad.shape):
+        step = np.zeros_like(s['amplitudes'])
+        step[idx] = eps
+        fd[idx] = (prop.fidelity(s['initials'], s['targets'], s['amplitudes'] + step)
+                   - prop.fidelity(s['initials'], s['targets'], s['amplitudes'] - step)) / (2 * eps)
+    np.testing.assert_allclose(grad, fd, atol = 1e-7)
+
+
+def test_propagate_converges_to_exact(transmon_mode):
+    s = transmon_mode
+    exact_final, exact_states = exact_propagate(s['H0'], s['Hops'], s['dt'], s['amplitudes'], s['initials'],
+                                                store_states = True)
+    prop = split(s)
+    errors = []
+    for n_sub in [1, 2, 4, 8]:
+        final = prop.propagate(s['initials'], s['amplitudes'], n_sub = n_sub)
+        errors.append(np.max(np.linalg.norm(final - exact_final, axis = 0)))
+    # symmetric splitting: second order in the substep
+    assert np.all(np.array(errors[:-1]) / np.array(errors[1:]) > 3.5)
+    final, states = prop.propagate(s['initials'], s['amplitudes'], n_sub = 8, store_states = True)
+    assert states.shape == exact_states.shape
+    np.testing.assert_allclose(states, exact_states, atol = 2 * errors[-1])
+
+
+def test_adaptive_and_fidelity_agree_with_exact(transmon_mode):
+    s = transmon_mode
+    prop = split(s, tol = 1e-6, max_sub = 1024)
+    final, error = prop.propagate_adaptive(s['initials'], s['amplitudes'])
+    exact_final = exact_propagate(s['H0'], s['Hops'], s['dt'], s['amplitudes'], s['initials'])
+    assert error < 1e-6
+    assert np.max(np.linalg.norm(final - exact_final, axis = 0)) < 1e-6
+    fid, grad = prop.fidelity_and_gradient(s['initials'], s['targets'], s['amplitudes'])
+    exact_fid, exact_grad = exact_fidelity_and_gradient(s['H0'], s['Hops'], s['dt'], s['amplitudes'],
+                                                        s['initials'], s['targets'])
+    assert fid == pytest.approx(exact_fid, abs = 1e-6)
+    np.testing.assert_allclose(grad, exact_grad, atol = 1e-5)
+
+
+def test_from_full_rejects_mode_controls(transmon_mode):
+    s = transmon_mode
+    mode_drive = np.kron(np.eye(s['qnum']), np.diag(np.sqrt(np.arange(1, 4)), 1) + np.diag(np.sqrt(np.arange(1, 4)), -1))
+    with pytest.raises(ValueError):
+        split_operator_propagator.from_full(s['H0'], [mode_drive], s['dt'], s['qnum'])